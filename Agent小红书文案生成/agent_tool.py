@@ -1,6 +1,11 @@
 import random # 用于模拟生成表情
+import threading
 import time # 用于模拟网络延迟
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import metrics
+from async_logger import get_logger
 from vector_db import db
+from reranker import Reranker
 TOOLS_DEFINITION = [
     {
         "type": "function",
@@ -38,10 +43,97 @@ TOOLS_DEFINITION = [
     }
 ]
 
-def mock_query_product_database(product_name: str) -> str:
-    """模拟查询产品数据库，返回预设的产品信息。"""
-    print(f"[Tool Call] 模拟查询产品数据库：{product_name}")
-    dic = db.search("product_information", product_name, "IP", 2)
+# 流水线模式下首轮额外提供的工具：模型在第一轮工具调用中直接以结构化参数给出提取到的需求，
+# 由对话引擎记录，无需单独的需求提取请求
+RECORD_REQUIREMENTS_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "record_requirements",
+        "description": "记录从用户需求中识别出的产品名和文案风格。应在第一轮调用，可与其他工具同时调用。",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "product_name": {
+                    "type": "string",
+                    "description": "需要营销的产品名，未识别到时为空字符串"
+                },
+                "style": {
+                    "type": "string",
+                    "description": "需要的营销文案风格（如：专业、幽默、活泼、科技感等），未识别到时为空字符串"
+                }
+            },
+            "required": ["product_name", "style"]
+        }
+    }
+}
+
+# 工具名 -> (集合名, 查询参数名, top_k)，同一轮内检索同一集合的工具调用可以合并为一次批量检索
+TOOL_SEARCH_SPECS = {
+    "query_product_information": ("product_information", "product_name", 2),
+    "generate_emoji": ("emotion2emoji", "context", 3),
+}
+
+# 每个工具的超时秒数，超时的调用以错误信息作为 Observation 返回给模型
+TOOL_TIMEOUTS = {
+    "query_product_information": 10,
+    "generate_emoji": 5,
+}
+DEFAULT_TOOL_TIMEOUT = 10
+# 工具排队等待空闲线程的最长秒数（不计入工具自身的超时），线程池被占满时超过该时间的调用直接取消
+TOOL_QUEUE_TIMEOUT = 30
+
+# 产品检索结果的相关度过滤：第二个产品的得分与最佳结果相差超过 15% 时视为无关产品，不返回给模型
+product_reranker = Reranker(relative_margin=0.15, min_keep=1)
+
+# 工具名 -> 检索结果的重排序与过滤（启用交叉编码器时检索更多候选）
+TOOL_RERANKERS = {
+    "query_product_information": product_reranker,
+}
+
+log = get_logger("agent_tool")
+
+# 同一轮内互不依赖的工具调用在线程池中并行执行（所有请求共用，大小由 set_tool_workers 按服务并发数设置）
+_tool_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="agent-tool")
+
+def set_tool_workers(max_workers: int):
+    """
+    按服务的并发请求数设置工具线程池的大小，每个请求一轮最多同时占用几个线程（各集合的检索和各个工具）。
+
+    Args:
+        max_workers (int): 线程数。
+    """
+    global _tool_executor
+    old, _tool_executor = _tool_executor, ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="agent-tool")
+    # 已提交的任务在旧线程池中执行完，之后线程退出
+    old.shutdown(wait=False)
+
+class _TimedTask:
+    """记录任务开始执行的时间：工具的超时从开始执行算起，不包括在线程池中排队的时间。"""
+
+    __slots__ = ("fn", "started", "started_at")
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.started = threading.Event()
+        self.started_at = None
+
+    def __call__(self):
+        self.started_at = time.monotonic()
+        self.started.set()
+        return self.fn()
+
+def mock_query_product_database(product_name: str, search_results: list = None) -> str:
+    """模拟查询产品数据库，返回预设的产品信息。search_results 为已批量检索好的结果（可选）。"""
+    log.debug("[Tool Call] 模拟查询产品数据库：%s", product_name)
+    # 产品名完全一致时按内容键直接取出（集合已加载到进程内，只是一次字典查找），不需要向量检索
+    text = db.get_texts("product_information", [product_name])[0]
+    if text is not None:
+        return [text]
+
+    dic = search_results if search_results is not None else db.search(
+        "product_information", product_name, "IP", product_reranker.candidate_count(2)
+    )
+    dic = product_reranker.rerank(product_name, dic, 2)
 
     content = [line_with_distance[0] for line_with_distance in dic]
 
@@ -50,17 +142,17 @@ def mock_query_product_database(product_name: str) -> str:
     else:
         return f"产品数据库中未找到关于 '{product_name}' 的详细信息。"
 
-def mock_generate_emoji(context: str) -> list:
-    """模拟生成表情符号，根据上下文提供常用表情。"""
-    print(f"[Tool Call] 模拟生成表情符号，上下文：{context}")
-    dic = db.search("emotion2emoji", context)
+def mock_generate_emoji(context: str, search_results: list = None) -> list:
+    """模拟生成表情符号，根据上下文提供常用表情。search_results 为已批量检索好的结果（可选）。"""
+    log.debug("[Tool Call] 模拟生成表情符号，上下文：%s", context)
+    dic = search_results if search_results is not None else db.search("emotion2emoji", context)
 
     content = [line_with_distance[0] for line_with_distance in dic]
 
     if not content=="":
         return content
     else:
-        print("未能从向量数据内找到正确符合的表情")
+        log.warning("未能从向量数据内找到正确符合的表情")
     
 
     if "补水" in context or "水润" in context or "保湿" in context:
@@ -78,4 +170,140 @@ def mock_generate_emoji(context: str) -> list:
 available_tools = {
     "query_product_information": mock_query_product_database,
     "generate_emoji": mock_generate_emoji,
-}
\ No newline at end of file
+}
+
+def _group_search_queries(calls: list) -> dict:
+    """按 (集合名, top_k) 对工具调用的检索查询分组（去重并保持顺序）。"""
+    grouped = {}
+    for function_name, function_args in calls:
+        spec = TOOL_SEARCH_SPECS.get(function_name)
+        if spec is None:
+            continue
+        collection_name, arg_name, top_k = spec
+        if function_name in TOOL_RERANKERS:
+            top_k = TOOL_RERANKERS[function_name].candidate_count(top_k)
+        query = function_args.get(arg_name)
+        if isinstance(query, str):
+            grouped.setdefault((collection_name, top_k), {})[query] = None
+    return {key: list(queries) for key, queries in grouped.items()}
+
+def batch_search_for_tool_calls(calls: list) -> dict:
+    """
+    将一轮内的工具调用按集合分组，每个集合只做一次批量检索。
+
+    Args:
+        calls (list): (function_name, function_args) 元组列表。
+
+    Returns:
+        dict: (集合名, 查询文本) -> 检索结果。
+    """
+    results = {}
+    for (collection_name, top_k), queries in _group_search_queries(calls).items():
+        for query, res in zip(queries, db.search_many(collection_name, queries, top_k)):
+            results[(collection_name, query)] = res
+    return results
+
+def call_tool(function_name: str, function_args: dict, prefetched: dict = None):
+    """执行工具，若该调用的检索结果已批量取回，则直接使用。耗时按工具名记入阶段指标。"""
+    tool_function = available_tools[function_name]
+    spec = TOOL_SEARCH_SPECS.get(function_name)
+    with metrics.span(f"tool_{function_name}"):
+        if prefetched and spec:
+            key = (spec[0], function_args.get(spec[1]))
+            if key in prefetched:
+                return tool_function(**function_args, search_results=prefetched[key])
+        return tool_function(**function_args)
+
+def start_searches(calls: list, searches: dict = None) -> dict:
+    """
+    在后台线程池中提交工具调用所需的批量检索（每个集合一次），不等待结果。
+
+    Args:
+        calls (list): (function_name, function_args) 元组列表。
+        searches (dict): 已提交的检索（可选），其中已有的查询不会重复提交，新提交的检索也会写入其中。
+
+    Returns:
+        dict: (集合名, 查询文本) -> (批量检索的 Future, 该查询在批量结果中的下标)。
+    """
+    searches = {} if searches is None else searches
+
+    def submitted(function_name, function_args):
+        spec = TOOL_SEARCH_SPECS.get(function_name)
+        search = searches.get((spec[0], function_args.get(spec[1]))) if spec else None
+        # 失败或被取消的检索不复用，重新提交
+        if search is None:
+            return False
+        future = search[0]
+        return not (future.cancelled() or (future.done() and future.exception() is not None))
+
+    pending = [call for call in calls if not submitted(*call)]
+    for (collection_name, top_k), queries in _group_search_queries(pending).items():
+        # 在线程池中记录的检索耗时仍归入发起请求的明细
+        future = _tool_executor.submit(metrics.traced(db.search_many, collection_name, queries, top_k))
+        for index, query in enumerate(queries):
+            searches[(collection_name, query)] = (future, index)
+    return searches
+
+def _call_tool_after_search(function_name: str, function_args: dict, search):
+    """等待该调用的检索完成后执行工具。"""
+    prefetched = None
+    spec = TOOL_SEARCH_SPECS.get(function_name)
+    if search is not None:
+        future, index = search
+        prefetched = {(spec[0], function_args.get(spec[1])): future.result()[index]}
+    return call_tool(function_name, function_args, prefetched)
+
+def run_tool_calls(calls: list, timeouts: dict = None, searches: dict = None) -> list:
+    """
+    并行执行一轮内的所有工具调用，结果按调用顺序返回。
+
+    不同集合的批量检索同时进行，每个工具在其检索完成后立即执行，
+    因此一轮的耗时取决于最慢的工具，而不是所有工具耗时之和。
+    每个工具的超时从其开始执行算起，在线程池中排队的时间不计入；排队超过 TOOL_QUEUE_TIMEOUT 的调用被取消。
+
+    Args:
+        calls (list): (function_name, function_args) 元组列表。
+        timeouts (dict): 工具名 -> 超时秒数，默认使用 TOOL_TIMEOUTS。
+        searches (dict): 单次请求内的检索缓存（start_searches 的返回值，可选），
+            预取过的查询直接复用其结果，本轮新提交的检索也会写入其中。
+
+    Returns:
+        list: 与 calls 一一对应的 (是否成功, 工具结果或错误信息) 元组。
+    """
+    timeouts = TOOL_TIMEOUTS if timeouts is None else timeouts
+    queue_deadline = time.monotonic() + TOOL_QUEUE_TIMEOUT
+
+    # 先提交各集合的批量检索，线程池按提交顺序执行，工具任务等待检索时不会占满线程池而死锁
+    searches = start_searches(calls, searches)
+
+    tool_tasks = []
+    for function_name, function_args in calls:
+        if function_name not in available_tools:
+            tool_tasks.append(None)
+            continue
+        spec = TOOL_SEARCH_SPECS.get(function_name)
+        search = searches.get((spec[0], function_args.get(spec[1]))) if spec else None
+        task = _TimedTask(metrics.traced(_call_tool_after_search, function_name, function_args, search))
+        tool_tasks.append((task, _tool_executor.submit(task)))
+
+    outputs = []
+    for (function_name, _), entry in zip(calls, tool_tasks):
+        if entry is None:
+            outputs.append((False, f"错误：未知的工具 '{function_name}'"))
+            continue
+        task, future = entry
+        timeout = timeouts.get(function_name, DEFAULT_TOOL_TIMEOUT)
+        if not task.started.wait(max(0.0, queue_deadline - time.monotonic())) and future.cancel():
+            outputs.append((False, f"错误：工具 '{function_name}' 排队超时（{TOOL_QUEUE_TIMEOUT} 秒），服务繁忙"))
+            continue
+        task.started.wait()
+        remaining = max(0.0, task.started_at + timeout - time.monotonic())
+        try:
+            outputs.append((True, future.result(timeout=remaining)))
+        except FutureTimeoutError:
+            # 线程无法被强行中止，超时的工具在后台执行完后结果被丢弃
+            future.cancel()
+            outputs.append((False, f"错误：工具 '{function_name}' 执行超时（{timeout} 秒）"))
+        except Exception as e:
+            outputs.append((False, f"错误：工具 '{function_name}' 执行失败：{e}"))
+    return outputs
@@ -0,0 +1,233 @@
+import json
+import os
+import re
+from collections import Counter
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    import jieba
+except ImportError:  # 未安装 jieba 时退化为中文二元组切分
+    jieba = None
+
+# 连续的中文字符 / 连续的字母数字
+_TOKEN_PATTERN = re.compile(r"[一-鿿]+|[A-Za-z0-9_]+")
+# 阿拉伯数字写法的条号，例如 "第204条"
+_ARABIC_ARTICLE_PATTERN = re.compile(r"第\s*(\d{1,5})\s*条")
+_DIGITS = "零一二三四五六七八九"
+# 分词方式，记录在保存的索引中：安装或卸载 jieba 后旧索引失效
+TOKENIZER = "jieba" if jieba is not None else "bigram"
+
+
+def _chinese_number(n: int) -> str:
+    """把整数（小于 10 万）转换为法条中使用的中文数字，例如 204 -> 二百零四，10 -> 十"""
+    if n < 10:
+        return _DIGITS[n]
+    result = ""
+    zero = False
+    for value, unit in ((10000, "万"), (1000, "千"), (100, "百"), (10, "十")):
+        digit, n = divmod(n, value)
+        if digit:
+            result += ("零" if zero else "") + _DIGITS[digit] + unit
+            zero = False
+        elif result:
+            zero = True
+    if n:
+        result += ("零" if zero else "") + _DIGITS[n]
+    # 10 ~ 19 写作 "十X" 而不是 "一十X"
+    return result[1:] if result.startswith("一十") else result
+
+
+def normalize_query(text: str) -> str:
+    """统一条号写法：把 "第204条" 改写为法条原文中的 "第二百零四条"，便于词项精确匹配"""
+    return _ARABIC_ARTICLE_PATTERN.sub(lambda m: f"第{_chinese_number(int(m.group(1)))}条", text)
+
+
+def tokenize(text: Any) -> List[str]:
+    """
+    中文分词
+
+    安装了 jieba 时使用 jieba 的搜索引擎模式（长词额外切出短词）；否则中文按单字 + 相邻二元组切分。
+    英文和数字按单词切分并转为小写。非字符串的文本（例如产品信息字典）先序列化为 JSON。
+    """
+    if not isinstance(text, str):
+        text = json.dumps(text, ensure_ascii=False)
+    tokens = []
+    for match in _TOKEN_PATTERN.finditer(text.lower()):
+        word = match.group()
+        if not ("一" <= word[0] <= "鿿"):
+            tokens.append(word)
+        elif jieba is not None:
+            tokens.extend(token for token in jieba.cut_for_search(word) if token.strip())
+        else:
+            tokens.extend(word)
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+class BM25Index:
+    """
+    BM25 倒排索引
+
+    功能：
+    - 入库时对每个文本块分词，建立 词项 -> (文档序号, 词频) 的倒排表，以 CSR 形式存放在 NumPy 数组中
+    - 检索时只遍历查询词项的倒排表，按 BM25 打分并返回得分最高的文档序号
+    - 可保存到向量快照目录中，启动时与快照一起加载，无需重新分词
+
+    文档序号即向量存储中的行号，索引与构建时的向量存储数据一一对应。
+
+    使用示例：
+    >>> index = BM25Index.build(texts)
+    >>> index.search(["第二百零四条 物权"], top_k=10)
+    """
+
+    def __init__(
+        self,
+        vocabulary: Dict[str, int],
+        offsets: np.ndarray,
+        postings: np.ndarray,
+        frequencies: np.ndarray,
+        doc_lengths: np.ndarray,
+        k1: float = 1.5,
+        b: float = 0.75
+    ):
+        """
+        参数:
+        vocabulary: 词项 -> 词项序号
+        offsets: 长度为 词项数 + 1 的偏移量数组，第 t 个词项的倒排表为 postings[offsets[t]:offsets[t + 1]]
+        postings: 文档序号
+        frequencies: 与 postings 对应的词频
+        doc_lengths: 每个文档的词项数
+        k1: 词频饱和参数
+        b: 文档长度归一化参数
+        """
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.postings = postings
+        self.frequencies = frequencies
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        doc_count = len(doc_lengths)
+        avg_length = float(doc_lengths.mean()) if doc_count else 0.0
+        # 每个文档的长度归一化项，检索时直接查表
+        self._norms = self.k1 * (1 - self.b + self.b * doc_lengths / max(avg_length, 1e-9))
+        doc_freqs = np.diff(offsets)
+        self._idf = np.log(1 + (doc_count - doc_freqs + 0.5) / (doc_freqs + 0.5))
+
+    @classmethod
+    def build(cls, texts: Sequence[Any], k1: float = 1.5, b: float = 0.75) -> "BM25Index":
+        """对所有文本分词并建立索引"""
+        vocabulary: Dict[str, int] = {}
+        term_docs: List[List[Tuple[int, int]]] = []
+        doc_lengths = np.zeros(len(texts), dtype=np.int32)
+        for doc, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_lengths[doc] = sum(counts.values())
+            for term, freq in counts.items():
+                term_id = vocabulary.setdefault(term, len(vocabulary))
+                if term_id == len(term_docs):
+                    term_docs.append([])
+                term_docs[term_id].append((doc, freq))
+
+        offsets = np.zeros(len(term_docs) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(docs) for docs in term_docs])
+        postings = np.fromiter((doc for docs in term_docs for doc, _ in docs), dtype=np.int32, count=int(offsets[-1]))
+        frequencies = np.fromiter((freq for docs in term_docs for _, freq in docs), dtype=np.float32, count=int(offsets[-1]))
+        return cls(vocabulary, offsets, postings, frequencies, doc_lengths, k1, b)
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    def scores(self, query: str) -> np.ndarray:
+        """计算查询对每个文档的 BM25 得分"""
+        scores = np.zeros(len(self.doc_lengths), dtype=np.float32)
+        for term in set(tokenize(normalize_query(query))):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs = self.postings[start:end]
+            freqs = self.frequencies[start:end]
+            scores[docs] += self._idf[term_id] * freqs * (self.k1 + 1) / (freqs + self._norms[docs])
+        return scores
+
+    def search(self, queries: List[str], top_k: int) -> List[List[Tuple[int, float]]]:
+        """
+        检索得分最高的文档
+
+        参数:
+        queries: 查询文本列表
+        top_k: 每个查询返回的结果数量
+
+        返回:
+        与查询顺序一致的结果列表，每项为 (文档序号, BM25 得分) 元组列表，不含得分为 0 的文档
+        """
+        results = []
+        for query in queries:
+            scores = self.scores(query)
+            k = min(top_k, int(np.count_nonzero(scores)))
+            if k <= 0:
+                results.append([])
+                continue
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = best[np.argsort(-scores[best], kind="stable")]
+            results.append([(int(i), float(scores[i])) for i in best])
+        return results
+
+    def save(self, path: str, revision: Optional[str] = None):
+        """保存到 path 目录（bm25.npz），revision 为对应的快照版本"""
+        tmp_path = os.path.join(path, "bm25.tmp.npz")
+        np.savez(
+            tmp_path,
+            vocabulary=np.array(json.dumps(self.vocabulary, ensure_ascii=False)),
+            offsets=self.offsets,
+            postings=self.postings,
+            frequencies=self.frequencies,
+            doc_lengths=self.doc_lengths,
+            params=np.array([self.k1, self.b]),
+            revision=np.array(revision or ""),
+            tokenizer=np.array(TOKENIZER),
+        )
+        os.replace(tmp_path, os.path.join(path, "bm25.npz"))
+
+    @classmethod
+    def load(cls, path: str, revision: Optional[str] = None) -> Optional["BM25Index"]:
+        """从 path 目录加载索引；文件不存在、损坏、与快照版本或分词方式不一致时返回 None"""
+        file_path = os.path.join(path, "bm25.npz")
+        if not os.path.exists(file_path):
+            return None
+        try:
+            with np.load(file_path) as data:
+                if revision is not None and str(data["revision"]) != revision:
+                    return None
+                if str(data["tokenizer"]) != TOKENIZER:
+                    return None
+                k1, b = data["params"]
+                return cls(
+                    json.loads(str(data["vocabulary"])),
+                    data["offsets"], data["postings"], data["frequencies"], data["doc_lengths"],
+                    float(k1), float(b),
+                )
+        except (OSError, ValueError, KeyError) as e:
+            print(f"读取 BM25 索引失败，将重新构建: {e}")
+            return None
+
+
+def reciprocal_rank_fusion(rankings: List[List[Any]], k: int = 60) -> List[Tuple[Any, float]]:
+    """
+    倒数排名融合（RRF）：每个结果的得分为其在各个排名列表中 1 / (k + 名次) 之和
+
+    参数:
+    rankings: 多个排名列表，列表元素为结果的标识（需可哈希），按相关度从高到低排列
+    k: 平滑常数，越大时排名靠后的结果权重衰减越慢
+
+    返回:
+    按融合得分从高到低排列的 (标识, 得分) 列表
+    """
+    scores: Dict[Any, float] = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
@@ -4,24 +4,42 @@ import os
 import random
 import json
 import re
+import time
 
-from openai import OpenAI
+from llm_transport import LLMTransport
+import metrics
+from async_logger import ConversationLog, get_logger
 from utils import embedding_model
 from vector_db import db
 import agent_tool
+from session_store import SessionStore
+from lru_cache import LRUCache
+from async_runtime import AsyncRuntime, ServerBusyError
 
 
 # 从环境变量获取 DeepSeek API Key
 api_key = os.getenv("DEEPSEEK_API_KEY")
+# 指向本地模拟服务（DEEPSEEK_BASE_URL）时不需要真实的 API Key
+base_url = os.getenv("DEEPSEEK_BASE_URL")
 if not api_key:
-    raise ValueError("请设置 DEEPSEEK_API_KEY 环境变量")
+    if not base_url:
+        raise ValueError("请设置 DEEPSEEK_API_KEY 环境变量")
+    api_key = "mock"
 
-# 初始化 OpenAI 客户端（假设 DeepSeek 的 API 兼容 OpenAI 格式）
-client = OpenAI(
+# 所有大模型调用共用的传输层（假设 DeepSeek 的 API 兼容 OpenAI 格式）：
+# 同步 / 异步客户端各自使用 keep-alive 连接池，调用超时、限流和服务端错误自动重试
+# DEEPSEEK_BASE_URL 可指向本地模拟服务；DEEPSEEK_HEDGE=1 时启用对冲请求
+transport = LLMTransport(
     api_key=api_key,
-    base_url="https://api.deepseek.com/v1",  # DeepSeek API 的基地址
+    base_url=base_url or "https://api.deepseek.com/v1",  # DeepSeek API 的基地址
+    max_connections=64,
+    timeout=60,
+    max_retries=3,
+    hedge=os.getenv("DEEPSEEK_HEDGE") == "1",
 )
 
+log = get_logger("agent")
+
 SYSTEM_PROMPT = """
 你是一个资深的小红书爆款文案专家，擅长结合最新潮流和产品卖点，创作引人入胜、高互动、高转化的笔记文案。
 
@@ -42,7 +60,6 @@ SYSTEM_PROMPT = """
 
 
 class ConversationEngine:
-    messages : list = [{"role": "system", "content": SYSTEM_PROMPT}]
     """
     多轮对话引擎类
     
@@ -54,26 +71,59 @@ class ConversationEngine:
     
     使用方法：
     1. 初始化引擎: engine = ConversationEngine()
-    2. 处理用户消息: response = engine.chat(user_message)
+    2. 处理用户消息: response = engine.generate_rednote_by_single_chat(user_message, session_id=session_id)
     3. 获取对话历史: history = engine.get_history()
     4. 保存对话日志: engine.save_logs()
     """
     
-    def __init__(self, log_file):
+    def __init__(self, log_file, session_db_path: str = None, runtime: AsyncRuntime = None, pipeline: bool = True,
+                 prefetch: bool = True):
         """
         初始化对话引擎
         
         参数:
-        log_file: 对话日志保存
+        log_file: 对话日志保存路径（每次生成的需求和文案追加一行 JSON，按大小轮转）
+        session_db_path: 会话持久化的 SQLite 路径（可选，默认仅保存在内存中）
+        runtime: 异步运行时（可选，None 表示使用同步客户端）
+        pipeline: 流水线模式，需求提取合并到第一轮工具调用中，省去一次单独的模型请求
+        prefetch: 需求确定后立即在后台预取产品信息和表情的检索结果
         """
+        self.runtime = runtime
+        self.pipeline = pipeline
+        self.prefetch = prefetch
+        # 用户需求 -> 提取结果，重复的需求无需再次提取
+        self.extraction_cache = LRUCache(maxsize=1024, ttl=24 * 3600)
         self.log_file = log_file
+        self.conversation_log = ConversationLog(log_file)
         self.conversation_history = []
+        # 每个会话独立记录用户需求和生成的文案，不同用户之间互不干扰
+        self.sessions = SessionStore(SYSTEM_PROMPT, db_path=session_db_path)
+
+    def _create_completion(self, stage: str = "llm", **kwargs):
+        """
+        调用 DeepSeek：配置了异步运行时时在其事件循环中并发执行，否则使用同步客户端
+
+        stage 为指标中的阶段名，调用耗时、结果和 token 用量按阶段记录
+        """
+        if kwargs.get("stream"):
+            # 最后一个数据块附带本次调用的 token 用量
+            kwargs.setdefault("stream_options", {"include_usage": True})
+            return metrics.observe_stream(stage, lambda: self._request_completion(**kwargs))
+        return metrics.observe_completion(stage, lambda: self._request_completion(**kwargs))
+
+    def _request_completion(self, **kwargs):
+        if self.runtime is None:
+            return transport.create(**kwargs)
+        if kwargs.get("stream"):
+            return self.runtime.iterate(lambda: transport.acreate(**kwargs))
+        return self.runtime.run(lambda: transport.acreate(**kwargs))
 
     def chat_with_deepseek(self, message: list):
         try:
-            #print(f"lpppppppp: {self.messages}")
+            #print(f"lpppppppp: {message}")
             # 调用 DeepSeek Chat API
-            response = client.chat.completions.create(
+            response = self._create_completion(
+                stage="llm_extract",
                 model="deepseek-chat",  # 或 DeepSeek 提供的其他模型名称
                 messages=message,
                 temperature=0.7,
@@ -83,48 +133,54 @@ class ConversationEngine:
             # 提取生成的 HTML 内容
             if response.choices and len(response.choices) > 0:
                 response_message = response.choices[0].message
-                self.messages.append(response.choices[0].message)
                 return response_message
                 # 保存到文件
             else:
-                print("未收到有效响应")
-                self.messages.pop()
+                log.warning("未收到有效响应")
                 return
+        except ServerBusyError:
+            # 排队已满，交给接口层返回 503
+            raise
         except Exception as e:
-            print(f"调用 API 出错: {e}")
-            self.messages.pop()
+            log.error("调用 API 出错: %s", e)
             return
         
-    def chat_with_deepseek_use_tool(self, message: list):
+    def chat_with_deepseek_use_tool(self, message: list, tools: list = None):
         try:
-            #print(f"lpppppppp: {self.messages}")
+            #print(f"lpppppppp: {message}")
             # 调用 DeepSeek Chat API
-            response = client.chat.completions.create(
+            response = self._create_completion(
+                stage="llm_agent",
                 model="deepseek-chat",  # 或 DeepSeek 提供的其他模型名称
                 messages=message,
                 temperature=0.7,
                 stream=False,
-                tools=agent_tool.TOOLS_DEFINITION, # 告知模型可用的工具
+                tools=tools or agent_tool.TOOLS_DEFINITION, # 告知模型可用的工具
                 tool_choice="auto" # 允许模型自动决定是否使用工具
             )
 
             # 提取生成的 HTML 内容
             if response.choices and len(response.choices) > 0:
                 response_message = response.choices[0].message
-                self.messages.append(response.choices[0].message)
                 return response_message
                 # 保存到文件
             else:
-                print("未收到有效响应")
-                self.messages.pop()
+                log.warning("未收到有效响应")
                 return
+        except ServerBusyError:
+            # 排队已满，交给接口层返回 503
+            raise
         except Exception as e:
-            print(f"调用 API 出错: {e}")
-            self.messages.pop()
+            log.error("调用 API 出错: %s", e)
             return
         
     def extract_requirements(self, user_query: str) -> dict:
-            """从用户提问中提取需求信息，包含产品名以及需要的风格"""
+            """从用户提问中提取需求信息，包含产品名以及需要的风格（结果按提问缓存）"""
+
+            cache_key = user_query.strip()
+            cached = self.extraction_cache.get(cache_key)
+            if cached is not None:
+                return dict(cached)
 
             extraction_prompt = """
                 你是一个专业的营销需求分析助手。请从以下用户提问中提取关键信息，包含以下方面：
@@ -153,86 +209,218 @@ class ConversationEngine:
 
             try:
                 response = self.chat_with_deepseek(messages)
-                print(f"deepseek 根据 {user_query} 提取了 {response.content}")
+                log.info("deepseek 根据 %s 提取了 %s", user_query, response.content)
                 # 解析DeepSeek的返回结果
                 extracted_data = json.loads(response.content)
+                self._cache_requirements(user_query, extracted_data)
                 return extracted_data
                 
+            except ServerBusyError:
+                raise
             except Exception as e:
                 # 直接返回默认空值
                 return {"product_name": "", "style": ""}
             
+    def _cache_requirements(self, user_query: str, requirements: dict):
+        """缓存提取结果，未识别到产品名的结果不缓存"""
+        if isinstance(requirements, dict) and requirements.get("product_name"):
+            self.extraction_cache.put(user_query.strip(), {
+                "product_name": requirements.get("product_name", ""),
+                "style": requirements.get("style", ""),
+            })
+
+    def _requirements_progress(self, query: str, dic: dict) -> dict:
+        log.info("🚀 启动小红书文案生成助手，用户需求为：%s，成功提取到产品名为：%s，需要的风格为: %s", query, dic.get('product_name'), dic.get('style'))
+        return {"type": "progress", "content": f"已提取需求：产品「{dic.get('product_name')}」，风格「{dic.get('style')}」"}
+
+    def _prefetch_calls(self, dic: dict) -> list:
+        """模型几乎总会发起的工具调用：按产品名查询产品信息、按风格生成表情"""
+        calls = []
+        if dic.get("product_name"):
+            calls.append(("query_product_information", {"product_name": dic["product_name"]}))
+        if dic.get("style"):
+            calls.append(("generate_emoji", {"context": dic["style"]}))
+        return calls
+
+    def _prefetched_observations(self, dic: dict, searches: dict) -> list:
+        """
+        执行预取的工具调用，并构造成已完成的工具调用和 Observation，预置到对话历史中，
+        模型在第一轮即可直接使用这些信息，通常可以少一轮工具调用。
+
+        预取需要已知的产品名和风格，因此只在需求已提取时生效：非流水线模式下总是如此，
+        流水线模式下只有 extraction_cache 命中时才会预取。流水线模式未命中缓存时，需求与第一轮工具调用
+        由同一次模型请求给出，此时没有可提前预置的信息；也不按原始需求文本做推测性检索，
+        因为检索结果按模型给出的工具参数（产品名、风格）复用，原始文本的检索结果无法命中。
+        """
+        calls = self._prefetch_calls(dic)
+        if not calls:
+            return []
+        results = agent_tool.run_tool_calls(calls, searches=searches)
+        tool_calls = []
+        observations = []
+        for i, ((function_name, function_args), (ok, tool_result)) in enumerate(zip(calls, results)):
+            if not ok:
+                # 预取失败的调用不预置，由模型按需重新调用
+                continue
+            tool_call_id = f"prefetch_{i}"
+            tool_calls.append({
+                "id": tool_call_id,
+                "type": "function",
+                "function": {"name": function_name, "arguments": json.dumps(function_args, ensure_ascii=False)},
+            })
+            observations.append({"tool_call_id": tool_call_id, "role": "tool", "content": str(tool_result)})
+        if not tool_calls:
+            return []
+        return [{"role": "assistant", "content": None, "tool_calls": tool_calls}] + observations
+
     #product_name: str, tone_style: str = "活泼甜美", max_iterations: int = 5
-    def generate_rednote_by_single_chat(self, query, max_iterations: int = 5) -> str:
+    def generate_rednote_by_single_chat(self, query, max_iterations: int = 5, session_id: str = "default") -> str:
         """
         使用 DeepSeek Agent 生成小红书爆款文案。
         
         Args:
-            product_name (str): 要生成文案的产品名称。
-            tone_style (str): 文案的语气和风格，如"活泼甜美"、"知性"、"搞怪"等。
+            query (str): 用户的原始需求，从中提取产品名称和文案风格。
             max_iterations (int): Agent 最大迭代次数，防止无限循环。
+            session_id (str): 会话 id。
             
         Returns:
-            str: 生成的爆款文案（JSON 格式字符串）。
+            str: 生成的爆款文案（Markdown 格式）。
         """
+        result = "未能成功生成文案。"
+        for event in self.generate_rednote_events(query, max_iterations, session_id):
+            if event["type"] == "done":
+                result = event["content"]
+        return result
+
+    def generate_rednote_events(self, query, max_iterations: int = 5, session_id: str = "default"):
+        """
+        以事件流的形式运行小红书文案生成 Agent，便于前端实时展示中间进度。
         
-        
-        
-        dic = self.extract_requirements(query)
-        print(f"\n🚀 启动小红书文案生成助手，用户需求为：{query}\n, 成功提取到产品名为：{dic["product_name"]}, 需要的风格为: {dic["style"]}")
+        Args:
+            query (str): 用户的原始需求。
+            max_iterations (int): Agent 最大迭代次数，防止无限循环。
+            session_id (str): 会话 id，生成的文案记录到该会话的历史中。
+            
+        Yields:
+            dict: type 为 "progress"（需求提取、迭代、工具调用与结果）或 "done"（最终文案）的事件。
+        """
+        with self.sessions.session(session_id) as session:
+            for event in self._run_agent(query, max_iterations):
+                if event["type"] == "done":
+                    session.messages.append({"role": "user", "content": query})
+                    session.messages.append({"role": "assistant", "content": event["content"]})
+                    self.conversation_log.record(session_id=session_id, question=query, answer=event["content"])
+                yield event
+
+    def _run_agent(self, query, max_iterations: int):
+        """运行 Agent 主循环，产出进度事件和最终文案事件（格式见 generate_rednote_events）。"""
+        output_format = "包含标题、正文、至少5个相关标签和5个表情符号。请以完整的JSON格式输出，并确保JSON内容用markdown代码块包裹（例如：```json{...}```）。"
+        # 命中缓存时无需提取；流水线模式下未命中缓存时，由模型在第一轮工具调用中给出需求
+        if self.pipeline:
+            dic = self.extraction_cache.get(query.strip())
+        else:
+            with metrics.span("extract_requirements"):
+                dic = self.extract_requirements(query)
+
+        if dic is not None:
+            yield self._requirements_progress(query, dic)
+            user_prompt = f"请为产品「{dic['product_name']}」生成一篇小红书爆款文案。要求：语气{dic['style']}，{output_format}"
+            first_turn_tools = None
+        else:
+            user_prompt = f"用户需求：{query}\n请先调用 record_requirements 记录从需求中识别出的产品名和文案风格（可以与其他工具同时调用），然后为该产品生成一篇小红书爆款文案。要求：语气符合识别出的风格，{output_format}"
+            first_turn_tools = agent_tool.TOOLS_DEFINITION + [agent_tool.RECORD_REQUIREMENTS_TOOL]
 
         # 存储对话历史，包括系统提示词和用户请求
         messages = [
             {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": f"请为产品「{dic["product_name"]}」生成一篇小红书爆款文案。要求：语气{dic["style"]}，包含标题、正文、至少5个相关标签和5个表情符号。请以完整的JSON格式输出，并确保JSON内容用markdown代码块包裹（例如：```json{{...}}```）。"}
+            {"role": "user", "content": user_prompt}
         ]
+
+        # 单次请求内的检索缓存：预取的结果在模型发起相同的工具调用时直接复用
+        searches = {}
+        if dic is not None and self.prefetch:
+            with metrics.span("prefetch"):
+                seeded = self._prefetched_observations(dic, searches)
+            if seeded:
+                messages.extend(seeded)
+                yield {"type": "progress", "content": "已预取产品信息和表情"}
         
         iteration_count = 0
         final_response = None
         
         while iteration_count < max_iterations:
             iteration_count += 1
-            print(f"-- Iteration {iteration_count} --")
+            log.info("-- Iteration %d --", iteration_count)
+            yield {"type": "progress", "content": f"第 {iteration_count} 轮思考中..."}
             
+            iteration_start = time.perf_counter()
             try:
-                response_message = self.chat_with_deepseek_use_tool(messages)
+                # 需求已记录后不再提供 record_requirements 工具
+                tools = first_turn_tools if dic is None else None
+                response_message = self.chat_with_deepseek_use_tool(messages, tools)
                 
                 # **ReAct模式：处理工具调用**
                 if response_message.tool_calls: # 如果模型决定调用工具
-                    print("Agent: 决定调用工具...")
+                    log.info("Agent: 决定调用工具...")
                     messages.append(response_message) # 将工具调用信息添加到对话历史
                     
+                    # 确保参数是合法的JSON字符串，即使工具不要求参数，也需要传递空字典
+                    parsed_calls = [
+                        (tool_call.function.name, json.loads(tool_call.function.arguments) if tool_call.function.arguments else {})
+                        for tool_call in response_message.tool_calls
+                    ]
+                    # 流水线模式：记录模型给出的结构化需求，其余工具照常执行
+                    for function_name, function_args in parsed_calls:
+                        if function_name == "record_requirements" and dic is None:
+                            dic = {"product_name": function_args.get("product_name", ""), "style": function_args.get("style", "")}
+                            self._cache_requirements(query, dic)
+                            yield self._requirements_progress(query, dic)
+                            if self.prefetch:
+                                # 模型本轮未发起的检索在后台预取，后续轮次调用时直接命中
+                                agent_tool.start_searches(self._prefetch_calls(dic), searches)
+                    tool_calls = [
+                        (tool_call, call) for tool_call, call in zip(response_message.tool_calls, parsed_calls)
+                        if call[0] != "record_requirements"
+                    ]
+
+                    for _, (function_name, function_args) in tool_calls:
+                        log.info("Agent Action: 调用工具 '%s'，参数：%s", function_name, function_args)
+                        yield {"type": "progress", "content": f"调用工具 {function_name}：{function_args}"}
+
+                    # 同一集合的检索合并为一次批量检索，互不依赖的工具并行执行，结果按调用顺序返回
+                    with metrics.span("tool_calls"):
+                        results = dict(zip(
+                            (tool_call.id for tool_call, _ in tool_calls),
+                            agent_tool.run_tool_calls([call for _, call in tool_calls], searches=searches),
+                        ))
+
                     tool_outputs = []
-                    for tool_call in response_message.tool_calls:
-                        function_name = tool_call.function.name
-                        # 确保参数是合法的JSON字符串，即使工具不要求参数，也需要传递空字典
-                        function_args = json.loads(tool_call.function.arguments) if tool_call.function.arguments else {}
-
-                        print(f"Agent Action: 调用工具 '{function_name}'，参数：{function_args}")
-                        
-                        # 查找并执行对应的模拟工具函数
-                        if function_name in agent_tool.available_tools:
-                            tool_function = agent_tool.available_tools[function_name]
-                            tool_result = tool_function(**function_args)
-                            print(f"Observation: 工具返回结果：{tool_result}")
+                    for tool_call, (function_name, _) in zip(response_message.tool_calls, parsed_calls):
+                        if function_name == "record_requirements":
                             tool_outputs.append({
                                 "tool_call_id": tool_call.id,
                                 "role": "tool",
-                                "content": str(tool_result) # 工具结果作为字符串返回
+                                "content": "需求已记录"
                             })
+                            continue
+                        ok, tool_result = results[tool_call.id]
+                        if ok:
+                            # 工具结果可能很长，只在调试级别记录，格式化在后台线程完成
+                            log.debug("Observation: 工具返回结果：%s", tool_result)
+                            yield {"type": "progress", "content": f"工具 {function_name} 已返回结果"}
                         else:
-                            error_message = f"错误：未知的工具 '{function_name}'"
-                            print(error_message)
-                            tool_outputs.append({
-                                "tool_call_id": tool_call.id,
-                                "role": "tool",
-                                "content": error_message
-                            })
+                            log.warning("%s", tool_result)
+                            yield {"type": "progress", "content": tool_result}
+                        tool_outputs.append({
+                            "tool_call_id": tool_call.id,
+                            "role": "tool",
+                            "content": str(tool_result) # 工具结果作为字符串返回
+                        })
                     messages.extend(tool_outputs) # 将工具执行结果作为 Observation 添加到对话历史
                     
                 # **ReAct 模式：处理最终内容**
                 elif response_message.content: # 如果模型直接返回内容（通常是最终答案）
-                    print(f"[模型生成结果] {response_message.content}")
+                    log.debug("[模型生成结果] %s", response_message.content)
                     
                     # --- START: 添加 JSON 提取和解析逻辑 ---
                     json_string_match = re.search(r"```json\s*(\{.*\})\s*```", response_message.content, re.DOTALL)
@@ -241,32 +429,39 @@ class ConversationEngine:
                         extracted_json_content = json_string_match.group(1)
                         try:
                             final_response = json.loads(extracted_json_content)
-                            print("Agent: 任务完成，成功解析最终JSON文案。")
-                            return self.format_rednote_for_markdown(json.dumps(final_response, ensure_ascii=False, indent=2))
+                            log.info("Agent: 任务完成，成功解析最终JSON文案。")
+                            yield {"type": "done", "content": self.format_rednote_for_markdown(json.dumps(final_response, ensure_ascii=False, indent=2))}
+                            return
                         except json.JSONDecodeError as e:
-                            print(f"Agent: 提取到JSON块但解析失败: {e}")
-                            print(f"尝试解析的字符串:\n{extracted_json_content}")
+                            log.warning("Agent: 提取到JSON块但解析失败: %s", e)
+                            log.debug("尝试解析的字符串:\n%s", extracted_json_content)
                             messages.append(response_message) # 解析失败，继续对话
                     else:
                         # 如果没有匹配到 ```json 块，尝试直接解析整个 content
                         try:
                             final_response = json.loads(response_message.content)
-                            print("Agent: 任务完成，直接解析最终JSON文案。")
-                            return self.format_rednote_for_markdown(json.dumps(final_response, ensure_ascii=False, indent=2))
+                            log.info("Agent: 任务完成，直接解析最终JSON文案。")
+                            yield {"type": "done", "content": self.format_rednote_for_markdown(json.dumps(final_response, ensure_ascii=False, indent=2))}
+                            return
                         except json.JSONDecodeError:
-                            print("Agent: 生成了非JSON格式内容或非Markdown JSON块，可能还在思考或出错。")
+                            log.warning("Agent: 生成了非JSON格式内容或非Markdown JSON块，可能还在思考或出错。")
                             messages.append(response_message) # 非JSON格式，继续对话
                     # --- END: 添加 JSON 提取和解析逻辑 ---
                 else:
-                    print("Agent: 未知响应，可能需要更多交互。")
+                    log.warning("Agent: 未知响应，可能需要更多交互。")
                     break
                     
+            except ServerBusyError:
+                raise
             except Exception as e:
-                print(f"调用 DeepSeek API 时发生错误: {e}")
+                log.error("调用 DeepSeek API 时发生错误: %s", e)
                 break
+            finally:
+                # 每轮的耗时（含模型调用和工具执行）单独记录，慢请求明细中可看出是哪一轮变慢
+                metrics.observe("agent_iteration", time.perf_counter() - iteration_start, f"agent_iteration_{iteration_count}")
         
-        print("\n⚠️ Agent 达到最大迭代次数或未能生成最终文案。请检查Prompt或增加迭代次数。")
-        return "未能成功生成文案。"
+        log.warning("⚠️ Agent 达到最大迭代次数或未能生成最终文案。请检查Prompt或增加迭代次数。")
+        yield {"type": "done", "content": "未能成功生成文案。"}
     
     def format_rednote_for_markdown(self, json_string: str) -> str:
         """
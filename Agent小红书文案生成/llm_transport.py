@@ -0,0 +1,254 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+import httpx
+import openai
+from openai import OpenAI, AsyncOpenAI
+
+from async_logger import get_logger
+
+# 可重试的 HTTP 状态码：请求超时、冲突、限流以及服务端错误
+RETRY_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+
+log = get_logger("llm_transport")
+
+
+class LLMTransport:
+    """
+    大模型调用的共享传输层
+
+    功能：
+    - 同步、异步客户端各自使用一个固定大小的 keep-alive 连接池，所有请求复用连接，避免频繁建连
+    - 每次调用都有超时（连接超时 + 整体超时），可按调用单独指定
+    - 429 / 5xx / 连接错误 / 超时按指数退避加随机抖动重试，服务端返回 Retry-After 时按其等待
+    - 可选的对冲请求：非流式调用超过近期 p95 延迟仍未返回时，再发出一个相同的请求，取先返回的结果
+      （只在异步调用中生效，会增加少量重复请求的费用）
+    - 记录调用、重试、对冲次数以及延迟分位数
+
+    流式调用只在建立连接阶段（收到第一个数据块之前）重试，不做对冲。
+
+    使用示例：
+    >>> transport = LLMTransport(api_key, "https://api.deepseek.com/v1", max_connections=64)
+    >>> response = transport.create(model="deepseek-chat", messages=messages, timeout=30)
+    >>> response = runtime.run(lambda: transport.acreate(model="deepseek-chat", messages=messages))
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str,
+        max_connections: int = 64,
+        max_keepalive_connections: int = 32,
+        keepalive_expiry: float = 30.0,
+        connect_timeout: float = 5.0,
+        timeout: float = 60.0,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+        hedge: bool = False,
+        hedge_min_samples: int = 20,
+        hedge_min_delay: float = 1.0
+    ):
+        """
+        初始化传输层
+
+        参数:
+        api_key: API Key
+        base_url: OpenAI 兼容接口的基地址（可指向本地模拟服务）
+        max_connections: 连接池的最大连接数
+        max_keepalive_connections: 空闲时保留的 keep-alive 连接数
+        keepalive_expiry: 空闲连接保留的秒数
+        connect_timeout: 建立连接的超时秒数
+        timeout: 每次调用的默认超时秒数（读取响应的总时长上限）
+        max_retries: 最大重试次数
+        backoff_base: 第一次重试的退避上限秒数，之后每次翻倍
+        backoff_max: 单次退避的最长秒数
+        hedge: 是否启用对冲请求
+        hedge_min_samples: 至少积累多少次调用的延迟后才开始对冲（p95 需要足够的样本）
+        hedge_min_delay: 对冲前的最短等待秒数，避免 p95 很小时对冲过于频繁
+        """
+        self.base_url = base_url
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        default_timeout = self._timeout(timeout)
+        # 重试由传输层统一处理，关闭 SDK 自带的重试
+        self.client = OpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            max_retries=0,
+            timeout=default_timeout,
+            http_client=httpx.Client(limits=limits, timeout=default_timeout),
+        )
+        self.async_client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            max_retries=0,
+            timeout=default_timeout,
+            http_client=httpx.AsyncClient(limits=limits, timeout=default_timeout),
+        )
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=256)
+        self._counters = {"calls": 0, "retries": 0, "failures": 0, "hedges": 0, "hedge_wins": 0}
+
+    def _timeout(self, seconds: Optional[float]) -> httpx.Timeout:
+        return httpx.Timeout(seconds or self.timeout, connect=self.connect_timeout)
+
+    def _count(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def _record_latency(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def _percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._latencies)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def _retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        """判断错误是否可重试，可重试时返回等待秒数，否则返回 None"""
+        if attempt >= self.max_retries:
+            return None
+        if isinstance(error, openai.APIStatusError):
+            if error.status_code not in RETRY_STATUS_CODES:
+                return None
+            retry_after = error.response.headers.get("retry-after")
+            if retry_after:
+                try:
+                    return min(float(retry_after), self.backoff_max)
+                except ValueError:
+                    pass
+        elif not isinstance(error, (openai.APIConnectionError, httpx.TransportError)):
+            # APITimeoutError 是 APIConnectionError 的子类；其余错误（参数错误、鉴权失败等）重试无意义
+            return None
+        # 指数退避 + 全抖动：在 [0, min(上限, base * 2^attempt)] 中随机取值，避免大量请求同时重试
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def create(self, timeout: Optional[float] = None, **kwargs) -> Any:
+        """
+        同步调用 chat.completions.create，失败时按策略重试
+
+        参数:
+        timeout: 本次调用的超时秒数（默认使用初始化时的 timeout）
+        kwargs: 传给 chat.completions.create 的参数
+
+        返回:
+        补全结果（stream=True 时为流）
+        """
+        self._count("calls")
+        for attempt in range(self.max_retries + 1):
+            start = time.monotonic()
+            try:
+                response = self.client.chat.completions.create(timeout=self._timeout(timeout), **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    self._count("failures")
+                    raise
+                self._count("retries")
+                log.warning("大模型调用失败，%.2f 秒后第 %d 次重试: %s", delay, attempt + 1, e)
+                time.sleep(delay)
+                continue
+            if not kwargs.get("stream"):
+                self._record_latency(time.monotonic() - start)
+            return response
+
+    async def _acreate_with_retry(self, timeout: Optional[float], kwargs: Dict[str, Any]) -> Any:
+        for attempt in range(self.max_retries + 1):
+            start = time.monotonic()
+            try:
+                response = await self.async_client.chat.completions.create(timeout=self._timeout(timeout), **kwargs)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                self._count("retries")
+                log.warning("大模型调用失败，%.2f 秒后第 %d 次重试: %s", delay, attempt + 1, e)
+                await asyncio.sleep(delay)
+                continue
+            if not kwargs.get("stream"):
+                self._record_latency(time.monotonic() - start)
+            return response
+
+    async def acreate(self, timeout: Optional[float] = None, **kwargs) -> Any:
+        """
+        异步调用 chat.completions.create，失败时按策略重试；启用对冲时，非流式调用超过 p95 延迟后发出对冲请求
+
+        参数与返回值同 create
+        """
+        self._count("calls")
+        try:
+            hedge_delay = self._hedge_delay() if self.hedge and not kwargs.get("stream") else None
+            if hedge_delay is None:
+                return await self._acreate_with_retry(timeout, kwargs)
+            return await self._hedged(hedge_delay, timeout, kwargs)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self._count("failures")
+            raise
+
+    def _hedge_delay(self) -> Optional[float]:
+        """对冲前的等待时间：近期 p95 延迟，样本不足时不对冲"""
+        with self._lock:
+            enough = len(self._latencies) >= self.hedge_min_samples
+        if not enough:
+            return None
+        return max(self.hedge_min_delay, self._percentile(0.95))
+
+    async def _hedged(self, hedge_delay: float, timeout: Optional[float], kwargs: Dict[str, Any]) -> Any:
+        primary = asyncio.ensure_future(self._acreate_with_retry(timeout, kwargs))
+        done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+        if done:
+            return primary.result()
+
+        self._count("hedges")
+        backup = asyncio.ensure_future(self._acreate_with_retry(timeout, kwargs))
+        pending = {primary, backup}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is backup:
+                            self._count("hedge_wins")
+                        return task.result()
+                    error = task.exception()
+            # 两个请求都失败
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        """返回调用统计信息（延迟单位为秒，只统计非流式调用）"""
+        with self._lock:
+            stats = dict(self._counters)
+            samples = len(self._latencies)
+        stats["latency_samples"] = samples
+        stats["latency_p50"] = self._percentile(0.50)
+        stats["latency_p95"] = self._percentile(0.95)
+        return stats
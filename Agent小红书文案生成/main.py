@@ -1,19 +1,33 @@
 
-from flask import Flask, request, jsonify
-from conversation import ConversationEngine
+import argparse
+import json
+import uuid
+
+from flask import Flask, request, jsonify, Response, stream_with_context
+from conversation import ConversationEngine, transport
+from async_runtime import AsyncRuntime, ServerBusyError
+import metrics
+import async_logger
 from glob import glob
 from vector_db import LocalMilvusDB
 from tqdm import tqdm
 from utils import embedding_model, emoji_mapping
-from vector_db import db
+from vector_db import db, source_fingerprint
+from embedding_cache import doc_embedding_cache
+from parallel_encoder import ParallelEncoder
+from agent_tool import product_reranker, set_tool_workers
 
 import product_chunker  
 
 app = Flask(__name__)
-engine = ConversationEngine("conversation.log")
-
-def chunk_product_information(): 
-    chunker = product_chunker.ProductChunker("./doc/product_information.json", "./doc/chunked_product_information.json")
+log = async_logger.get_logger("main")
+# 所有请求的大模型调用共用一个后台事件循环，最多 32 个并发调用，超过 128 个排队时返回 503
+runtime = AsyncRuntime(max_concurrency=32, max_queue=128)
+metrics.register_components(runtime, transport, async_logger.writer)
+# 对话日志追加写入 JSON 行文件（按大小轮转），由后台线程写入
+engine = ConversationEngine("conversation.jsonl", runtime=runtime)
+
+def chunk_product_information(chunker): 
      # 执行chunking
     chunks = chunker.chunk_by_product()
     
@@ -33,8 +47,22 @@ def chunk_product_information():
 
 
 def init_product_vector_db():
+    init_product_collection()
+    init_emoji_collection()
+    print("初始化数据库成功")
+
+
+def init_product_collection():
+    collection_name = "product_information"
+    # 分块逻辑变化同样需要重建，因此把分块代码也计入源数据指纹
+    source = source_fingerprint(["./doc/product_information.json", product_chunker.__file__])
+    # 源文件未变化时直接以内存映射方式加载向量快照，跳过分块、编码和同步
+    if db.load_snapshot(collection_name, source):
+        return
+
     print("即将从json文件内处理文本分块嵌入")
-    chunks = chunk_product_information()
+    chunker = product_chunker.ProductChunker("./doc/product_information.json", "./doc/chunked_product_information.json")
+    chunks = chunk_product_information(chunker)
 
     text_chunks = [chunk["product_name"] for chunk in chunks]
     content_chunks = [chunk["content"] for chunk in chunks]
@@ -42,49 +70,68 @@ def init_product_vector_db():
     #print(contents)
     #print("\n")
     data = []
-    collection_name = "product_information"
 
-    doc_embeddings = embedding_model.encode_documents(text_chunks)
+    # 未变化的文本直接从磁盘缓存读取向量，只对新增或修改的文本进行编码
+    doc_embeddings = doc_embedding_cache.encode_documents(text_chunks)
     embedding_dim = len(doc_embeddings[0])
     print(f"第一个元素的维度是 {embedding_dim}\n")
     print(f"向量编码模型的默认维度是 {embedding_model.dim}\n")
 
     for i, line in enumerate(tqdm(text_chunks, desc="Creating embeddings")):
-        data.append({"id": i, "vector": doc_embeddings[i], "text": content_chunks[i]})
+        # 产品名、分类、话题作为标量字段写入，支持精确查询和按分类过滤
+        data.append({"key": line, "vector": doc_embeddings[i], "text": content_chunks[i], **chunker.scalar_fields(chunks[i])})
+
+    # 以产品名作为内容键增量同步，产品信息变化时原地更新
+    if not db.sync_collection(
+        collection_name, embedding_dim, data, source=source, scalar_fields=product_chunker.PRODUCT_SCALAR_FIELDS
+    ):
+        print("同步产品信息到向量数据库失败")
+        exit(1)
 
-    if not db.create_collection(collection_name, embedding_dim) :
-        print("初始化数据库失败")
-        exit(1)   
 
-    if not db.insert(collection_name, data):
-        print("插入产品信息到向量数据库失败")
-        exit(1)
-    
+def init_emoji_collection():
+    emoji_collection_name = "emotion2emoji"
+    source = source_fingerprint(extra=emoji_mapping)
+    if db.load_snapshot(emoji_collection_name, source):
+        return
+
     emotion_list = [key for key in emoji_mapping.keys()]
     emoji_list = [value for value in emoji_mapping.values()]
     print(f"emotion: {emotion_list}, emoji: {emoji_list}")
 
-    emotion_enbed = embedding_model.encode_documents(emotion_list)
+    emotion_enbed = doc_embedding_cache.encode_documents(emotion_list)
     embedding_dim = len(emotion_enbed[0])
     print(f"第一个情绪元素的维度是 {embedding_dim}\n")
     print(f"向量编码模型的默认维度是 {embedding_model.dim}\n")
 
     emoji_data = []
-    emoji_collection_name = "emotion2emoji"    
     for i, line in enumerate(tqdm(emotion_list, desc="Creating embeddings")):
-        emoji_data.append({"id": i, "vector": emotion_enbed[i], "text": emoji_list[i]})
+        emoji_data.append({"key": line, "vector": emotion_enbed[i], "text": emoji_list[i]})
 
-    if not db.create_collection(emoji_collection_name, embedding_dim) :
-        print("初始化数据库失败")
-        exit(1)   
-
-    if not db.insert(emoji_collection_name, emoji_data):
-        print("插入产品信息到向量数据库失败")
+    if not db.sync_collection(emoji_collection_name, embedding_dim, emoji_data, source=source):
+        print("同步表情映射到向量数据库失败")
         exit(1)
 
-    print("初始化数据库成功")
 
 
+SESSION_COOKIE = 'session_id'
+
+def resolve_session_id(data: dict) -> tuple[str, bool]:
+    """
+    取请求的会话 id：优先使用请求体中的 session_id，其次是 cookie；都没有时生成新的 id（第二个返回值为 True），
+    由接口通过 cookie 和响应返回给客户端，没有带 session_id 的客户端之间不会共用同一个会话
+    """
+    session_id = data.get('session_id') or request.cookies.get(SESSION_COOKIE)
+    if session_id:
+        return str(session_id), False
+    return uuid.uuid4().hex, True
+
+def attach_session(response: Response, session_id: str, is_new: bool) -> Response:
+    """在响应头中带上会话 id，新生成的 id 同时写入 cookie"""
+    response.headers['X-Session-Id'] = session_id
+    if is_new:
+        response.set_cookie(SESSION_COOKIE, session_id, httponly=True, samesite='Lax')
+    return response
 
 @app.route('/')
 def index():
@@ -94,20 +141,90 @@ def index():
 def chat_endpoint():
     data = request.json
     user_message = data.get('message', '')
-    print(f"lppppp:{user_message}")
+    session_id, is_new = resolve_session_id(data)
+    log.debug("收到消息：%s", user_message)
     # 处理用户消息
-    response = engine.generate_rednote_by_single_chat(user_message)
+    with metrics.request_trace('/chat') as trace:
+        try:
+            response = engine.generate_rednote_by_single_chat(user_message, session_id=session_id)
+        except ServerBusyError:
+            trace.status = 'busy'
+            return attach_session(jsonify({'response': '服务繁忙，请稍后再试', 'session_id': session_id}), session_id, is_new), 503
     
-    return jsonify({
+    return attach_session(jsonify({
         'response': response,
+        'session_id': session_id,
         #'history': engine.get_history()
-    })
+    }), session_id, is_new)
+
+def sse_event(event: dict) -> str:
+    """将事件编码为 Server-Sent Events 格式"""
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+def sse_events(events):
+    """将事件流编码为 SSE，排队已满时以错误事件结束（计时覆盖整个生成过程）"""
+    with metrics.request_trace('/chat/stream') as trace:
+        try:
+            for event in events:
+                yield sse_event(event)
+        except ServerBusyError:
+            trace.status = 'busy'
+            yield sse_event({'type': 'error', 'content': '服务繁忙，请稍后再试'})
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream_endpoint():
+    data = request.json
+    user_message = data.get('message', '')
+    # 以 SSE 的形式推送 Agent 的中间进度（需求提取、工具调用）以及最终文案
+    session_id, is_new = resolve_session_id(data)
+    events = engine.generate_rednote_events(user_message, session_id=session_id)
+
+    return attach_session(Response(
+        stream_with_context(sse_events(events)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    ), session_id, is_new)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 抓取接口：请求和各阶段的耗时直方图、大模型调用次数和 token 用量"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 # @app.route('/clear', methods=['POST'])
 # def clear_history():
 #     engine.clear_history()
 #     return jsonify({'status': 'success'})
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="小红书文案生成 Agent 服务")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="初始化向量数据库时并行编码文档的进程数（默认 1，即单进程编码）")
+    parser.add_argument("--tool-workers", type=int, default=None,
+                        help="工具调用线程池的线程数（默认为大模型并发上限的 4 倍，每个请求一轮最多同时执行约 4 个检索和工具）")
+    parser.add_argument("--rerank-model", default=None,
+                        help="本地交叉编码器模型，例如 BAAI/bge-reranker-v2-m3（默认不启用，只按检索得分过滤）")
+    parser.add_argument("--rerank-min-score", type=float, default=None,
+                        help="交叉编码器得分低于该值的检索结果不放入提示词")
+    return parser.parse_args()
+
+def init_with_workers(workers: int):
+    """初始化向量数据库，workers 大于 1 时使用多进程编码，完成后关闭进程池"""
+    if workers <= 1:
+        init_product_vector_db()
+        return
+
+    encoder = ParallelEncoder(embedding_model, workers=workers)
+    doc_embedding_cache.set_encoder(encoder)
+    try:
+        init_product_vector_db()
+    finally:
+        doc_embedding_cache.set_encoder(embedding_model)
+        encoder.close()
+
 if __name__ == '__main__':
-    init_product_vector_db()
-    app.run(debug=True, port=5000, use_reloader=False)
\ No newline at end of file
+    args = parse_args()
+    init_with_workers(args.workers)
+    set_tool_workers(args.tool_workers or runtime.max_concurrency * 4)
+    if args.rerank_model:
+        product_reranker.set_cross_encoder(args.rerank_model, min_score=args.rerank_min_score)
+    app.run(debug=True, port=5000, use_reloader=False, threaded=True)
@@ -0,0 +1,106 @@
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Optional
+
+import numpy as np
+
+# 子进程中的编码模型，由进程池的 initializer 创建
+_worker_model = None
+
+
+def _init_worker(model_factory: Callable):
+    global _worker_model
+    _worker_model = model_factory()
+
+
+def _encode_shard(texts: List[str]) -> np.ndarray:
+    return np.asarray(_worker_model.encode_documents(texts), dtype=np.float32)
+
+
+class ParallelEncoder:
+    """
+    多进程文档编码器
+
+    功能：
+    - 将一批文本切分为若干分片，分发到进程池中并行编码，结果按原顺序拼接
+    - 进程池在创建时启动，之后的调用复用同一批进程，每个进程只加载一次模型
+    - 文本较少或 workers 为 1 时直接在当前进程编码
+    - 查询编码（encode_queries）文本很少，始终在当前进程执行
+
+    注意：进程池使用 fork 方式启动（spawn 会在子进程中重新执行 main.py，重复打开 Milvus 数据文件），
+    不支持 fork 的平台上退化为单进程编码。子进程会重新创建模型，不复用父进程中的推理会话。
+
+    使用示例：
+    >>> encoder = ParallelEncoder(embedding_model, workers=8)
+    >>> vectors = encoder.encode_documents(texts)
+    """
+
+    def __init__(
+        self,
+        model,
+        workers: Optional[int] = None,
+        min_shard_size: int = 16,
+        model_factory: Optional[Callable] = None
+    ):
+        """
+        初始化并启动进程池
+
+        参数:
+        model: 当前进程中的编码模型，需提供 encode_documents / encode_queries 方法
+        workers: 进程数（默认为 CPU 核数）
+        min_shard_size: 每个分片的最少文本数，避免分片过小时进程间通信开销超过编码本身
+        model_factory: 在子进程中创建模型的函数（默认为 type(model)，即用无参构造函数重新创建）
+        """
+        self.model = model
+        self.workers = workers or os.cpu_count() or 1
+        self.min_shard_size = min_shard_size
+        self.model_factory = model_factory or type(model)
+        # 与原模型保持一致，向量缓存据此生成模型标识
+        self.model_name = getattr(model, "model_name", "")
+        self.dim = getattr(model, "dim", None)
+        self._executor = None
+
+        if self.workers > 1:
+            if "fork" not in multiprocessing.get_all_start_methods():
+                print("当前平台不支持 fork 启动进程，多进程编码退化为单进程")
+                self.workers = 1
+            else:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("fork"),
+                    initializer=_init_worker,
+                    initargs=(self.model_factory,),
+                )
+                # 立即启动所有进程并加载模型：此时其他后台线程尚未开始工作，fork 更安全
+                self._executor.submit(math.sqrt, 0).result()
+                print(f"多进程编码器已启动，进程数: {self.workers}")
+
+    def encode_documents(self, texts: List[str]) -> List[np.ndarray]:
+        """
+        并行编码文档
+
+        参数:
+        texts: 文本列表
+
+        返回:
+        与 texts 顺序一致的向量列表
+        """
+        if self._executor is None or len(texts) < 2 * self.min_shard_size:
+            return self.model.encode_documents(texts)
+
+        shard_count = min(self.workers, math.ceil(len(texts) / self.min_shard_size))
+        shard_size = math.ceil(len(texts) / shard_count)
+        shards = [texts[i:i + shard_size] for i in range(0, len(texts), shard_size)]
+        results = list(self._executor.map(_encode_shard, shards))
+        return [vector for shard in results for vector in shard]
+
+    def encode_queries(self, queries: List[str]) -> List[np.ndarray]:
+        return self.model.encode_queries(queries)
+
+    def close(self):
+        """关闭进程池"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
@@ -3,6 +3,15 @@ import re
 from typing import List, Dict, Any
 from datetime import datetime
 
+# 写入向量数据库的标量字段定义（见 LocalMilvusDB.create_collection）：
+# 产品名建倒排索引用于精确查询，主分类作为分区键，按分类过滤时只检索对应的分区
+PRODUCT_SCALAR_FIELDS = {
+    "product_name": {"type": "VARCHAR", "max_length": 256, "index": "INVERTED"},
+    "product_category": {"type": "VARCHAR", "max_length": 64, "partition_key": True},
+    "product_categories": {"type": "ARRAY", "element_type": "VARCHAR", "max_capacity": 8, "max_length": 64},
+    "web_query_topics": {"type": "ARRAY", "element_type": "VARCHAR", "max_capacity": 32, "max_length": 128},
+}
+
 class ProductChunker:
     """
     产品数据chunking工具 - 从JSON文件读取数据并按产品进行chunking，可以保留好较完整的语义
@@ -142,6 +151,27 @@ class ProductChunker:
         
         return categories if categories else ["general"]
     
+    def scalar_fields(self, chunk: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        取出chunk中需要作为标量字段写入向量数据库的元数据
+        
+        Args:
+            chunk: chunk_by_product 生成的chunk
+            
+        Returns:
+            与 PRODUCT_SCALAR_FIELDS 对应的字段值
+        """
+        metadata = chunk["metadata"]
+        limits = PRODUCT_SCALAR_FIELDS
+        categories = metadata["product_categories"][:limits["product_categories"]["max_capacity"]]
+        return {
+            "product_name": chunk["product_name"],
+            # 第一个分类作为主分类（分区键）
+            "product_category": categories[0],
+            "product_categories": categories,
+            "web_query_topics": metadata["web_query_topics"][:limits["web_query_topics"]["max_capacity"]],
+        }
+    
     def save_chunks_to_file(self, chunks: List[Dict[str, Any]]) -> bool:
         """
         将chunks保存到JSON文件
@@ -0,0 +1,171 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+
+class Session:
+    """单个会话的对话状态"""
+
+    def __init__(self, session_id: str, messages: List[Dict], summary: str = ""):
+        self.session_id = session_id
+        self.messages = messages
+        # 早期对话的滚动摘要（由上下文窗口管理器维护）
+        self.summary = summary
+        self.last_access = time.monotonic()
+        self.lock = threading.Lock()
+        # 正在使用该会话的请求数，大于 0 时不会被淘汰
+        self.active = 0
+
+
+class SessionStore:
+    """
+    会话存储
+
+    功能：
+    - 以会话 id 区分不同用户的对话历史
+    - 每个会话一把锁，同一会话的并发请求串行执行，不同会话互不影响
+    - 空闲超时的会话会被淘汰；会话数超过上限时淘汰最久未访问的会话
+    - 每个会话最多保留 max_messages 条消息（不含系统提示词）
+    - 可选 SQLite 持久化：会话被淘汰出内存后，再次访问时从数据库恢复
+
+    使用示例：
+    >>> store = SessionStore(SYSTEM_PROMPT, db_path="./sessions.db")
+    >>> with store.session("user-1") as session:
+    ...     session.messages.append({"role": "user", "content": "你好"})
+    """
+
+    def __init__(
+        self,
+        system_prompt: str,
+        max_sessions: int = 1000,
+        idle_timeout: float = 1800,
+        max_messages: int = 40,
+        db_path: Optional[str] = None
+    ):
+        """
+        初始化会话存储
+
+        参数:
+        system_prompt: 新会话的系统提示词
+        max_sessions: 内存中最多保留的会话数
+        idle_timeout: 会话空闲多少秒后被淘汰
+        max_messages: 每个会话最多保留的消息数（不含系统提示词）
+        db_path: SQLite 数据库路径（可选，None 表示仅保存在内存中）
+        """
+        self.system_prompt = system_prompt
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._db = None
+        self._db_lock = threading.Lock()
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, messages TEXT NOT NULL, "
+                "summary TEXT NOT NULL DEFAULT '', updated_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def _new_messages(self) -> List[Dict]:
+        return [{"role": "system", "content": self.system_prompt}]
+
+    def _load(self, session_id: str) -> Optional[Session]:
+        """从 SQLite 中恢复会话"""
+        if self._db is None:
+            return None
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT messages, summary FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return Session(session_id, json.loads(row[0]), row[1])
+
+    def _save(self, session: Session):
+        """将会话写入 SQLite"""
+        if self._db is None:
+            return
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, messages, summary, updated_at) "
+                "VALUES (?, ?, ?, ?)",
+                (session.session_id, json.dumps(session.messages, ensure_ascii=False),
+                 session.summary, time.time()),
+            )
+            self._db.commit()
+
+    def _trim(self, session: Session):
+        """只保留最近的 max_messages 条消息，并保证保留的历史从用户消息开始"""
+        history = session.messages[1:]
+        if len(history) <= self.max_messages:
+            return
+        history = history[-self.max_messages:]
+        while history and history[0].get("role") != "user":
+            history.pop(0)
+        session.messages = session.messages[:1] + history
+
+    def _evict(self):
+        """淘汰空闲超时的会话，以及超过数量上限时最久未访问的会话（调用方需持有 self._lock）"""
+        now = time.monotonic()
+        for session_id, session in list(self._sessions.items()):
+            if session.active == 0 and now - session.last_access > self.idle_timeout:
+                del self._sessions[session_id]
+
+        if len(self._sessions) > self.max_sessions:
+            for session_id, session in list(self._sessions.items()):
+                if len(self._sessions) <= self.max_sessions:
+                    break
+                if session.active == 0:
+                    del self._sessions[session_id]
+
+    def _acquire(self, session_id: str) -> Session:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._load(session_id) or Session(session_id, self._new_messages())
+                self._sessions[session_id] = session
+            self._sessions.move_to_end(session_id)
+            session.active += 1
+            self._evict()
+            return session
+
+    def _release(self, session: Session):
+        with self._lock:
+            session.active -= 1
+            session.last_access = time.monotonic()
+
+    @contextmanager
+    def session(self, session_id: str):
+        """
+        获取会话并持有其锁，退出时裁剪历史并持久化
+
+        参数:
+        session_id: 会话 id
+        """
+        session = self._acquire(session_id)
+        try:
+            with session.lock:
+                try:
+                    yield session
+                finally:
+                    self._trim(session)
+                    self._save(session)
+        finally:
+            self._release(session)
+
+    def clear(self, session_id: str):
+        """清空会话历史"""
+        with self.session(session_id) as session:
+            session.messages = self._new_messages()
+            session.summary = ""
+
+    def __len__(self) -> int:
+        return len(self._sessions)
@@ -0,0 +1,134 @@
+import asyncio
+import queue
+import threading
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional
+
+
+class ServerBusyError(Exception):
+    """排队的请求数超过上限"""
+
+
+_STREAM_END = object()
+
+
+class AsyncRuntime:
+    """
+    后台异步运行时
+
+    功能：
+    - 在独立线程中运行一个 asyncio 事件循环，所有请求的大模型调用都在该循环中并发执行，
+      共用同一个异步客户端和连接池
+    - 用信号量限制同时进行的调用数，超出的调用排队等待；排队数超过上限时直接拒绝
+    - 事件循环中只执行网络 I/O，向量编码、Milvus 检索等阻塞操作留在各自的请求线程中执行
+
+    使用示例：
+    >>> runtime = AsyncRuntime(max_concurrency=32, max_queue=128)
+    >>> response = runtime.run(lambda: async_client.chat.completions.create(...))
+    """
+
+    def __init__(self, max_concurrency: int = 32, max_queue: int = 128):
+        """
+        初始化并启动运行时
+
+        参数:
+        max_concurrency: 同时进行的调用数上限
+        max_queue: 排队等待的调用数上限
+        """
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+
+        self.loop = asyncio.new_event_loop()
+        self._semaphore = None
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, args=(ready,), name="async-runtime", daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def _run_loop(self, ready: threading.Event):
+        asyncio.set_event_loop(self.loop)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        ready.set()
+        self.loop.run_forever()
+
+    async def _limited(self, coro_factory: Callable[[], Awaitable]):
+        """在并发限制下执行协程，排队数超过上限时拒绝"""
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise ServerBusyError(f"排队请求数已达上限 {self.max_queue}")
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        try:
+            return await coro_factory()
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def run(self, coro_factory: Callable[[], Awaitable], timeout: Optional[float] = None) -> Any:
+        """
+        在事件循环中执行协程，并在当前线程等待结果
+
+        参数:
+        coro_factory: 返回协程的函数（在事件循环线程中调用，保证协程绑定到该循环）
+        timeout: 等待结果的超时秒数
+
+        返回:
+        协程的返回值
+        """
+        future = asyncio.run_coroutine_threadsafe(self._limited(coro_factory), self.loop)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def iterate(self, stream_factory: Callable[[], Awaitable]) -> Iterator[Any]:
+        """
+        在事件循环中消费异步流，并在当前线程逐个产出其中的元素
+
+        参数:
+        stream_factory: 返回协程的函数，协程的结果是一个异步可迭代对象（例如流式补全）
+        """
+        items = queue.Queue()
+
+        async def pump():
+            try:
+                stream = await stream_factory()
+                async for item in stream:
+                    items.put_nowait(item)
+            except BaseException as e:
+                items.put_nowait(e)
+                raise
+
+        future = asyncio.run_coroutine_threadsafe(self._limited(pump), self.loop)
+        # 任务结束（包括排队被拒绝、未能开始执行）时放入结束标记
+        future.add_done_callback(lambda _: items.put_nowait(_STREAM_END))
+        try:
+            while True:
+                item = items.get()
+                if item is _STREAM_END:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+            # 排队被拒绝时在这里抛出 ServerBusyError
+            future.result()
+        finally:
+            # 调用方提前停止迭代（例如客户端断开）时取消事件循环中的任务
+            future.cancel()
+
+    def stats(self) -> Dict[str, int]:
+        """返回运行时统计信息"""
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+        }
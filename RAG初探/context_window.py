@@ -0,0 +1,144 @@
+import math
+import re
+from typing import Callable, Dict, List, Optional
+
+from async_logger import get_logger
+
+# 中日韩字符（含全角标点）
+_CJK_PATTERN = re.compile(r"[　-〿㐀-䶿一-鿿＀-￯]")
+
+# 每条消息在角色、分隔符等格式上的额外开销
+MESSAGE_OVERHEAD_TOKENS = 4
+
+log = get_logger("context_window")
+
+
+def count_tokens(text: str) -> int:
+    """
+    估算文本的 token 数
+
+    按 DeepSeek 官方给出的换算比例估算：1 个中文字符约 0.6 个 token，1 个英文字符约 0.3 个 token
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    return math.ceil(cjk * 0.6 + (len(text) - cjk) * 0.3)
+
+
+def message_tokens(message: Dict) -> int:
+    """估算单条消息的 token 数"""
+    return count_tokens(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+
+
+def messages_tokens(messages: List[Dict]) -> int:
+    """估算消息列表的 token 数"""
+    return sum(message_tokens(message) for message in messages)
+
+
+class ContextWindow:
+    """
+    基于 token 预算的上下文窗口管理
+
+    功能：
+    - 估算每次请求的 token 数，并限制在预算之内
+    - 超出预算时，把最早的若干轮对话折叠进会话的滚动摘要，历史中只保留最近的对话
+    - 摘要生成失败时退化为截断拼接，保证请求大小始终有上限
+
+    使用示例：
+    >>> window = ContextWindow(budget_tokens=6000, summarizer=engine.summarize)
+    >>> request_messages = window.build(session, [{"role": "user", "content": prompt}])
+    """
+
+    def __init__(
+        self,
+        budget_tokens: int = 6000,
+        keep_recent_messages: int = 4,
+        max_summary_tokens: int = 500,
+        summarizer: Optional[Callable[[str, List[Dict]], str]] = None
+    ):
+        """
+        初始化上下文窗口
+
+        参数:
+        budget_tokens: 每次请求的 token 预算（不含模型输出）
+        keep_recent_messages: 至少保留原文的最近消息数
+        max_summary_tokens: 滚动摘要的 token 上限
+        summarizer: 摘要函数，参数为 (已有摘要, 需要折叠的消息)，返回新摘要
+        """
+        self.budget_tokens = budget_tokens
+        self.keep_recent_messages = keep_recent_messages
+        self.max_summary_tokens = max_summary_tokens
+        self.summarizer = summarizer
+
+    def _summary_message(self, summary: str) -> List[Dict]:
+        if not summary:
+            return []
+        return [{"role": "system", "content": f"以下是之前对话的摘要：\n{summary}"}]
+
+    def _truncate(self, text: str, max_tokens: int) -> str:
+        """截断文本使其不超过 max_tokens（按最坏情况每字符 0.6 token 估算，保留末尾的最新内容）"""
+        if count_tokens(text) <= max_tokens:
+            return text
+        return text[-int(max_tokens / 0.6):]
+
+    def _fold(self, summary: str, folded: List[Dict]) -> str:
+        """把需要折叠的消息合并进摘要"""
+        if self.summarizer is not None:
+            try:
+                new_summary = self.summarizer(summary, folded)
+                if new_summary:
+                    return self._truncate(new_summary, self.max_summary_tokens)
+            except Exception as e:
+                log.warning("生成对话摘要失败，改为截断拼接: %s", e)
+
+        lines = [summary] if summary else []
+        for message in folded:
+            role = "用户" if message.get("role") == "user" else "助手"
+            lines.append(f"{role}：{message.get('content') or ''}")
+        return self._truncate("\n".join(lines), self.max_summary_tokens)
+
+    def build(self, session, pending: List[Dict]) -> List[Dict]:
+        """
+        构造发送给模型的消息列表：系统提示词 + 摘要 + 最近的历史 + 本轮消息
+
+        超出预算时会修改 session：较早的历史从 session.messages 中移除并折叠进 session.summary
+
+        参数:
+        session: 会话对象，需包含 messages（首条为系统提示词）和 summary
+        pending: 本轮新增的消息
+
+        返回:
+        发送给模型的消息列表
+        """
+        system = session.messages[:1]
+        history = session.messages[1:]
+        fixed_tokens = messages_tokens(system) + messages_tokens(pending)
+
+        def total_tokens() -> int:
+            return (fixed_tokens + messages_tokens(self._summary_message(session.summary))
+                    + messages_tokens(history))
+
+        if total_tokens() > self.budget_tokens and len(history) > self.keep_recent_messages:
+            # 从最早的消息开始，找出需要折叠的最少条数（按用户消息对齐，保证剩余历史从用户消息开始）
+            budget_for_history = self.budget_tokens - fixed_tokens - self.max_summary_tokens
+            cut = 0
+            remaining = messages_tokens(history)
+            while cut < len(history) - self.keep_recent_messages and (
+                remaining > budget_for_history or history[cut].get("role") != "user"
+            ):
+                remaining -= message_tokens(history[cut])
+                cut += 1
+            if cut > 0:
+                session.summary = self._fold(session.summary, history[:cut])
+                history = history[cut:]
+                session.messages = system + history
+                log.info("对话历史超出预算，已将 %d 条早期消息折叠进摘要", cut)
+
+        # 最近的消息本身仍超出预算时，直接丢弃最早的消息
+        while history and total_tokens() > self.budget_tokens:
+            history.pop(0)
+            while history and history[0].get("role") != "user":
+                history.pop(0)
+            session.messages = system + history
+
+        return system + self._summary_message(session.summary) + history + pending
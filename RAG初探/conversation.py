@@ -2,27 +2,47 @@ import json
 from datetime import datetime
 import os
 import random
-from openai import OpenAI
+from llm_transport import LLMTransport
+import metrics
+from async_logger import ConversationLog, get_logger
 from utils import embedding_model
 from vector_db import db
+from semantic_cache import SemanticAnswerCache, context_fingerprint
+from session_store import SessionStore
+from async_runtime import AsyncRuntime, ServerBusyError
+from context_window import ContextWindow
+from reranker import Reranker
 
 # 从环境变量获取 DeepSeek API Key
 api_key = os.getenv("DEEPSEEK_API_KEY")
+# 指向本地模拟服务（DEEPSEEK_BASE_URL）时不需要真实的 API Key
+base_url = os.getenv("DEEPSEEK_BASE_URL")
 if not api_key:
-    raise ValueError("请设置 DEEPSEEK_API_KEY 环境变量")
+    if not base_url:
+        raise ValueError("请设置 DEEPSEEK_API_KEY 环境变量")
+    api_key = "mock"
 
-# 初始化 OpenAI 客户端（假设 DeepSeek 的 API 兼容 OpenAI 格式）
-client = OpenAI(
+# 所有大模型调用共用的传输层（假设 DeepSeek 的 API 兼容 OpenAI 格式）：
+# 同步 / 异步客户端各自使用 keep-alive 连接池，调用超时、限流和服务端错误自动重试
+# DEEPSEEK_BASE_URL 可指向本地模拟服务；DEEPSEEK_HEDGE=1 时启用对冲请求
+transport = LLMTransport(
     api_key=api_key,
-    base_url="https://api.deepseek.com/v1",  # DeepSeek API 的基地址
+    base_url=base_url or "https://api.deepseek.com/v1",  # DeepSeek API 的基地址
+    max_connections=64,
+    timeout=60,
+    max_retries=3,
+    hedge=os.getenv("DEEPSEEK_HEDGE") == "1",
 )
 
+log = get_logger("conversation")
+
 SYSTEM_PROMPT = """
 Human: 你是一个 AI 助手。你能够从提供的上下文段落片段中找到问题的答案。
 """
 
+SUMMARY_PROMPT = "请把下面的新对话合并进已有摘要，生成一段简洁的中文摘要，保留用户问过的问题、涉及的法条和关键结论，不超过300字。"
+
 class ConversationEngine:
-    messages : list = [{"role": "system", "content": SYSTEM_PROMPT}]
     """
     多轮对话引擎类
     
@@ -34,24 +54,100 @@ class ConversationEngine:
     
     使用方法：
     1. 初始化引擎: engine = ConversationEngine()
-    2. 处理用户消息: response = engine.chat(user_message)
+    2. 处理用户消息: response = engine.chat_with_deepseek(user_message, session_id)
     3. 获取对话历史: history = engine.get_history()
     4. 保存对话日志: engine.save_logs()
     """
     
-    def __init__(self, log_file):
+    def __init__(
+        self,
+        log_file,
+        cache_threshold: float = 0.95,
+        cache_size: int = 512,
+        session_db_path: str = None,
+        context_budget: int = 4000,
+        runtime: AsyncRuntime = None,
+        top_k: int = 3,
+        reranker: Reranker = None
+    ):
         """
         初始化对话引擎
         
         参数:
-        log_file: 对话日志保存
+        log_file: 对话日志保存路径（每轮问答追加一行 JSON，按大小轮转）
+        cache_threshold: 语义答案缓存命中所需的最小问题相似度
+        cache_size: 语义答案缓存的最大条目数
+        session_db_path: 会话持久化的 SQLite 路径（可选，默认仅保存在内存中）
+        context_budget: 每次请求的 token 预算，超出时早期对话被折叠进摘要
+        runtime: 异步运行时（可选，None 表示使用同步客户端）
+        top_k: 每个问题最多放入提示词的检索片段数
+        reranker: 检索结果的重排序与相关度过滤（默认只保留融合得分不低于最佳结果一半的片段）
         """
+        self.runtime = runtime
         self.log_file = log_file
+        self.conversation_log = ConversationLog(log_file)
         self.conversation_history = []
+        # 每个会话独立保存对话历史，不同用户之间互不干扰
+        self.sessions = SessionStore(SYSTEM_PROMPT, db_path=session_db_path)
+        self.answer_cache = SemanticAnswerCache(threshold=cache_threshold, maxsize=cache_size)
+        self.context_window = ContextWindow(budget_tokens=context_budget, summarizer=self.summarize)
+        self.top_k = top_k
+        # 混合检索的 RRF 得分：只在一路检索中排第一的片段得分约为两路都排第一时的一半，
+        # 相对阈值 0.5 保留至少有一路强烈支持的片段，其余的不放入提示词
+        self.reranker = reranker or Reranker(relative_margin=0.5, min_keep=1)
+
+    def _create_completion(self, stage: str = "llm", **kwargs):
+        """
+        调用 DeepSeek：配置了异步运行时时在其事件循环中并发执行，否则使用同步客户端
+
+        stage 为指标中的阶段名，调用耗时、结果和 token 用量按阶段记录
+        """
+        if kwargs.get("stream"):
+            # 最后一个数据块附带本次调用的 token 用量
+            kwargs.setdefault("stream_options", {"include_usage": True})
+            return metrics.observe_stream(stage, lambda: self._request_completion(**kwargs))
+        return metrics.observe_completion(stage, lambda: self._request_completion(**kwargs))
+
+    def _request_completion(self, **kwargs):
+        if self.runtime is None:
+            return transport.create(**kwargs)
+        if kwargs.get("stream"):
+            return self.runtime.iterate(lambda: transport.acreate(**kwargs))
+        return self.runtime.run(lambda: transport.acreate(**kwargs))
+
+    def summarize(self, summary: str, messages: list) -> str:
+        """调用 DeepSeek 把早期对话合并进滚动摘要"""
+        conversation = "\n".join(
+            f"{'用户' if message['role'] == 'user' else '助手'}：{message['content']}" for message in messages
+        )
+        response = self._create_completion(
+            stage="llm_summary",
+            model="deepseek-chat",
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": f"已有摘要：\n{summary or '无'}\n\n新的对话：\n{conversation}"},
+            ],
+            temperature=0.3,
+            max_tokens=400,
+            stream=False
+        )
+        return response.choices[0].message.content
 
     
-    def chat_with_deepseek(self, question) -> str:
-        dic = db.search("my_mfd_collection", question)
+    def _prepare_turn(self, question, session):
+        """
+        检索上下文、构造提示词，并在 token 预算内组织本轮请求的消息
+
+        会话中已有之前的对话（或摘要）时，追问的含义依赖上下文，不查询也不写入语义缓存
+
+        返回:
+        (请求消息列表, 问题向量, 上下文指纹, 缓存的答案)，未命中缓存时答案为 None；不使用缓存时问题向量和指纹为 None
+        """
+        # 混合检索：问题中的条号、法律术语由 BM25 精确匹配，语义相近的内容由向量检索召回
+        with metrics.span("retrieval"):
+            dic = db.search("my_mfd_collection", question, top_k=self.reranker.candidate_count(self.top_k), mode="hybrid")
+        with metrics.span("rerank"):
+            dic = self.reranker.rerank(question, dic, self.top_k)
         context = "\n".join(
                                 [line_with_distance[0] for line_with_distance in dic]
                             )
@@ -66,14 +162,47 @@ class ConversationEngine:
                                     <translated>
                                     </translated>
                                     """
-        print(USER_PROMPT)
-        self.messages.append({"role": "user", "content": USER_PROMPT})
+        log.debug("提示词：%s", USER_PROMPT)
+
+        # 会话的第一轮问题中，相近的问题且检索到的上下文一致时，直接复用缓存的答案，跳过大模型调用
+        question_vector = fingerprint = cached_answer = None
+        if len(session.messages) <= 1 and not session.summary:
+            with metrics.span("answer_cache_lookup"):
+                question_vector = db.encode_query(question)
+                fingerprint = context_fingerprint(context)
+                cached_answer = self.answer_cache.lookup(question_vector, fingerprint)
+        if cached_answer is not None:
+            self._record_turn(session, question, cached_answer)
+            log.info("问题：%s，命中语义缓存，缓存统计: %s", question, self.answer_cache.stats())
+            self.conversation_log.record(session_id=session.session_id, question=question, answer=cached_answer, cached=True)
+            return None, question_vector, fingerprint, cached_answer
+
+        # 检索到的上下文只随本轮请求发送，历史中只保存问题本身，早期对话超出预算时折叠进摘要
+        with metrics.span("context_build"):
+            messages = self.context_window.build(session, [{"role": "user", "content": USER_PROMPT}])
+        return messages, question_vector, fingerprint, cached_answer
+
+    def _record_turn(self, session, question, answer):
+        """把本轮问答写入会话历史（只保存问题，不保存检索到的上下文）"""
+        session.messages.append({"role": "user", "content": question})
+        session.messages.append({"role": "assistant", "content": answer})
+
+    def chat_with_deepseek(self, question, session_id: str = "default") -> str:
+        with self.sessions.session(session_id) as session:
+            return self._chat(question, session)
+
+    def _chat(self, question, session) -> str:
+        messages, question_vector, fingerprint, cached_answer = self._prepare_turn(question, session)
+        if cached_answer is not None:
+            return cached_answer
+
         try:
-            #print(f"lpppppppp: {self.messages}")
+            #print(f"lpppppppp: {messages}")
             # 调用 DeepSeek Chat API
-            response = client.chat.completions.create(
+            response = self._create_completion(
+                stage="llm_answer",
                 model="deepseek-chat",  # 或 DeepSeek 提供的其他模型名称
-                messages=self.messages,
+                messages=messages,
                 temperature=0.7,
                 stream=False
             )
@@ -81,20 +210,78 @@ class ConversationEngine:
             # 提取生成的 HTML 内容
             if response.choices and len(response.choices) > 0:
                 html_content = response.choices[0].message.content
-                self.messages.append(response.choices[0].message)
-                print(f"问题：{question}，响应: {html_content}")
-                with open(self.log_file, "w", encoding="utf-8") as f:
-                    f.write(f"Question: {question}\n")
-                    f.write(f"Answer: {html_content}\n")
+                self._record_turn(session, question, html_content)
+                if fingerprint is not None:
+                    self.answer_cache.put(question_vector, fingerprint, html_content)
+                log.debug("问题：%s，响应: %s", question, html_content)
+                self.conversation_log.record(session_id=session.session_id, question=question, answer=html_content)
                 return html_content
                 # 保存到文件
                 
                 
             else:
-                print("未收到有效响应")
-                self.messages.pop()
+                log.warning("未收到有效响应")
                 return ""
+        except ServerBusyError:
+            # 排队已满，交给接口层返回 503
+            raise
+        except Exception as e:
+            log.error("调用 API 出错: %s", e)
+            return ""
+
+    def chat_with_deepseek_stream(self, question, session_id: str = "default"):
+        """
+        流式回答问题，逐块产出生成的内容
+
+        参数:
+        question: 用户问题
+        session_id: 会话 id
+
+        产出:
+        事件字典，type 为 "delta"（增量内容）、"done"（生成结束）或 "error"（调用出错）
+        """
+        with self.sessions.session(session_id) as session:
+            yield from self._chat_stream(question, session)
+
+    def _chat_stream(self, question, session):
+        messages, question_vector, fingerprint, cached_answer = self._prepare_turn(question, session)
+        if cached_answer is not None:
+            yield {"type": "delta", "content": cached_answer}
+            yield {"type": "done"}
+            return
+
+        try:
+            response = self._create_completion(
+                stage="llm_answer",
+                model="deepseek-chat",
+                messages=messages,
+                temperature=0.7,
+                stream=True
+            )
+
+            parts = []
+            for chunk in response:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield {"type": "delta", "content": delta}
+
+            html_content = "".join(parts)
+            if not html_content:
+                log.warning("未收到有效响应")
+                yield {"type": "error", "content": "未收到有效响应"}
+                return
+
+            self._record_turn(session, question, html_content)
+            if fingerprint is not None:
+                self.answer_cache.put(question_vector, fingerprint, html_content)
+            log.debug("问题：%s，响应: %s", question, html_content)
+            self.conversation_log.record(session_id=session.session_id, question=question, answer=html_content, stream=True)
+            yield {"type": "done"}
+        except ServerBusyError:
+            raise
         except Exception as e:
-            print(f"调用 API 出错: {e}")
-            self.messages.pop()
-            return ""
\ No newline at end of file
+            log.error("调用 API 出错: %s", e)
+            yield {"type": "error", "content": f"调用 API 出错: {e}"}
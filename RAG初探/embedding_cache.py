@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import threading
+from typing import List
+
+import numpy as np
+
+from async_logger import get_logger
+from utils import embedding_model
+
+log = get_logger("embedding_cache")
+
+
+def text_hash(text: str) -> str:
+    """计算文本内容的哈希值，作为缓存键"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    基于内容哈希的持久化文档向量缓存
+
+    功能：
+    - 以 (模型标识, 文本哈希) 作为缓存键
+    - 向量按行追加到 float32 平铺文件中，读取时使用内存映射
+    - 哈希索引保存在 json 文件中，重启后未变化的文档不再经过编码模型
+
+    使用示例：
+    >>> cache = EmbeddingCache(embedding_model, "./embedding_cache")
+    >>> vectors = cache.encode_documents(["第一段文本", "第二段文本"])
+    """
+
+    VECTORS_FILE = "vectors.f32"
+    INDEX_FILE = "index.json"
+
+    def __init__(self, model, cache_dir: str = "./embedding_cache", model_id: str = None):
+        """
+        初始化向量缓存
+
+        参数:
+        model: 嵌入模型，需提供 encode_documents 方法
+        cache_dir: 缓存根目录
+        model_id: 模型标识（可选，默认根据模型类型、名称和维度生成）
+        """
+        self.model = model
+        self.model_id = model_id or self._model_identity(model)
+        # 不同模型的向量互不兼容，按模型标识分目录存放
+        model_key = hashlib.sha1(self.model_id.encode("utf-8")).hexdigest()[:16]
+        self.cache_dir = os.path.join(cache_dir, model_key)
+        self.vectors_path = os.path.join(self.cache_dir, self.VECTORS_FILE)
+        self.index_path = os.path.join(self.cache_dir, self.INDEX_FILE)
+
+        self.dim = None
+        self.rows = 0
+        self.index = {}
+        self.hits = 0
+        self.misses = 0
+        self._vectors = None
+        self._lock = threading.Lock()
+        self._load()
+
+    def set_encoder(self, encoder):
+        """
+        替换实际执行编码的对象（例如多进程编码器），缓存的模型标识保持不变
+
+        参数:
+        encoder: 与原模型输出一致的编码器，需提供 encode_documents 方法
+        """
+        with self._lock:
+            self.model = encoder
+
+    @staticmethod
+    def _model_identity(model) -> str:
+        """根据模型类型、名称和维度生成模型标识"""
+        model_type = f"{type(model).__module__}.{type(model).__name__}"
+        model_name = getattr(model, "model_name", "")
+        dim = getattr(model, "dim", "")
+        return f"{model_type}:{model_name}:{dim}"
+
+    def _load(self):
+        """加载哈希索引，并以只读方式映射向量文件"""
+        if not os.path.exists(self.index_path):
+            return
+
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            log.warning("读取向量缓存索引失败，将重新建立缓存: %s", e)
+            return
+
+        if meta.get("model_id") != self.model_id:
+            log.warning("向量缓存的模型标识不一致，将重新建立缓存")
+            return
+
+        self.dim = meta["dim"]
+        self.rows = meta["rows"]
+        self.index = meta["index"]
+        self._map_vectors()
+        log.info("成功加载向量缓存，共 %d 条，存储在: %s", self.rows, self.cache_dir)
+
+    def _map_vectors(self):
+        """按索引记录的行数映射向量文件，忽略写入中断留下的尾部数据"""
+        if self.rows == 0:
+            self._vectors = None
+            return
+        self._vectors = np.memmap(
+            self.vectors_path, dtype=np.float32, mode="r", shape=(self.rows, self.dim)
+        )
+
+    def _append(self, hashes: List[str], vectors: np.ndarray):
+        """追加新向量并更新索引（先写向量，再写索引）"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+
+        with open(self.vectors_path, "r+b" if os.path.exists(self.vectors_path) else "wb") as f:
+            f.truncate(self.rows * self.dim * 4)
+            f.seek(0, os.SEEK_END)
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+
+        for i, h in enumerate(hashes):
+            self.index[h] = self.rows + i
+        self.rows += len(hashes)
+
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"model_id": self.model_id, "dim": self.dim, "rows": self.rows, "index": self.index},
+                f,
+            )
+        os.replace(tmp_path, self.index_path)
+        self._map_vectors()
+
+    def encode_documents(self, texts: List[str]) -> List[np.ndarray]:
+        """
+        编码文档，已缓存的文本直接从缓存读取
+
+        参数:
+        texts: 文本列表
+
+        返回:
+        与 texts 顺序一致的向量列表
+        """
+        hashes = [text_hash(text) for text in texts]
+
+        with self._lock:
+            missing = {}
+            for h, text in zip(hashes, texts):
+                if h not in self.index and h not in missing:
+                    missing[h] = text
+
+            if missing:
+                new_vectors = np.asarray(
+                    self.model.encode_documents(list(missing.values())), dtype=np.float32
+                )
+                self._append(list(missing.keys()), new_vectors)
+
+            self.misses += len(missing)
+            self.hits += len(texts) - len(missing)
+            log.info("向量缓存命中 %d 条，新编码 %d 条", len(texts) - len(missing), len(missing))
+
+            if not texts:
+                return []
+            rows = [self.index[h] for h in hashes]
+            return list(np.array(self._vectors[rows]))
+
+    def stats(self) -> dict:
+        """返回缓存统计信息"""
+        return {"rows": self.rows, "hits": self.hits, "misses": self.misses}
+
+
+doc_embedding_cache = EmbeddingCache(embedding_model, "./embedding_cache")
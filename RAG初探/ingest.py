@@ -0,0 +1,258 @@
+import os
+import queue
+import threading
+import time
+import zipfile
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+_END = object()
+
+
+def is_macos_metadata(path: str) -> bool:
+    """macOS 打包时附带的元数据（__MACOSX 目录、以 ._ 开头的 AppleDouble 文件），内容是二进制数据而不是文档"""
+    parts = path.replace("\\", "/").split("/")
+    return "__MACOSX" in parts or parts[-1].startswith("._")
+
+
+def walk_documents(source: str, suffix: str = ".md") -> Iterator[Tuple[str, str]]:
+    """
+    逐个读取文档，每次只在内存中保留一个文件（无法按 UTF-8 解码的字节替换为占位符）
+
+    参数:
+    source: 单个文件、目录（递归查找）或 zip 压缩包
+    suffix: 目录和压缩包中需要读取的文件后缀
+
+    返回:
+    (文档名, 文本) 的迭代器
+    """
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            # 跳过 macOS 打包时附带的元数据目录和文件
+            dirs[:] = sorted(d for d in dirs if d != "__MACOSX")
+            for name in sorted(files):
+                if name.endswith(suffix) and not name.startswith("._"):
+                    path = os.path.join(root, name)
+                    with open(path, "r", encoding="utf-8", errors="replace") as f:
+                        yield path, f.read()
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                # 跳过目录以及 macOS 打包时附带的元数据文件
+                if info.is_dir() or not info.filename.endswith(suffix) or is_macos_metadata(info.filename):
+                    continue
+                yield f"{source}:{info.filename}", archive.read(info).decode("utf-8", errors="replace")
+    else:
+        with open(source, "r", encoding="utf-8", errors="replace") as f:
+            yield source, f.read()
+
+
+def split_sections(text: str, separator: str = "# ") -> Iterator[str]:
+    """按标题分隔符切分文本，跳过空白片段"""
+    for section in text.split(separator):
+        if section.strip():
+            yield section
+
+
+def chunk_text(chunk: Union[str, Dict[str, Any]]) -> str:
+    """文本块可以是字符串，也可以是带元数据的字典 {"text": ..., "metadata": {...}}"""
+    return chunk if isinstance(chunk, str) else chunk["text"]
+
+
+def chunk_row(chunk: Union[str, Dict[str, Any]], vector: Any) -> Dict[str, Any]:
+    """构造写入集合的数据行，文本块的元数据作为动态字段一并写入"""
+    text = chunk_text(chunk)
+    row = {"key": text, "vector": vector, "text": text}
+    if not isinstance(chunk, str):
+        row.update(chunk.get("metadata") or {})
+    return row
+
+
+def batched(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """把迭代器按 size 分批"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class IngestionPipeline:
+    """
+    流式文档入库流水线
+
+    功能：
+    - 文档遍历 → 切分 → 批量编码 → 批量写入，各阶段在独立线程中运行，通过有界队列衔接
+    - 下游处理不过来时上游阻塞等待（背压），内存占用只取决于批大小和队列长度，与语料规模无关
+    - 写入使用 LocalMilvusDB 的流式增量同步，已写入的批次即可被检索
+    - 定期打印进度和吞吐量
+
+    使用示例：
+    >>> pipeline = IngestionPipeline(db, doc_embedding_cache.encode_documents, encode_batch_size=64)
+    >>> pipeline.run("milvus_docs", ["./doc/milvus_docs"])
+    """
+
+    def __init__(
+        self,
+        db,
+        encode: Callable[[List[str]], List[Any]],
+        encode_batch_size: int = 64,
+        insert_batch_size: int = 512,
+        queue_size: int = 4,
+        progress_interval: float = 5.0,
+        splitter: Callable[[str], Iterable[Union[str, Dict[str, Any]]]] = split_sections
+    ):
+        """
+        初始化流水线
+
+        参数:
+        db: LocalMilvusDB 实例
+        encode: 批量编码函数，输入文本列表，返回顺序一致的向量列表
+        encode_batch_size: 每次编码的文本块数
+        insert_batch_size: 每次写入的行数
+        queue_size: 各阶段之间队列的最大批次数
+        progress_interval: 打印进度的间隔秒数
+        splitter: 文本切分函数，输入整篇文档，返回文本块的迭代器（文本块为字符串，或带元数据的字典，见 chunk_row）
+        """
+        self.db = db
+        self.encode = encode
+        self.encode_batch_size = encode_batch_size
+        self.insert_batch_size = insert_batch_size
+        self.queue_size = queue_size
+        self.progress_interval = progress_interval
+        self.splitter = splitter
+
+    def _put(self, q: queue.Queue, item: Any, stop: threading.Event) -> bool:
+        """向有界队列放入数据，队列满时阻塞等待；流水线停止时返回 False"""
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run_stage(self, produce: Callable[[], Iterator[Any]], out: queue.Queue, stop: threading.Event):
+        """在线程中运行一个阶段，把产出放入下游队列；出错时把异常传给下游"""
+        try:
+            for item in produce():
+                if not self._put(out, item, stop):
+                    return
+        except BaseException as e:
+            self._put(out, e, stop)
+            return
+        self._put(out, _END, stop)
+
+    @staticmethod
+    def _drain(q: queue.Queue, stop: threading.Event) -> Iterator[Any]:
+        """从上游队列取数据，直到结束标记或流水线停止；上游出错时重新抛出异常"""
+        while True:
+            try:
+                item = q.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    return
+                continue
+            if item is _END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def run(
+        self,
+        collection_name: str,
+        sources: List[str],
+        metric_type: str = "IP",
+        source: Optional[str] = None
+    ) -> bool:
+        """
+        把 sources 中的所有文档切分、编码后同步到集合
+
+        参数:
+        collection_name: 集合名称
+        sources: 文件、目录或 zip 压缩包列表
+        metric_type: 距离度量类型（"L2" 或 "IP"）
+        source: 源数据指纹（可选，见 vector_db.source_fingerprint）
+
+        返回:
+        是否同步成功
+        """
+        stop = threading.Event()
+        chunks_queue = queue.Queue(self.queue_size)
+        encoded_queue = queue.Queue(self.queue_size)
+        counters = {"documents": 0, "chunks": 0, "encoded": 0, "written": 0}
+
+        def produce_chunks():
+            def chunks():
+                for source_path in sources:
+                    for _, text in walk_documents(source_path):
+                        counters["documents"] += 1
+                        for chunk in self.splitter(text):
+                            counters["chunks"] += 1
+                            yield chunk
+            return batched(chunks(), self.encode_batch_size)
+
+        def produce_vectors():
+            for batch in self._drain(chunks_queue, stop):
+                vectors = self.encode([chunk_text(chunk) for chunk in batch])
+                counters["encoded"] += len(batch)
+                yield batch, vectors
+
+        threads = [
+            threading.Thread(target=self._run_stage, args=(produce_chunks, chunks_queue, stop), name="ingest-split", daemon=True),
+            threading.Thread(target=self._run_stage, args=(produce_vectors, encoded_queue, stop), name="ingest-encode", daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+
+        start = last_report = time.monotonic()
+
+        def report(final: bool = False):
+            elapsed = max(time.monotonic() - start, 1e-9)
+            print(
+                f"[{'入库完成' if final else '入库进度'}] 集合 '{collection_name}'：文档 {counters['documents']} 篇，"
+                f"文本块 {counters['chunks']} 个，已编码 {counters['encoded']} 个（{counters['encoded'] / elapsed:.1f} 块/秒），"
+                f"已写入 {counters['written']} 条，用时 {elapsed:.1f} 秒"
+            )
+
+        sync = None
+        finished = False
+        rows = []
+        try:
+            for batch, vectors in self._drain(encoded_queue, stop):
+                if sync is None:
+                    # 维度在第一批编码完成后才能确定
+                    sync = self.db.begin_sync(collection_name, len(vectors[0]), metric_type, source)
+                rows.extend(chunk_row(chunk, vector) for chunk, vector in zip(batch, vectors))
+                if len(rows) >= self.insert_batch_size:
+                    if not sync.add(rows):
+                        return False
+                    counters["written"] += len(rows)
+                    rows = []
+                if time.monotonic() - last_report >= self.progress_interval:
+                    report()
+                    last_report = time.monotonic()
+
+            if sync is None:
+                print(f"没有读取到任何文本块，跳过集合 '{collection_name}'")
+                return False
+            if rows and not sync.add(rows):
+                return False
+            counters["written"] += len(rows)
+            finished = True
+            if not sync.finish():
+                return False
+            report(final=True)
+            return True
+        except BaseException:
+            if sync is not None and not finished:
+                sync.abort()
+            raise
+        finally:
+            # 写入阶段提前结束（出错）时通知上游停止
+            stop.set()
+            for thread in threads:
+                thread.join()
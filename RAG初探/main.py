@@ -1,65 +1,86 @@
+import argparse
+import json
+import uuid
 
-from flask import Flask, request, jsonify
-from conversation import ConversationEngine
+from flask import Flask, request, jsonify, Response, stream_with_context
+from conversation import ConversationEngine, transport
+from async_runtime import AsyncRuntime, ServerBusyError
+import metrics
+import async_logger
 from glob import glob
 from vector_db import LocalMilvusDB
-from tqdm import tqdm
+from vector_db import db, source_fingerprint
 from utils import embedding_model
-from vector_db import db
+from embedding_cache import doc_embedding_cache
+from parallel_encoder import ParallelEncoder
+from ingest import IngestionPipeline
+from markdown_chunker import MarkdownChunker
 
 app = Flask(__name__)
-engine = ConversationEngine("conversation.log")
+log = async_logger.get_logger("main")
+# 所有请求的大模型调用共用一个后台事件循环，最多 32 个并发调用，超过 128 个排队时返回 503
+runtime = AsyncRuntime(max_concurrency=32, max_queue=128)
+metrics.register_components(runtime, transport, async_logger.writer)
+# 对话日志追加写入 JSON 行文件（按大小轮转），由后台线程写入
+engine = ConversationEngine("conversation.jsonl", runtime=runtime)
 
-"""
-从民法典md中读取文本
-"""
-def fetch_content_from_mfd() -> list[str]:
-    text_lines = []
-    with open("./doc/mfd.md", "r") as file:
-        file_text = file.read()
-        text_lines += file_text.split("# ")
-    return text_lines
+# 流式入库：文档逐个读取、切分后分批编码和写入，内存占用与语料规模无关
+# 按标题和法条切分，每个文本块（含标题路径）不超过 480 个字符：编码模型每个汉字一个 token，最多 512 个位置，
+# 因此一次编码即可覆盖全文，不会被截断
+pipeline = IngestionPipeline(
+    db, doc_embedding_cache.encode_documents, encode_batch_size=64, insert_batch_size=512,
+    splitter=MarkdownChunker(max_tokens=480, overlap_tokens=50),
+)
 
-"""
-从milvus向量数据faq md中读取文本
-"""
-def fetch_milvus_faq_from_dir() -> list[str]:
-    text_lines = []
-    for file_path in glob("milvus_docs/en/faq/*.md", recursive=True):
-        with open(file_path, "r") as file:
-            file_text = file.read()
-            text_lines += file_text.split("# ")
-    
-    return text_lines
+def init_collection_from_sources(collection_name: str, sources: list[str]):
+    """
+    将文件、目录或 zip 压缩包中的文档同步到集合
+
+    源文件和切分参数未变化时直接以内存映射方式加载向量快照，跳过读取、编码和同步
+    """
+    source = source_fingerprint(sources, extra=repr(pipeline.splitter))
+    if db.load_snapshot(collection_name, source):
+        print("初始化数据库成功")
+        return
+
+    if not pipeline.run(collection_name, sources, "IP", source=source):
+        print("同步向量数据库失败")
+        exit(1)
+
+    print("初始化数据库成功")
 
 """
 初始化民法典向量数据库
 """
 def init_mfd_vector_db():
-    contents = fetch_content_from_mfd()
-    #print(contents)
-    #print("\n")
-    data = []
-    collection_name = "my_mfd_collection"
+    init_collection_from_sources("my_mfd_collection", ["./doc/mfd.md"])
 
-    doc_embeddings = embedding_model.encode_documents(contents)
-    embedding_dim = len(doc_embeddings[0])
-    print(f"第一个元素的维度是 {embedding_dim}\n")
+"""
+初始化 Milvus 文档向量数据库（目录或 zip 压缩包，例如 ./doc/milvus_docs 或 ./doc/milvus_docs_2.4.x_en.zip）
+"""
+def init_milvus_docs_vector_db(sources: list[str]):
+    init_collection_from_sources("milvus_docs", sources)
 
-    for i, line in enumerate(tqdm(contents, desc="Creating embeddings")):
-        data.append({"id": i, "vector": doc_embeddings[i], "text": line})
 
-    if not db.create_collection(collection_name, embedding_dim, "IP") :
-        print("初始化数据库失败")
-        exit(1)   
 
-    if not db.insert(collection_name, data):
-        print("插入到向量数据库失败")
-        exit(1)
-    
-    print("初始化数据库成功")
+SESSION_COOKIE = 'session_id'
 
+def resolve_session_id(data: dict) -> tuple[str, bool]:
+    """
+    取请求的会话 id：优先使用请求体中的 session_id，其次是 cookie；都没有时生成新的 id（第二个返回值为 True），
+    由接口通过 cookie 和响应返回给客户端，没有带 session_id 的客户端之间不会共用同一个会话
+    """
+    session_id = data.get('session_id') or request.cookies.get(SESSION_COOKIE)
+    if session_id:
+        return str(session_id), False
+    return uuid.uuid4().hex, True
 
+def attach_session(response: Response, session_id: str, is_new: bool) -> Response:
+    """在响应头中带上会话 id，新生成的 id 同时写入 cookie"""
+    response.headers['X-Session-Id'] = session_id
+    if is_new:
+        response.set_cookie(SESSION_COOKIE, session_id, httponly=True, samesite='Lax')
+    return response
 
 @app.route('/')
 def index():
@@ -69,20 +90,107 @@ def index():
 def chat_endpoint():
     data = request.json
     user_message = data.get('message', '')
-    print(f"lppppp:{user_message}")
+    session_id, is_new = resolve_session_id(data)
+    log.debug("收到消息：%s", user_message)
     # 处理用户消息
-    response = engine.chat_with_deepseek(user_message)
+    with metrics.request_trace('/chat') as trace:
+        try:
+            response = engine.chat_with_deepseek(user_message, session_id)
+        except ServerBusyError:
+            trace.status = 'busy'
+            return attach_session(jsonify({'response': '服务繁忙，请稍后再试', 'session_id': session_id}), session_id, is_new), 503
     
-    return jsonify({
+    return attach_session(jsonify({
         'response': response,
+        'session_id': session_id,
         #'history': engine.get_history()
+    }), session_id, is_new)
+
+def sse_event(event: dict) -> str:
+    """将事件编码为 Server-Sent Events 格式"""
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+def sse_events(events):
+    """将事件流编码为 SSE，排队已满时以错误事件结束（计时覆盖整个生成过程）"""
+    with metrics.request_trace('/chat/stream') as trace:
+        try:
+            for event in events:
+                yield sse_event(event)
+        except ServerBusyError:
+            trace.status = 'busy'
+            yield sse_event({'type': 'error', 'content': '服务繁忙，请稍后再试'})
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream_endpoint():
+    data = request.json
+    user_message = data.get('message', '')
+    session_id, is_new = resolve_session_id(data)
+    # 以 SSE 的形式逐块返回生成内容，浏览器收到第一块即可开始渲染
+    events = engine.chat_with_deepseek_stream(user_message, session_id)
+
+    return attach_session(Response(
+        stream_with_context(sse_events(events)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    ), session_id, is_new)
+
+@app.route('/stats', methods=['GET'])
+def stats_endpoint():
+    return jsonify({
+        'answer_cache': engine.answer_cache.stats(),
+        'query_cache': db.query_cache_stats(),
+        'runtime': runtime.stats(),
+        'llm': transport.stats(),
     })
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 抓取接口：请求和各阶段的耗时直方图、大模型调用次数和 token 用量"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 # @app.route('/clear', methods=['POST'])
 # def clear_history():
 #     engine.clear_history()
 #     return jsonify({'status': 'success'})
 
-if __name__ == '__main__':
+def parse_args():
+    parser = argparse.ArgumentParser(description="民法典 RAG 问答服务")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="初始化向量数据库时并行编码文档的进程数（默认 1，即单进程编码）")
+    parser.add_argument("--rerank-model", default=None,
+                        help="本地交叉编码器模型，例如 BAAI/bge-reranker-v2-m3（默认不启用，只按检索得分过滤）")
+    parser.add_argument("--rerank-min-score", type=float, default=None,
+                        help="交叉编码器得分低于该值的检索结果不放入提示词")
+    parser.add_argument("--docs", nargs="+", default=None,
+                        help="同时把这些文档源（文件、目录或 zip 压缩包）流式同步到 milvus_docs 集合，"
+                             "例如 ./doc/milvus_docs 或 ./doc/milvus_docs_2.4.x_en.zip")
+    return parser.parse_args()
+
+def init_collections(docs: list[str] = None):
+    """初始化民法典集合，指定了 docs 时同时同步 Milvus 文档集合"""
     init_mfd_vector_db()
-    app.run(debug=True, port=5000, use_reloader=False)
\ No newline at end of file
+    if docs:
+        init_milvus_docs_vector_db(docs)
+
+def init_with_workers(workers: int, docs: list[str] = None):
+    """初始化向量数据库，workers 大于 1 时使用多进程编码，完成后关闭进程池"""
+    if workers <= 1:
+        init_collections(docs)
+        return
+
+    encoder = ParallelEncoder(embedding_model, workers=workers)
+    doc_embedding_cache.set_encoder(encoder)
+    # 每批文本足够多，才能分给所有进程
+    pipeline.encode_batch_size = max(pipeline.encode_batch_size, 32 * workers)
+    try:
+        init_collections(docs)
+    finally:
+        doc_embedding_cache.set_encoder(embedding_model)
+        encoder.close()
+
+if __name__ == '__main__':
+    args = parse_args()
+    init_with_workers(args.workers, args.docs)
+    if args.rerank_model:
+        engine.reranker.set_cross_encoder(args.rerank_model, min_score=args.rerank_min_score)
+    app.run(debug=True, port=5000, use_reloader=False, threaded=True)
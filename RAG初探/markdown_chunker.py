@@ -0,0 +1,276 @@
+import re
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+# markdown 标题，例如 "#### 第一章 一般规定"
+_HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+# 法条开头，例如 "**第二百零四条** 为了明确物的归属……"
+_ARTICLE_PATTERN = re.compile(r"^\s*(?:\*\*)?(第[零〇一二两三四五六七八九十百千万\d]+条(?:之[一二三四五六七八九十]+)?)(?:\*\*)?[\s　]")
+# 句子边界：中文句末标点、换行之后，或英文句末标点及其后的空白之后（切分后直接拼接即可还原原文）
+_SENTENCE_PATTERN = re.compile(r"(?<=[。！？；\n])|(?<=[.!?;]\s)")
+_FENCE_PATTERN = re.compile(r"^\s*(```|~~~)")
+
+
+def count_embedding_tokens(text: str) -> int:
+    """
+    编码模型输入 token 数的上界
+
+    默认编码模型（albert 中文模型，最多 512 个位置）每个汉字切为一个 token，英文按子词切分，
+    token 数不超过字符数，因此按字符数计算可以保证文本块不会被截断
+    """
+    return len(text)
+
+
+class MarkdownChunker:
+    """
+    结构感知的 markdown 文档切分工具
+
+    功能：
+    - 按 markdown 标题（编、章、节等各级标题）划分章节，每个文本块只包含同一章节的内容，
+      并在开头附上标题路径，例如 "中华人民共和国民法典 > （二）物权编 > 第一章 一般规定"
+    - 章节内按法条（"第X条"）或段落划分单元，把相邻单元合并到 max_tokens 以内，法条不会被拆到两个文本块中
+    - token 数按编码模型计算（默认按字符数，见 count_embedding_tokens），而不是按大模型的 token 估算
+    - 单个单元超过 max_tokens 时按句子切分，相邻文本块之间保留 overlap_tokens 的重叠；
+      法条之间的边界是完整的语义边界，不再重叠
+    - 只有标题没有正文的章节不生成文本块，避免产生无意义的碎片
+    - 代码块作为整体处理，其中以 # 开头的注释不会被当作标题
+    - 每个文本块附带元数据：标题路径、包含的法条编号、在文档中的序号
+
+    使用示例：
+    >>> chunker = MarkdownChunker(max_tokens=480, overlap_tokens=50)
+    >>> for chunk in chunker.split(text):
+    ...     print(chunk["metadata"]["article_ids"], chunk["text"])
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 400,
+        overlap_tokens: int = 50,
+        min_tokens: int = 20,
+        heading_separator: str = " > ",
+        token_counter: Callable[[str], int] = count_embedding_tokens
+    ):
+        """
+        初始化切分工具
+
+        参数:
+        max_tokens: 每个文本块（含标题路径）的 token 上限，应小于编码模型的最大输入长度
+        overlap_tokens: 长单元被拆分时，相邻文本块之间重叠的 token 数
+        min_tokens: 正文少于该 token 数的章节与下一个同级章节合并（例如只有一个小标题的章节）
+        heading_separator: 标题路径中各级标题之间的分隔符
+        token_counter: 计算文本 token 数的函数，应与编码模型的分词方式一致，且结果不超过字符数
+        """
+        if overlap_tokens >= max_tokens:
+            raise ValueError("overlap_tokens 必须小于 max_tokens")
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.min_tokens = min_tokens
+        self.heading_separator = heading_separator
+        self.count_tokens = token_counter
+
+    def __repr__(self) -> str:
+        # 作为源数据指纹的一部分：切分参数变化时重新入库
+        return (
+            f"MarkdownChunker(max_tokens={self.max_tokens}, overlap_tokens={self.overlap_tokens}, "
+            f"min_tokens={self.min_tokens}, heading_separator={self.heading_separator!r}, "
+            f"token_counter={getattr(self.count_tokens, '__name__', self.count_tokens)})"
+        )
+
+    def __call__(self, text: str) -> Iterator[Dict[str, Any]]:
+        """可直接作为 IngestionPipeline 的 splitter 使用"""
+        return self.split(text)
+
+    def split(self, text: str) -> Iterator[Dict[str, Any]]:
+        """
+        切分整篇文档
+
+        参数:
+        text: markdown 文本
+
+        返回:
+        文本块的迭代器，每个文本块为 {"text": 文本, "metadata": {"headings", "article_ids", "chunk_index"}}
+        """
+        index = 0
+        for headings, units in self._merge_small_sections(self._sections(text)):
+            for body, article_ids in self._pack(headings, units):
+                prefix = self.heading_separator.join(headings)
+                yield {
+                    "text": f"{prefix}\n{body}" if prefix else body,
+                    "metadata": {
+                        "headings": prefix,
+                        "article_ids": article_ids,
+                        "chunk_index": index,
+                    },
+                }
+                index += 1
+
+    def _sections(self, text: str) -> Iterator[Tuple[List[str], List[Tuple[str, Optional[str]]]]]:
+        """
+        按标题划分章节
+
+        返回:
+        (标题路径, 单元列表) 的迭代器，单元为 (文本, 法条编号)，普通段落的法条编号为 None
+        """
+        stack: List[Tuple[int, str]] = []
+        units: List[Tuple[str, Optional[str]]] = []
+        lines: List[str] = []
+        article_id: Optional[str] = None
+        in_fence = False
+
+        def flush_unit():
+            nonlocal lines, article_id
+            unit = "\n".join(lines).strip()
+            if unit:
+                units.append((unit, article_id))
+            lines = []
+            article_id = None
+
+        for line in text.splitlines():
+            if _FENCE_PATTERN.match(line):
+                in_fence = not in_fence
+                lines.append(line)
+                continue
+            if in_fence:
+                lines.append(line)
+                continue
+
+            heading = _HEADING_PATTERN.match(line)
+            if heading:
+                flush_unit()
+                if units:
+                    yield [title for _, title in stack], units
+                    units = []
+                level = len(heading.group(1))
+                while stack and stack[-1][0] >= level:
+                    stack.pop()
+                stack.append((level, heading.group(2)))
+                continue
+
+            article = _ARTICLE_PATTERN.match(line)
+            if article:
+                flush_unit()
+                article_id = article.group(1)
+                lines.append(line)
+            elif not line.strip() and article_id is None:
+                # 普通段落以空行分隔；法条内部的空行不切断法条
+                flush_unit()
+            else:
+                lines.append(line)
+
+        flush_unit()
+        if units:
+            yield [title for _, title in stack], units
+
+    def _merge_small_sections(self, sections):
+        """正文过短的章节并入紧随其后的同级章节，标题路径取两者的公共前缀"""
+        pending = None
+        for headings, units in sections:
+            if pending is not None:
+                pending_headings, pending_units = pending
+                common = []
+                for a, b in zip(pending_headings, headings):
+                    if a != b:
+                        break
+                    common.append(a)
+                # 只在同一上级标题下合并，避免把不同编、章的内容混在一起
+                if len(common) >= max(len(pending_headings), len(headings)) - 1:
+                    # 被合并章节的小标题保留在正文中
+                    own_title = pending_headings[len(common):]
+                    merged_units = [(self.heading_separator.join(own_title), None)] if own_title else []
+                    merged_units += pending_units
+                    title = headings[len(common):]
+                    if title:
+                        merged_units.append((self.heading_separator.join(title), None))
+                    headings, units = common, merged_units + units
+                else:
+                    yield pending
+                pending = None
+            if sum(self.count_tokens(unit) for unit, _ in units) < self.min_tokens:
+                pending = (headings, units)
+            else:
+                yield headings, units
+        if pending is not None:
+            yield pending
+
+    def _pack(self, headings: List[str], units: List[Tuple[str, Optional[str]]]) -> Iterator[Tuple[str, List[str]]]:
+        """
+        把章节内的单元合并为不超过 max_tokens 的文本块
+
+        返回:
+        (正文, 法条编号列表) 的迭代器
+        """
+        budget = self.max_tokens - self.count_tokens(self.heading_separator.join(headings)) - 1
+        # 标题路径本身过长时至少为正文保留一半预算
+        budget = max(budget, self.max_tokens // 2)
+
+        # parts 中的片段直接拼接：整段单元自带结尾换行，句子保留原有的标点和空白
+        parts: List[str] = []
+        article_ids: List[str] = []
+        used = 0
+
+        def emit(overlap: bool) -> Tuple[str, List[str]]:
+            nonlocal parts, article_ids, used
+            result = ("".join(parts).strip(), article_ids)
+            parts = self._overlap_tail(parts) if overlap else []
+            article_ids = []
+            used = sum(self.count_tokens(part) for part in parts)
+            return result
+
+        for unit, article_id in units:
+            unit += "\n"
+            tokens = self.count_tokens(unit)
+            if tokens <= budget:
+                if used + tokens > budget:
+                    # 当前文本块放不下这个单元：普通段落之间保留重叠，法条从新文本块开头开始
+                    yield emit(overlap=article_id is None)
+                    if used + tokens > budget:
+                        parts, used = [], 0
+                parts.append(unit)
+                used += tokens
+                if article_id is not None and article_id not in article_ids:
+                    article_ids.append(article_id)
+                continue
+
+            # 单元本身超过预算：按句子拆分，相邻文本块之间保留重叠
+            if article_id is not None and parts:
+                yield emit(overlap=False)
+            for sentence in self._sentences(unit, budget):
+                sentence_tokens = self.count_tokens(sentence)
+                if used and used + sentence_tokens > budget:
+                    yield emit(overlap=True)
+                    # 重叠部分与新句子放不下时放弃重叠，保证不超过上限
+                    if used + sentence_tokens > budget:
+                        parts, used = [], 0
+                if article_id is not None and article_id not in article_ids:
+                    article_ids.append(article_id)
+                parts.append(sentence)
+                used += sentence_tokens
+
+        if parts:
+            yield emit(overlap=False)
+
+    def _overlap_tail(self, parts: List[str]) -> List[str]:
+        """取文本块末尾不超过 overlap_tokens 的若干句子，作为下一个文本块的开头"""
+        if self.overlap_tokens <= 0 or not parts:
+            return []
+        tail: List[str] = []
+        used = 0
+        for sentence in reversed(self._sentences("".join(parts), self.max_tokens)):
+            tokens = self.count_tokens(sentence)
+            if used + tokens > self.overlap_tokens:
+                break
+            tail.insert(0, sentence)
+            used += tokens
+        return tail
+
+    def _sentences(self, text: str, max_tokens: int) -> List[str]:
+        """按句子切分文本，单个句子超过 max_tokens 时按字符截断（token 数不超过字符数）"""
+        max_chars = max(max_tokens, 1)
+        sentences = []
+        for sentence in _SENTENCE_PATTERN.split(text):
+            if not sentence:
+                continue
+            if self.count_tokens(sentence) <= max_tokens:
+                sentences.append(sentence)
+            else:
+                sentences.extend(sentence[i:i + max_chars] for i in range(0, len(sentence), max_chars))
+        return sentences
@@ -0,0 +1,151 @@
+import json
+from typing import Any, List, Optional, Tuple
+
+from async_logger import get_logger
+
+log = get_logger("reranker")
+
+
+def _document_text(text: Any) -> str:
+    """交叉编码器只接受字符串，非字符串的文本（例如产品信息字典）序列化为 JSON"""
+    return text if isinstance(text, str) else json.dumps(text, ensure_ascii=False)
+
+
+class Reranker:
+    """
+    检索结果的后处理：重排序 + 相关度过滤
+
+    功能：
+    - 去掉得分低于阈值（min_score），或与最佳结果差距超过相对比例（relative_margin）的结果，
+      不相关的片段不再进入提示词
+    - 可选的本地交叉编码器（pymilvus 的 BGERerankFunction）：检索时先取更多候选，
+      再用交叉编码器对 (问题, 片段) 逐对打分重新排序，阈值按交叉编码器的得分计算
+    - 交叉编码器加载或打分失败时退化为只按检索得分过滤
+
+    得分约定：higher_is_better 为 True 时得分越大越相关（IP 距离、BM25、RRF 融合得分、交叉编码器得分），
+    为 False 时得分越小越相关（L2 距离）。
+
+    使用示例：
+    >>> reranker = Reranker(relative_margin=0.5, min_keep=1)
+    >>> hits = db.search("my_mfd_collection", question, top_k=reranker.candidate_count(3))
+    >>> hits = reranker.rerank(question, hits, top_k=3)
+    """
+
+    def __init__(
+        self,
+        min_score: Optional[float] = None,
+        relative_margin: Optional[float] = None,
+        min_keep: int = 0,
+        higher_is_better: bool = True,
+        candidate_factor: int = 3
+    ):
+        """
+        初始化
+
+        参数:
+        min_score: 绝对阈值，得分比它差的结果被丢弃（None 表示不限制）
+        relative_margin: 相对阈值，例如 0.2 表示只保留得分不低于最佳结果 80% 的结果（None 表示不限制）
+        min_keep: 至少保留的结果数（即使低于阈值），0 表示全部低于阈值时返回空列表
+        higher_is_better: 检索得分是否越大越相关
+        candidate_factor: 启用交叉编码器时，检索候选数为 top_k 的倍数
+        """
+        self.min_score = min_score
+        self.relative_margin = relative_margin
+        self.min_keep = min_keep
+        self.higher_is_better = higher_is_better
+        self.candidate_factor = candidate_factor
+        self.cross_encoder = None
+        # 交叉编码器得分的阈值与检索得分不同，在 set_cross_encoder 中单独设置
+        self.cross_min_score = None
+        self.cross_relative_margin = None
+
+    def set_cross_encoder(
+        self,
+        model_name: str = "BAAI/bge-reranker-v2-m3",
+        device: str = "cpu",
+        min_score: Optional[float] = None,
+        relative_margin: Optional[float] = None
+    ) -> bool:
+        """
+        加载本地交叉编码器（需要安装 pymilvus[model] 及 FlagEmbedding）
+
+        参数:
+        model_name: 模型名称或本地路径
+        device: 运行设备，例如 "cpu"、"cuda:0"
+        min_score: 交叉编码器得分的绝对阈值
+        relative_margin: 交叉编码器得分的相对阈值
+
+        返回:
+        是否加载成功
+        """
+        try:
+            from pymilvus import model as milvus_model
+            self.cross_encoder = milvus_model.reranker.BGERerankFunction(model_name=model_name, device=device)
+        except Exception as e:
+            log.warning("加载交叉编码器 %s 失败，只按检索得分过滤: %s", model_name, e)
+            self.cross_encoder = None
+            return False
+        self.cross_min_score = min_score
+        self.cross_relative_margin = relative_margin
+        log.info("已加载交叉编码器: %s", model_name)
+        return True
+
+    def candidate_count(self, top_k: int) -> int:
+        """检索时应取的候选数：启用交叉编码器时放大到 top_k 的 candidate_factor 倍"""
+        return top_k * self.candidate_factor if self.cross_encoder is not None else top_k
+
+    def rerank(self, query: str, hits: List[Tuple[Any, float]], top_k: int) -> List[Tuple[Any, float]]:
+        """
+        对检索结果重排序并过滤
+
+        参数:
+        query: 问题文本
+        hits: 检索结果，(text, 得分) 元组列表，按相关度从高到低排列
+        top_k: 最多返回的结果数
+
+        返回:
+        过滤后的 (text, 得分) 元组列表；启用交叉编码器时得分为交叉编码器得分
+        """
+        if not hits:
+            return []
+
+        if self.cross_encoder is not None:
+            try:
+                scored = self.cross_encoder(query, [_document_text(text) for text, _ in hits], top_k=len(hits))
+                hits = [(hits[result.index][0], float(result.score)) for result in scored]
+                return self._filter(hits, top_k, self.cross_min_score, self.cross_relative_margin, True)
+            except Exception as e:
+                log.error("交叉编码器打分失败，只按检索得分过滤: %s", e)
+
+        return self._filter(hits, top_k, self.min_score, self.relative_margin, self.higher_is_better)
+
+    def _filter(
+        self,
+        hits: List[Tuple[Any, float]],
+        top_k: int,
+        min_score: Optional[float],
+        relative_margin: Optional[float],
+        higher_is_better: bool
+    ) -> List[Tuple[Any, float]]:
+        """按绝对阈值和相对阈值过滤，hits 需按相关度从高到低排列"""
+        hits = hits[:top_k]
+        best = hits[0][1]
+
+        def relevant(score: float) -> bool:
+            if min_score is not None and (score < min_score if higher_is_better else score > min_score):
+                return False
+            if relative_margin is not None:
+                # 与最佳结果的差距按最佳得分的绝对值计算，得分为负数时同样适用
+                limit = abs(best) * relative_margin
+                if higher_is_better and score < best - limit:
+                    return False
+                if not higher_is_better and score > best + limit:
+                    return False
+            return True
+
+        kept = [hit for hit in hits if relevant(hit[1])]
+        if len(kept) < self.min_keep:
+            kept = hits[:self.min_keep]
+        if len(kept) < len(hits):
+            log.debug("相关度过滤：保留 %d / %d 个检索结果", len(kept), len(hits))
+        return kept
@@ -0,0 +1,115 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+
+def context_fingerprint(context: str) -> str:
+    """计算检索上下文的指纹，上下文发生变化时缓存的答案不再可用"""
+    return hashlib.sha1(context.encode("utf-8")).hexdigest()
+
+
+class SemanticAnswerCache:
+    """
+    语义答案缓存
+
+    功能：
+    - 保存问题向量、答案以及检索上下文指纹
+    - 新问题与缓存问题的余弦相似度不低于阈值，且上下文指纹一致时，直接返回缓存的答案
+    - 超过容量时淘汰最久未使用的条目
+    - 记录命中 / 未命中次数
+
+    使用示例：
+    >>> cache = SemanticAnswerCache(threshold=0.95, maxsize=512)
+    >>> cache.put(question_vector, fingerprint, answer)
+    >>> cache.lookup(question_vector, fingerprint)
+    """
+
+    def __init__(self, threshold: float = 0.95, maxsize: int = 512):
+        """
+        初始化语义缓存
+
+        参数:
+        threshold: 命中所需的最小余弦相似度
+        maxsize: 最大条目数
+        """
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._next_id = 0
+        # 条目 id -> (归一化问题向量, 上下文指纹, 答案)，按使用顺序排列
+        self._entries = OrderedDict()
+        # 上下文指纹 -> 条目 id 集合，查找时只比较上下文相同的条目
+        self._by_fingerprint = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def lookup(self, question_vector, fingerprint: str) -> Optional[str]:
+        """
+        查找语义相近且上下文一致的缓存答案
+
+        参数:
+        question_vector: 问题向量
+        fingerprint: 检索上下文指纹
+
+        返回:
+        缓存的答案，未命中时返回 None
+        """
+        query = self._normalize(question_vector)
+        with self._lock:
+            entry_ids = list(self._by_fingerprint.get(fingerprint, ()))
+            if entry_ids:
+                vectors = np.stack([self._entries[i][0] for i in entry_ids])
+                scores = vectors @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    entry_id = entry_ids[best]
+                    self._entries.move_to_end(entry_id)
+                    self.hits += 1
+                    return self._entries[entry_id][2]
+            self.misses += 1
+            return None
+
+    def put(self, question_vector, fingerprint: str, answer: str):
+        """
+        写入缓存，超过容量时淘汰最久未使用的条目
+
+        参数:
+        question_vector: 问题向量
+        fingerprint: 检索上下文指纹
+        answer: 答案
+        """
+        vector = self._normalize(question_vector)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (vector, fingerprint, answer)
+            self._by_fingerprint.setdefault(fingerprint, set()).add(entry_id)
+
+            while len(self._entries) > self.maxsize:
+                old_id, (_, old_fingerprint, _) = self._entries.popitem(last=False)
+                ids = self._by_fingerprint[old_fingerprint]
+                ids.discard(old_id)
+                if not ids:
+                    del self._by_fingerprint[old_fingerprint]
+
+    def stats(self) -> Dict[str, Any]:
+        """返回缓存统计信息"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
@@ -1,11 +1,9 @@
 import os
 from pymilvus import model as milvus_model
 
+# API Key 只在使用 OpenAI 兼容的编码模型时需要，DeepSeek 的 Key 由 conversation.py 检查
 api_key = os.getenv("DEEPSEEK_API_KEY")
-if not api_key:
-    raise ValueError("请设置 DEEPSEEK_API_KEY 环境变量")
 
-print(api_key)
 embedding_model = milvus_model.DefaultEmbeddingFunction()
 # embedding_model = milvus_model.dense.OpenAIEmbeddingFunction(
 #     model_name='text-embedding-3-large', # Specify the model name
@@ -1,4 +1,9 @@
 import os
+import hashlib
+import json
+import threading
+import time
+import uuid
 
 import numpy as np
 from typing import List, Dict, Any, Tuple, Optional
@@ -12,7 +17,81 @@ from pymilvus import (
 from pymilvus import MilvusClient
 from pymilvus import model as milvus_model
 
+import metrics
+from async_logger import get_logger
 from utils import embedding_model
+from lru_cache import LRUCache
+from bm25_index import BM25Index, reciprocal_rank_fusion
+from vector_store import (
+    VectorStore, MilvusVectorStore, NumpyVectorStore,
+    SnapshotTexts, SnapshotWriter, read_snapshot_meta, write_snapshot_meta
+)
+
+
+log = get_logger("vector_db")
+
+
+def stable_id(key: str) -> int:
+    """根据内容键生成稳定的 int64 主键，同一内容在每次启动时得到相同的 id"""
+    digest = hashlib.sha1(key.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") & 0x7FFFFFFFFFFFFFFF
+
+
+def row_hash(row: Dict[str, Any]) -> str:
+    """计算一行数据（不含向量）的内容哈希，用于判断是否发生变化"""
+    content = {k: v for k, v in row.items() if k not in ("id", "vector")}
+    return hashlib.sha1(
+        json.dumps(content, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def source_fingerprint(paths: List[str] = (), extra: Any = None) -> str:
+    """
+    根据源文件的路径、大小、修改时间（以及额外的源数据）计算指纹，不读取文件内容
+
+    参数:
+    paths: 源文件路径列表（目录会递归展开为其中的所有文件）
+    extra: 额外参与计算的源数据（需可 JSON 序列化），例如代码中定义的映射表
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+        else:
+            files.append(path)
+    stats = []
+    for path in sorted(files):
+        st = os.stat(path)
+        stats.append([path, st.st_size, st.st_mtime_ns])
+    return hashlib.sha1(
+        json.dumps([stats, extra], ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def scalar_filter(**conditions: Any) -> str:
+    """
+    根据字段取值构造 Milvus 过滤表达式，多个条件之间为 and 关系
+
+    字符串或数字生成 `field == value`，列表生成 `field in [...]`，取值为 None 的条件被忽略。
+    更复杂的条件（例如 array_contains(product_categories, "electronics")）可直接书写表达式。
+
+    使用示例：
+    >>> scalar_filter(product_name="深海蓝藻保湿面膜")
+    'product_name == "深海蓝藻保湿面膜"'
+    """
+    def literal(value: Any) -> str:
+        return json.dumps(value, ensure_ascii=False) if isinstance(value, str) else str(value)
+
+    clauses = []
+    for field, value in conditions.items():
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple, set)):
+            clauses.append(f"{field} in [{', '.join(literal(v) for v in value)}]")
+        else:
+            clauses.append(f"{field} == {literal(value)}")
+    return " and ".join(clauses)
+
 
 class LocalMilvusDB:
     """
@@ -24,6 +103,10 @@ class LocalMilvusDB:
     - 插入向量数据
     - 执行向量搜索
     - 数据持久化到本地文件
+    - 数据量不超过 local_max_rows 的集合在进程内用 NumPy 检索，省去 Milvus 客户端往返
+    - 同步后写入内存映射的快照（向量 .npy + 按偏移量索引的文本块），源数据未变化时启动直接加载快照
+    - 同步后为进程内检索的集合建立 BM25 倒排索引（随快照保存），支持关键词检索以及与向量检索的混合检索
+    - 集合可声明标量字段（可建标量索引、可作为分区键），检索时按过滤表达式过滤，精确匹配可直接做标量查询
     
     使用示例：
     >>> db = LocalMilvusDB(persist_path="./milvus_data")
@@ -33,14 +116,49 @@ class LocalMilvusDB:
     >>> results = db.search("my_collection", np.random.rand(128).tolist(), top_k=5)
     """
     
-    def __init__(self, persist_path: str = "./milvus_data"):
+    SEARCH_MODES = ("vector", "bm25", "hybrid")
+
+    def __init__(
+        self,
+        persist_path: str = "./milvus_data",
+        query_cache_size: int = 1024,
+        query_cache_ttl: Optional[float] = 3600,
+        local_max_rows: int = 50000,
+        snapshot_dir: Optional[str] = None,
+        hybrid_candidates: int = 20,
+        ivf_min_rows: Optional[int] = None,
+        nprobe: int = 8
+    ):
         """
         初始化本地 Milvus 数据库
         
         参数:
         persist_path: 数据持久化存储路径
+        query_cache_size: 查询向量缓存的最大条目数
+        query_cache_ttl: 查询向量缓存的过期秒数（None 表示不过期）
+        local_max_rows: 使用进程内 NumPy 检索的最大集合行数（0 表示始终使用 Milvus）
+        snapshot_dir: 向量快照目录（默认为 persist_path + ".snapshots"）
+        hybrid_candidates: 混合检索时向量检索和 BM25 检索各自取的候选数
+        ivf_min_rows: 进程内检索的集合达到该行数时建立 IVF 索引做近似检索（None 表示始终精确检索）
+        nprobe: IVF 检索时搜索的簇数，越大召回率越高、越慢
         """
         self.persist_path = persist_path
+        # 缓存问题文本对应的查询向量，重复的问题无需再次经过编码模型
+        self.query_cache = LRUCache(maxsize=query_cache_size, ttl=query_cache_ttl)
+        # 记录每个集合中已存储的 id 及其内容哈希，用于增量同步
+        self.manifest_path = f"{persist_path}.manifest.json"
+        self.snapshot_dir = snapshot_dir or f"{persist_path}.snapshots"
+        self.manifest = self._load_manifest()
+        # 集合名 -> 检索使用的向量存储（NumPy 或 Milvus），按集合大小自动选择
+        self.local_max_rows = local_max_rows
+        self.hybrid_candidates = hybrid_candidates
+        self.ivf_min_rows = ivf_min_rows
+        self.nprobe = nprobe
+        self._stores = {}
+        self._stores_lock = threading.Lock()
+        # 集合名 -> (建立索引时的文本序列, BM25 索引)，文本序列被替换（重新同步）后索引失效
+        self._lexical = {}
+        self._lexical_lock = threading.Lock()
         print("即将初始化")
         # 连接到本地 Milvus 实例
         self._connect()
@@ -53,12 +171,31 @@ class LocalMilvusDB:
         except Exception as e:
             print(f"创建 Milvus 失败: {e}")
             raise
+
+    def _load_manifest(self) -> Dict[str, Any]:
+        """加载集合清单"""
+        if not os.path.exists(self.manifest_path):
+            return {}
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"读取集合清单失败，将全量重建集合: {e}")
+            return {}
+
+    def _save_manifest(self):
+        """保存集合清单（先写临时文件再替换，避免写入中断导致清单损坏）"""
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self.manifest_path)
     
     def create_collection(
         self, 
         collection_name: str, 
         dimension: int, 
-        metric_type: str = "IP"
+        metric_type: str = "IP",
+        scalar_fields: Optional[Dict[str, Dict[str, Any]]] = None
     ) -> bool:
         """
         创建新的集合
@@ -67,6 +204,12 @@ class LocalMilvusDB:
         collection_name: 集合名称
         dimension: 向量维度
         metric_type: 距离度量类型（"L2" 或 "IP"）
+        scalar_fields: 标量字段定义（可选），字段名 -> 定义，定义中可包含：
+            - type: pymilvus DataType 名称，例如 "VARCHAR"、"INT64"、"ARRAY"
+            - index: 标量索引类型，例如 "INVERTED"（精确查询和过滤不再逐行扫描）
+            - partition_key: 是否作为分区键（按该字段过滤时只检索对应的分区）
+            - 其余键（max_length、element_type、max_capacity 等）原样传给 add_field
+            不声明的字段（包括 text）作为动态字段存储
         
         返回:
         是否创建成功
@@ -75,8 +218,23 @@ class LocalMilvusDB:
         if self.milvus_client.has_collection(collection_name):
             print(f"集合 '{collection_name}' 已存在，即将删除并重新创建")
             self.milvus_client.drop_collection(collection_name)
+        if self.manifest.pop(collection_name, None) is not None:
+            self._save_manifest()
+        self._stores.pop(collection_name, None)
+        self._lexical.pop(collection_name, None)
         
         
+        if scalar_fields:
+            try:
+                self._create_collection_with_schema(collection_name, dimension, metric_type, scalar_fields)
+                print(f"成功创建集合 '{collection_name}'，维度: {dimension}，标量字段: {list(scalar_fields)}")
+                return True
+            except Exception as e:
+                # 例如当前 Milvus 版本不支持分区键：标量字段改为动态字段存储，过滤表达式仍然可用
+                print(f"按标量字段定义创建集合失败，改用动态字段: {e}")
+                if self.milvus_client.has_collection(collection_name):
+                    self.milvus_client.drop_collection(collection_name)
+
         try:
             # 创建集合
             self.milvus_client.create_collection(
@@ -91,6 +249,37 @@ class LocalMilvusDB:
         except Exception as e:
             print(f"创建集合失败: {e}")
             return False
+
+    def _create_collection_with_schema(
+        self,
+        collection_name: str,
+        dimension: int,
+        metric_type: str,
+        scalar_fields: Dict[str, Dict[str, Any]]
+    ):
+        """按标量字段定义显式创建 schema、向量索引和标量索引"""
+        schema = MilvusClient.create_schema(auto_id=False, enable_dynamic_field=True)
+        schema.add_field(field_name="id", datatype=DataType.INT64, is_primary=True)
+        schema.add_field(field_name="vector", datatype=DataType.FLOAT_VECTOR, dim=dimension)
+        index_params = self.milvus_client.prepare_index_params()
+        index_params.add_index(field_name="vector", index_type="AUTOINDEX", metric_type=metric_type)
+        for name, spec in scalar_fields.items():
+            spec = dict(spec)
+            datatype = getattr(DataType, spec.pop("type"))
+            index_type = spec.pop("index", None)
+            if "element_type" in spec:
+                spec["element_type"] = getattr(DataType, spec["element_type"])
+            if spec.pop("partition_key", False):
+                spec["is_partition_key"] = True
+            schema.add_field(field_name=name, datatype=datatype, **spec)
+            if index_type:
+                index_params.add_index(field_name=name, index_type=index_type)
+        self.milvus_client.create_collection(
+            collection_name=collection_name,
+            schema=schema,
+            index_params=index_params,
+            consistency_level="Strong",
+        )
     
     def insert(
         self, 
@@ -109,65 +298,462 @@ class LocalMilvusDB:
         是否插入成功
         """
         if not self.milvus_client.has_collection(collection_name):
-            print(f"集合 '{collection_name}' 不存在")
+            log.warning("集合 '%s' 不存在", collection_name)
             return False
         
         try:
             self.milvus_client.insert(collection_name=collection_name, data=data)
-            print(f"成功插入 {data} 到 '{collection_name}'")
+            # 进程内的向量存储在下次检索时重新加载，已有的快照不再与集合一致
+            self._stores.pop(collection_name, None)
+            entry = self.manifest.get(collection_name)
+            if entry is not None and entry.pop("revision", None) is not None:
+                self._save_manifest()
+            # 只记录条数：整行数据包含完整的向量，打印会拖慢入库
+            log.info("成功插入 %d 条到 '%s'", len(data), collection_name)
             return True
         except Exception as e:
-            print(f"插入数据失败: {e}")
+            log.error("插入数据失败: %s", e)
             return False
     
+    def begin_sync(
+        self,
+        collection_name: str,
+        dimension: int,
+        metric_type: str = "IP",
+        source: Optional[str] = None,
+        scalar_fields: Optional[Dict[str, Dict[str, Any]]] = None
+    ) -> "CollectionSync":
+        """
+        开始一次流式增量同步：调用方分批 add 数据，全部提交后调用 finish
+
+        参数:
+        collection_name: 集合名称
+        dimension: 向量维度
+        metric_type: 距离度量类型（"L2" 或 "IP"）
+        source: 源数据指纹（可选，见 source_fingerprint），记录到快照中供下次启动时比较
+        scalar_fields: 标量字段定义（可选，见 create_collection），定义变化时全量重建集合
+
+        返回:
+        同步会话
+        """
+        return CollectionSync(self, collection_name, dimension, metric_type, source, scalar_fields)
+
+    def sync_collection(
+        self,
+        collection_name: str,
+        dimension: int,
+        rows: List[Dict[str, Any]],
+        metric_type: str = "IP",
+        source: Optional[str] = None,
+        scalar_fields: Optional[Dict[str, Dict[str, Any]]] = None
+    ) -> bool:
+        """
+        将源数据增量同步到集合中，只插入新增、更新变化、删除移除的数据，并写入向量快照
+
+        参数:
+        collection_name: 集合名称
+        dimension: 向量维度
+        rows: 数据行列表，每行需包含 'key'（内容键，用于生成稳定 id）、'vector' 和 'text'，其余字段作为标量字段或动态字段写入
+        metric_type: 距离度量类型（"L2" 或 "IP"）
+        source: 源数据指纹（可选，见 source_fingerprint），记录到快照中供下次启动时比较
+        scalar_fields: 标量字段定义（可选，见 create_collection）
+
+        返回:
+        是否同步成功
+        """
+        sync = self.begin_sync(collection_name, dimension, metric_type, source, scalar_fields)
+        return sync.add(rows) and sync.finish()
+
+    def _set_store(self, collection_name: str, metric_type: str, store: NumpyVectorStore):
+        """根据数据量为集合选择检索后端：小集合使用 NumPy 存储，大集合使用 Milvus"""
+        if len(store) > self.local_max_rows:
+            store = MilvusVectorStore(self.milvus_client, collection_name, metric_type)
+            log.info("集合 '%s' 数据量超过 %d 条，使用 Milvus 检索", collection_name, self.local_max_rows)
+        else:
+            log.info("集合 '%s' 共 %d 条，使用进程内 NumPy 检索", collection_name, len(store))
+        self._stores[collection_name] = store
+
+    def _snapshot_path(self, collection_name: str) -> str:
+        return os.path.join(self.snapshot_dir, collection_name)
+
+    def load_snapshot(self, collection_name: str, source: Optional[str] = None) -> bool:
+        """
+        从快照加载集合的检索后端：向量和文本以内存映射方式打开，按需读入，不为每行创建 Python 对象
+
+        只有快照与集合清单的版本一致、且源数据指纹未变化（传入 source 时）才会加载，
+        此时调用方可以跳过读取源文件、编码和同步。
+
+        参数:
+        collection_name: 集合名称
+        source: 当前源数据指纹（可选）
+
+        返回:
+        是否加载成功
+        """
+        entry = self.manifest.get(collection_name)
+        meta = read_snapshot_meta(self._snapshot_path(collection_name))
+        if (
+            entry is None
+            or meta is None
+            or meta.get("revision") != entry.get("revision")
+            or (source is not None and meta.get("source") != source)
+            or not self.milvus_client.has_collection(collection_name)
+        ):
+            return False
+
+        path = self._snapshot_path(collection_name)
+        try:
+            ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+            vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+            offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+            blob_path = os.path.join(path, "texts.bin")
+            # 空文件无法内存映射
+            blob = np.memmap(blob_path, dtype=np.uint8, mode="r") if os.path.getsize(blob_path) else np.empty(0, np.uint8)
+        except (OSError, ValueError) as e:
+            print(f"读取向量快照失败: {e}")
+            return False
+        if len(ids) != meta.get("rows") or vectors.shape != (len(ids), meta.get("dimension")):
+            print(f"集合 '{collection_name}' 的向量快照不完整，忽略")
+            return False
+
+        texts = SnapshotTexts(blob, offsets, meta.get("text_encoding", "utf-8"))
+        metric_type = meta.get("metric_type", "IP")
+        self._set_store(collection_name, metric_type, NumpyVectorStore.from_arrays(
+            ids, vectors, texts, metric_type, ivf_min_rows=self.ivf_min_rows, nprobe=self.nprobe
+        ))
+        print(f"已从快照加载集合 '{collection_name}'（{len(ids)} 条）")
+        return True
+
+    def _load_store(self, collection_name: str, metric_type: str) -> VectorStore:
+        """为本进程未同步过的集合选择检索后端：优先加载快照，否则小集合从 Milvus 读出全部数据构建 NumPy 存储"""
+        if self.load_snapshot(collection_name):
+            return self._stores[collection_name]
+        milvus_store = MilvusVectorStore(self.milvus_client, collection_name, metric_type)
+        try:
+            row_count = len(milvus_store)
+            if row_count == 0 or row_count > self.local_max_rows:
+                return milvus_store
+            rows = self.milvus_client.query(
+                collection_name=collection_name,
+                filter="",
+                output_fields=["id", "vector", "text"],
+                limit=row_count,
+            )
+            if len(rows) != row_count:
+                return milvus_store
+            store = NumpyVectorStore(len(rows[0]["vector"]), metric_type, ivf_min_rows=self.ivf_min_rows, nprobe=self.nprobe)
+            store.upsert([row["id"] for row in rows], [row["vector"] for row in rows], [row["text"] for row in rows])
+            print(f"集合 '{collection_name}' 共 {row_count} 条，已加载到进程内 NumPy 检索")
+            return store
+        except Exception as e:
+            print(f"加载集合 '{collection_name}' 到内存失败，使用 Milvus 检索: {e}")
+            return milvus_store
+
+    def get_store(self, collection_name: str, metric_type: str = "IP") -> VectorStore:
+        """
+        获取集合的检索后端
+
+        参数:
+        collection_name: 集合名称
+        metric_type: 距离度量类型，与集合创建时的度量不一致时使用 Milvus
+
+        返回:
+        向量存储
+        """
+        store = self._stores.get(collection_name)
+        if store is None:
+            with self._stores_lock:
+                store = self._stores.get(collection_name)
+                if store is None:
+                    store = self._load_store(collection_name, metric_type)
+                    self._stores[collection_name] = store
+        if store.metric_type != metric_type:
+            return MilvusVectorStore(self.milvus_client, collection_name, metric_type)
+        return store
+
+    def get_lexical_index(self, collection_name: str, store: VectorStore) -> Optional[Tuple[Any, BM25Index]]:
+        """
+        获取集合的 BM25 索引：优先使用内存中的索引，其次从快照目录加载，都没有时重新分词建立（并保存到快照目录）
+
+        参数:
+        collection_name: 集合名称
+        store: 集合当前的检索后端
+
+        返回:
+        (建立索引时的文本序列, BM25 索引)；使用 Milvus 检索的大集合没有 BM25 索引，返回 None
+        """
+        if not isinstance(store, NumpyVectorStore):
+            return None
+        texts = store.arrays[2]
+        cached = self._lexical.get(collection_name)
+        if cached is not None and cached[0] is texts:
+            return cached
+
+        with self._lexical_lock:
+            cached = self._lexical.get(collection_name)
+            if cached is not None and cached[0] is texts:
+                return cached
+
+            index = None
+            path = self._snapshot_path(collection_name)
+            # 只有快照中的文本才能与快照目录中保存的索引对应
+            revision = None
+            if isinstance(texts, SnapshotTexts):
+                revision = (read_snapshot_meta(path) or {}).get("revision")
+                if revision:
+                    index = BM25Index.load(path, revision)
+            if index is None or len(index) != len(texts):
+                start = time.monotonic()
+                index = BM25Index.build(texts)
+                print(f"集合 '{collection_name}' 的 BM25 索引已建立（{len(texts)} 条，用时 {time.monotonic() - start:.1f} 秒）")
+                if revision:
+                    try:
+                        index.save(path, revision)
+                    except OSError as e:
+                        print(f"保存 BM25 索引失败: {e}")
+            else:
+                print(f"已从快照加载集合 '{collection_name}' 的 BM25 索引")
+
+            cached = (texts, index)
+            self._lexical[collection_name] = cached
+            return cached
+
+    def encode_queries(self, questions: List[str]) -> List[np.ndarray]:
+        """
+        批量将问题编码为查询向量，缓存未命中的问题合并为一次编码调用
+
+        参数:
+        questions: 问题文本列表
+
+        返回:
+        与 questions 顺序一致的查询向量列表
+        """
+        vectors = {}
+        missing = []
+        for question in dict.fromkeys(questions):
+            vector = self.query_cache.get(question)
+            if vector is None:
+                missing.append(question)
+            else:
+                vectors[question] = vector
+
+        if missing:
+            with metrics.span("encode_queries"):
+                encoded = embedding_model.encode_queries(missing)
+            for question, vector in zip(missing, encoded):
+                vector = np.asarray(vector, dtype=np.float32)
+                vector.setflags(write=False)
+                self.query_cache.put(question, vector)
+                vectors[question] = vector
+
+        return [vectors[question] for question in questions]
+
+    def encode_query(self, question: str) -> np.ndarray:
+        """
+        将问题编码为查询向量，优先从缓存读取
+
+        参数:
+        question: 问题文本
+
+        返回:
+        查询向量
+        """
+        return self.encode_queries([question])[0]
+
+    def query_cache_stats(self) -> Dict[str, Any]:
+        """返回查询向量缓存的命中统计"""
+        return self.query_cache.stats()
+
     def search(
         self, 
         collection_name: str, 
         question: str,
         metric_type: str = "IP",
-        top_k: int = 3
+        top_k: int = 3,
+        mode: str = "vector",
+        filter: str = ""
     ) -> List[Dict]:
         """
-        执行向量搜索
+        检索单个问题，见 search_many
         
         参数:
         collection_name: 集合名称
-        query_vector: 查询向量（浮点数列表）
+        question: 问题文本
+        metric_type: 距离度量类型（"L2" 或 "IP"）
         top_k: 返回的最相似结果数量
-        output_fields: 返回的元数据字段（可选）
+        mode: 检索模式（"vector" / "bm25" / "hybrid"）
+        filter: Milvus 过滤表达式（可选），带过滤条件时只支持向量检索
         
         返回:
-        结果字典列表，每个字典包含:
-        - 'id': 向量ID
-        - 'distance': 距离
-        - 'metadata': 元数据字典
+        (text, 得分) 元组列表，按相关度从高到低排列。得分的含义随检索模式不同，不能跨模式比较：
+        - "vector": IP 为内积（越大越相似），L2 为欧氏距离的平方（越小越相似）
+        - "bm25": BM25 得分（越大越相关）
+        - "hybrid": 倒数排名融合（RRF）得分，只与排名有关，数值远小于前两者
+        按得分设置相对阈值的过滤（如 Reranker 的 relative_margin）需要按检索模式分别调整
         """
-        if not self.milvus_client.has_collection(collection_name):
-            print(f"集合 '{collection_name}' 不存在")
+        return self.search_many(collection_name, [question], top_k, metric_type, mode, filter)[0]
+
+    def search_many(
+        self,
+        collection_name: str,
+        questions: List[str],
+        top_k: int = 3,
+        metric_type: str = "IP",
+        mode: str = "vector",
+        filter: str = ""
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        批量执行向量搜索：所有问题合并为一次编码调用和一次检索（小集合在进程内检索，大集合使用 Milvus）
+
+        参数:
+        collection_name: 集合名称
+        questions: 问题文本列表
+        top_k: 每个问题返回的最相似结果数量
+        metric_type: 距离度量类型（"L2" 或 "IP"）
+        mode: 检索模式
+            - "vector": 向量检索，得分为距离
+            - "bm25": 关键词检索，得分为 BM25 得分
+            - "hybrid": 向量检索与关键词检索各取 hybrid_candidates 个候选，按倒数排名融合（RRF），得分为融合得分
+            没有 BM25 索引的集合（使用 Milvus 检索的大集合）在 "bm25" / "hybrid" 模式下退化为向量检索
+        filter: Milvus 过滤表达式（可选，可用 scalar_filter 构造），例如按产品分类过滤；
+            带过滤条件的检索由 Milvus 执行（条件包含分区键时只检索对应的分区），只支持向量检索
+
+        返回:
+        与 questions 顺序一致的结果列表，每项为 (text, 得分) 元组列表
+        """
+        if mode not in self.SEARCH_MODES:
+            raise ValueError(f"不支持的检索模式: {mode}，可选值为 {self.SEARCH_MODES}")
+        if not questions:
             return []
-        
+
+        if not self.milvus_client.has_collection(collection_name):
+            log.warning("集合 '%s' 不存在", collection_name)
+            return [[] for _ in questions]
+
         try:
-           
-            search_res = self.milvus_client.search(
-                            collection_name=collection_name,
-                            data=embedding_model.encode_queries(
-                                [question]
-                            ),  # 将问题转换为嵌入向量
-                            limit=top_k,  # 返回前3个结果
-                            search_params={"metric_type": metric_type, "params": {}},  # 内积距离
-                            output_fields=["text"],  # 返回 text 字段
-                            )
-            
-            retrieved_lines_with_distances = [
-                (res["entity"]["text"], res["distance"]) for res in search_res[0]
-            ]
-            print(f"在 '{collection_name}' 中找到 {len(retrieved_lines_with_distances)} 个结果")
-            return retrieved_lines_with_distances
+            if filter:
+                if mode != "vector":
+                    log.warning("带过滤条件的检索只支持向量检索，忽略检索模式 %s", mode)
+                store = MilvusVectorStore(self.milvus_client, collection_name, metric_type)
+                query_vectors = self.encode_queries(questions)
+                with metrics.span("milvus_search"):
+                    results = store.search(query_vectors, top_k, filter=filter)
+                log.debug("在 '%s' 中为 %d 个问题找到 %s 个结果（过滤条件: %s）", collection_name, len(questions), [len(r) for r in results], filter)
+                return results
+
+            store = self.get_store(collection_name, metric_type)
+            lexical = None
+            if mode != "vector":
+                lexical = self.get_lexical_index(collection_name, store)
+                if lexical is None:
+                    log.warning("集合 '%s' 没有 BM25 索引，改用向量检索", collection_name)
+                    mode = "vector"
+
+            if mode == "vector":
+                # 将问题批量转换为嵌入向量（带缓存），每个问题返回前 top_k 个结果
+                query_vectors = self.encode_queries(questions)
+                with metrics.span("vector_search"):
+                    results = store.search(query_vectors, top_k)
+            elif mode == "bm25":
+                texts, index = lexical
+                with metrics.span("bm25_search"):
+                    hits_list = index.search(questions, top_k)
+                results = [[(texts[i], score) for i, score in hits] for hits in hits_list]
+            else:
+                results = self._hybrid_search(store, lexical, questions, top_k)
+            log.debug("在 '%s' 中为 %d 个问题找到 %s 个结果（%s）", collection_name, len(questions), [len(r) for r in results], mode)
+            return results
         except Exception as e:
-            print(f"搜索失败: {e}")
-            return []
+            log.error("搜索失败: %s", e)
+            return [[] for _ in questions]
     
     
+    def query(
+        self,
+        collection_name: str,
+        filter: str,
+        output_fields: Optional[List[str]] = None,
+        limit: int = 16
+    ) -> List[Dict[str, Any]]:
+        """
+        标量查询：按过滤表达式直接取出匹配的行，不经过向量编码和向量检索（字段有标量索引时不逐行扫描）
+
+        参数:
+        collection_name: 集合名称
+        filter: Milvus 过滤表达式，例如 scalar_filter(product_name="深海蓝藻保湿面膜")
+        output_fields: 返回的字段（默认只返回 text）
+        limit: 最多返回的行数
+
+        返回:
+        匹配的行（字典）列表，查询失败时返回空列表
+        """
+        if not self.milvus_client.has_collection(collection_name):
+            log.warning("集合 '%s' 不存在", collection_name)
+            return []
+        try:
+            with metrics.span("scalar_query"):
+                rows = self.milvus_client.query(
+                    collection_name=collection_name,
+                    filter=filter,
+                    output_fields=output_fields or ["text"],
+                    limit=limit,
+                )
+            log.debug("在 '%s' 中按条件 %s 查询到 %d 条", collection_name, filter, len(rows))
+            return rows
+        except Exception as e:
+            log.error("标量查询失败: %s", e)
+            return []
+
+    def get_texts(self, collection_name: str, keys: List[str], metric_type: str = "IP") -> List[Optional[str]]:
+        """
+        按内容键（同步时的 key）取出文本：集合已加载到进程内时直接按主键查找，不经过 Milvus 和向量检索，
+        否则按主键做一次标量查询
+
+        参数:
+        collection_name: 集合名称
+        keys: 内容键列表，例如产品名
+        metric_type: 距离度量类型，见 get_store
+
+        返回:
+        与 keys 顺序一致的文本列表，不存在的键对应 None
+        """
+        ids = [stable_id(key) for key in keys]
+        store = self._stores.get(collection_name)
+        if store is None:
+            if not self.milvus_client.has_collection(collection_name):
+                log.warning("集合 '%s' 不存在", collection_name)
+                return [None for _ in keys]
+            store = self.get_store(collection_name, metric_type)
+        if isinstance(store, NumpyVectorStore):
+            return store.get(ids)
+        rows = self.query(collection_name, f"id in {ids}", output_fields=["id", "text"], limit=len(ids))
+        texts = {row["id"]: row["text"] for row in rows}
+        return [texts.get(row_id) for row_id in ids]
+
+    def _hybrid_search(
+        self,
+        store: NumpyVectorStore,
+        lexical: Tuple[Any, BM25Index],
+        questions: List[str],
+        top_k: int
+    ) -> List[List[Tuple[str, float]]]:
+        """向量检索与 BM25 检索分别取候选，按行号做倒数排名融合"""
+        candidates = max(top_k, self.hybrid_candidates)
+        query_vectors = self.encode_queries(questions)
+        with metrics.span("vector_search"):
+            texts, dense = store.search_rows(query_vectors, candidates)
+        index_texts, index = lexical
+        if texts is not index_texts:
+            # 检索期间集合被重新同步，行号已无法与 BM25 索引对应，本次只使用向量检索结果
+            return [[(texts[i], distance) for i, distance in hits[:top_k]] for hits in dense]
+        with metrics.span("bm25_search"):
+            sparse = index.search(questions, candidates)
+        results = []
+        for dense_hits, sparse_hits in zip(dense, sparse):
+            fused = reciprocal_rank_fusion([[i for i, _ in dense_hits], [i for i, _ in sparse_hits]])
+            results.append([(texts[i], score) for i, score in fused[:top_k]])
+        return results
+
     def list_collections(self) -> List[str]:
         """列出所有集合"""
         return self.milvus_client.list_collections()
@@ -176,4 +762,214 @@ class LocalMilvusDB:
         """检查集合是否存在"""
         return self.milvus_client.has_collection(collection_name)
 
-db = LocalMilvusDB(persist_path="./milvus_data.db")   
\ No newline at end of file
+class CollectionSync:
+    """
+    流式增量同步会话
+
+    功能：
+    - 分批接收数据：新增的插入、内容变化的更新，同时把数据追加写入新的向量快照
+    - finish 时删除源数据中已不存在的行、更新清单、提交快照并切换到快照检索
+    - 同步过程中只保留当前批次的数据（清单中的 id 与内容哈希除外），检索改走 Milvus，已写入的数据即可被检索
+
+    使用示例：
+    >>> sync = db.begin_sync("my_collection", 768)
+    >>> for rows in batches:
+    ...     sync.add(rows)
+    >>> sync.finish()
+    """
+
+    def __init__(
+        self,
+        db: "LocalMilvusDB",
+        collection_name: str,
+        dimension: int,
+        metric_type: str,
+        source: Optional[str],
+        scalar_fields: Optional[Dict[str, Dict[str, Any]]] = None
+    ):
+        self.db = db
+        self.collection_name = collection_name
+        self.dimension = dimension
+        self.metric_type = metric_type
+        self.source = source
+        self.scalar_fields = scalar_fields or None
+        self.failed = False
+        self.inserted = 0
+        self.updated = 0
+        self.new_hashes = {}
+        self.writer = None
+
+        entry = db.manifest.get(collection_name)
+        self.rebuild = (
+            entry is None
+            or entry.get("dimension") != dimension
+            or entry.get("metric_type") != metric_type
+            or entry.get("scalar_fields") != self.scalar_fields
+            or not db.milvus_client.has_collection(collection_name)
+        )
+        if self.rebuild:
+            print(f"集合 '{collection_name}' 没有可用的清单，执行全量重建")
+            if not db.create_collection(collection_name, dimension, metric_type, self.scalar_fields):
+                self.failed = True
+                return
+            self.old_hashes = {}
+        else:
+            self.old_hashes = entry["rows"]
+
+        # 同步期间快照与集合不一致，检索改走 Milvus
+        db._stores[collection_name] = MilvusVectorStore(db.milvus_client, collection_name, metric_type)
+        try:
+            self.writer = SnapshotWriter(db._snapshot_path(collection_name), dimension)
+        except OSError as e:
+            print(f"创建向量快照失败，本次同步不写快照: {e}")
+
+    def _fail(self, message: str) -> bool:
+        print(message)
+        self.failed = True
+        # 清单可能已与集合内容不一致，下次启动时全量重建
+        self.db.manifest.pop(self.collection_name, None)
+        self.db._save_manifest()
+        self.db._stores.pop(self.collection_name, None)
+        if self.writer is not None:
+            self.writer.discard()
+            self.writer = None
+        return False
+
+    def abort(self):
+        """中断同步（例如上游出错），集合在下次同步时全量重建"""
+        if not self.failed:
+            self._fail(f"集合 '{self.collection_name}' 的同步被中断")
+
+    def add(self, rows: List[Dict[str, Any]]) -> bool:
+        """
+        同步一批数据
+
+        参数:
+        rows: 数据行列表，每行需包含 'key'（内容键，用于生成稳定 id）、'vector' 和 'text'
+
+        返回:
+        是否成功
+        """
+        if self.failed:
+            return False
+
+        batch = {}
+        for row in rows:
+            row = dict(row)
+            row["id"] = stable_id(row.pop("key"))
+            row_id = str(row["id"])
+            # 相同内容键只保留第一条
+            if row_id not in self.new_hashes and row_id not in batch:
+                batch[row_id] = row
+        if not batch:
+            return True
+
+        to_insert, to_update = [], []
+        for row_id, row in batch.items():
+            h = row_hash(row)
+            self.new_hashes[row_id] = h
+            old = self.old_hashes.get(row_id)
+            if old is None:
+                to_insert.append(row)
+            elif old != h:
+                to_update.append(row)
+
+        try:
+            if to_update:
+                self.db.milvus_client.upsert(collection_name=self.collection_name, data=to_update)
+            if to_insert:
+                self.db.milvus_client.insert(collection_name=self.collection_name, data=to_insert)
+        except Exception as e:
+            return self._fail(f"增量同步失败: {e}")
+        self.inserted += len(to_insert)
+        self.updated += len(to_update)
+
+        if self.writer is not None:
+            rows = list(batch.values())
+            try:
+                self.writer.append(
+                    [row["id"] for row in rows], [row["vector"] for row in rows], [row["text"] for row in rows]
+                )
+            except (OSError, ValueError) as e:
+                print(f"写入向量快照失败，本次同步不写快照: {e}")
+                self.writer.discard()
+                self.writer = None
+        return True
+
+    def finish(self) -> bool:
+        """
+        结束同步：删除已移除的数据，更新清单，提交快照
+
+        返回:
+        是否同步成功
+        """
+        if self.failed:
+            return False
+
+        db = self.db
+        to_delete = [int(i) for i in self.old_hashes if i not in self.new_hashes]
+        try:
+            if to_delete:
+                db.milvus_client.delete(collection_name=self.collection_name, ids=to_delete)
+        except Exception as e:
+            return self._fail(f"增量同步失败: {e}")
+
+        old_entry = db.manifest.get(self.collection_name) or {}
+        entry = {
+            "dimension": self.dimension,
+            "metric_type": self.metric_type,
+            "scalar_fields": self.scalar_fields,
+            "rows": self.new_hashes,
+        }
+        changed = self.rebuild or bool(self.inserted or self.updated or to_delete)
+        path = db._snapshot_path(self.collection_name)
+        meta = read_snapshot_meta(path)
+        if self.writer is not None:
+            try:
+                if changed or meta is None or meta.get("revision") != old_entry.get("revision"):
+                    entry["revision"] = uuid.uuid4().hex
+                    self.writer.commit({
+                        "revision": entry["revision"],
+                        "source": self.source,
+                        "metric_type": self.metric_type,
+                    })
+                    print(f"集合 '{self.collection_name}' 的向量快照已写入 {path}")
+                else:
+                    # 数据未变化，沿用已有的快照
+                    self.writer.discard()
+                    entry["revision"] = old_entry["revision"]
+                    if meta.get("source") != self.source:
+                        write_snapshot_meta(path, dict(meta, source=self.source))
+            except OSError as e:
+                print(f"写入向量快照失败: {e}")
+                entry.pop("revision", None)
+            self.writer = None
+
+        db.manifest[self.collection_name] = entry
+        db._save_manifest()
+        # 切换到快照检索（内存映射，不占用额外内存）；没有可用快照时在下次检索时按需加载
+        db._stores.pop(self.collection_name, None)
+        db.load_snapshot(self.collection_name)
+        # 入库时即建立 BM25 索引并随快照保存，检索和下次启动时无需重新分词
+        store = db._stores.get(self.collection_name)
+        if store is not None:
+            db.get_lexical_index(self.collection_name, store)
+
+        if self.rebuild:
+            print(f"集合 '{self.collection_name}' 全量重建完成，共 {len(self.new_hashes)} 条")
+        else:
+            print(
+                f"集合 '{self.collection_name}' 增量同步完成：新增 {self.inserted} 条，"
+                f"更新 {self.updated} 条，删除 {len(to_delete)} 条，"
+                f"未变化 {len(self.new_hashes) - self.inserted - self.updated} 条"
+            )
+        return True
+
+
+# 设置 VECTOR_IVF_MIN_ROWS 后，达到该行数的进程内集合改用 IVF 近似检索（VECTOR_NPROBE 为搜索的簇数）
+_ivf_min_rows = os.getenv("VECTOR_IVF_MIN_ROWS")
+db = LocalMilvusDB(
+    persist_path="./milvus_data.db",
+    ivf_min_rows=int(_ivf_min_rows) if _ivf_min_rows else None,
+    nprobe=int(os.getenv("VECTOR_NPROBE", "8")),
+)   
\ No newline at end of file
@@ -0,0 +1,436 @@
+import json
+import os
+import shutil
+import threading
+from abc import ABC, abstractmethod
+from collections.abc import Sequence
+from typing import Any, List, Optional, Tuple
+
+import numpy as np
+
+
+class SnapshotTexts(Sequence):
+    """
+    按偏移量索引的文本块：所有文本以 UTF-8 拼接存放在一个（内存映射的）字节数组中，
+    访问第 i 条时才解码，加载时不为每行创建 Python 对象
+
+    参数:
+    blob: 拼接后的字节（np.uint8 数组或内存映射）
+    offsets: 长度为 n + 1 的 int64 偏移量数组
+    encoding: "utf-8" 表示原始字符串，"json" 表示每条是一个 JSON 值（用于非字符串的 text）
+    """
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray, encoding: str = "utf-8"):
+        self.blob = blob
+        self.offsets = offsets
+        self.encoding = encoding
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index) -> Any:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        text = self.blob[self.offsets[index]:self.offsets[index + 1]].tobytes().decode("utf-8")
+        return json.loads(text) if self.encoding == "json" else text
+
+    @staticmethod
+    def encode(texts: Sequence[Any], encoding: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray, str]:
+        """
+        把文本列表编码为 (字节数组, 偏移量数组, 编码方式)
+
+        参数:
+        texts: 文本列表
+        encoding: 编码方式（None 表示根据 texts 自动选择：全部为字符串时使用 "utf-8"，否则使用 "json"）
+        """
+        if encoding is None:
+            encoding = "utf-8" if all(isinstance(text, str) for text in texts) else "json"
+        elif encoding == "utf-8" and not all(isinstance(text, str) for text in texts):
+            raise ValueError("快照中已有的文本为字符串，不能追加非字符串的 text")
+        chunks = [
+            (text if encoding == "utf-8" else json.dumps(text, ensure_ascii=False)).encode("utf-8")
+            for text in texts
+        ]
+        offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+        np.cumsum([len(chunk) for chunk in chunks], out=offsets[1:])
+        return np.frombuffer(b"".join(chunks), dtype=np.uint8), offsets, encoding
+
+
+class SnapshotWriter:
+    """
+    流式写入向量快照：数据按批追加到临时目录中的平铺文件，commit 时转换为 .npy 并整体替换旧快照
+
+    目录结构：
+    - ids.npy: int64 主键
+    - vectors.npy: (n, dimension) 的 float32 向量矩阵
+    - offsets.npy: 长度为 n + 1 的 int64 偏移量，第 i 条文本为 texts.bin[offsets[i]:offsets[i+1]]
+    - texts.bin: 所有文本以 UTF-8 拼接（非字符串的 text 以 JSON 存储）
+    - meta.json: 版本号、源数据指纹、维度、度量类型、行数等（最后写入）
+
+    写入过程中只保留当前批次的数据，内存占用与数据总量无关
+    """
+
+    def __init__(self, path: str, dimension: int):
+        """
+        参数:
+        path: 快照目录（最终位置，写入时使用 path + ".tmp"）
+        dimension: 向量维度
+        """
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.dimension = dimension
+        self.rows = 0
+        self.text_bytes = 0
+        self.encoding = None
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+        self._files = {
+            name: open(os.path.join(self.tmp_path, f"{name}.raw"), "wb")
+            for name in ("ids", "vectors", "offsets")
+        }
+        self._files["texts"] = open(os.path.join(self.tmp_path, "texts.bin"), "wb")
+        self._files["offsets"].write(np.zeros(1, dtype=np.int64).tobytes())
+
+    def append(self, ids: Sequence[int], vectors: Sequence, texts: Sequence[Any]):
+        """追加一批数据"""
+        blob, offsets, encoding = SnapshotTexts.encode(texts, self.encoding)
+        self.encoding = encoding
+        self._files["ids"].write(np.asarray(ids, dtype=np.int64).tobytes())
+        self._files["vectors"].write(
+            np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(texts), self.dimension).tobytes()
+        )
+        self._files["texts"].write(blob.tobytes())
+        self._files["offsets"].write((offsets[1:] + self.text_bytes).tobytes())
+        self.rows += len(texts)
+        self.text_bytes += int(offsets[-1])
+
+    def _close(self):
+        for f in self._files.values():
+            f.close()
+
+    def _raw_to_npy(self, name: str, dtype, shape: Tuple[int, ...]):
+        """在平铺文件前加上 .npy 文件头（流式复制，不把数据读入内存）"""
+        raw_path = os.path.join(self.tmp_path, f"{name}.raw")
+        with open(os.path.join(self.tmp_path, f"{name}.npy"), "wb") as out, open(raw_path, "rb") as raw:
+            np.lib.format.write_array_header_1_0(out, {
+                "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                "fortran_order": False,
+                "shape": shape,
+            })
+            shutil.copyfileobj(raw, out, 1 << 20)
+        os.remove(raw_path)
+
+    def commit(self, meta: dict):
+        """完成写入，用新快照替换旧快照"""
+        self._close()
+        self._raw_to_npy("ids", np.int64, (self.rows,))
+        self._raw_to_npy("vectors", np.float32, (self.rows, self.dimension))
+        self._raw_to_npy("offsets", np.int64, (self.rows + 1,))
+        write_snapshot_meta(self.tmp_path, dict(
+            meta, rows=self.rows, dimension=self.dimension, text_encoding=self.encoding or "utf-8"
+        ))
+
+        old_path = f"{self.path}.old"
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(self.path):
+            os.rename(self.path, old_path)
+        os.rename(self.tmp_path, self.path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    def discard(self):
+        """放弃本次写入"""
+        self._close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+
+def read_snapshot_meta(path: str) -> Optional[dict]:
+    """读取快照目录中的 meta.json，不存在或损坏时返回 None"""
+    try:
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def write_snapshot_meta(path: str, meta: dict):
+    """写入快照目录中的 meta.json（先写临时文件再替换）"""
+    tmp_path = os.path.join(path, "meta.json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(path, "meta.json"))
+
+
+class VectorStore(ABC):
+    """
+    向量存储接口
+
+    search 的返回格式与 LocalMilvusDB.search_many 一致：
+    每个查询向量对应一个 (text, distance) 元组列表，按相似度从高到低排列。
+    IP 的 distance 为内积（越大越相似），L2 的 distance 为欧氏距离的平方（越小越相似），与 Milvus 保持一致。
+    """
+
+    metric_type = "IP"
+
+    @abstractmethod
+    def search(self, query_vectors: Sequence, top_k: int) -> List[List[Tuple[str, float]]]:
+        """按查询向量检索，每个查询返回前 top_k 个 (text, distance)"""
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """集合中的行数"""
+
+
+class MilvusVectorStore(VectorStore):
+    """通过 MilvusClient 检索的向量存储，用于数据量较大的集合"""
+
+    def __init__(self, client, collection_name: str, metric_type: str = "IP"):
+        self.client = client
+        self.collection_name = collection_name
+        self.metric_type = metric_type
+
+    def search(self, query_vectors: Sequence, top_k: int, filter: str = "") -> List[List[Tuple[str, float]]]:
+        """filter 为 Milvus 过滤表达式，过滤条件包含分区键时只检索对应的分区"""
+        search_res = self.client.search(
+            collection_name=self.collection_name,
+            data=list(query_vectors),
+            limit=top_k,  # 每个问题返回前 top_k 个结果
+            search_params={"metric_type": self.metric_type, "params": {}},
+            output_fields=["text"],  # 返回 text 字段
+            filter=filter,
+        )
+        return [
+            [(res["entity"]["text"], res["distance"]) for res in hits]
+            for hits in search_res
+        ]
+
+    def __len__(self) -> int:
+        return int(self.client.get_collection_stats(self.collection_name).get("row_count", 0))
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    进程内的 NumPy 向量存储
+
+    功能：
+    - 所有向量保存在一个连续的 float32 矩阵中，检索时一次矩阵乘法完成打分
+    - 精确计算 IP / L2 距离，用 argpartition 选出 top-k
+    - 可选 IVF 倒排索引：数据量达到 ivf_min_rows 时用 k-means 聚类，只在最近的 nprobe 个簇中精确打分
+    - 更新时整体替换数组，检索不需要加锁
+
+    使用示例：
+    >>> store = NumpyVectorStore(dimension=768, metric_type="IP")
+    >>> store.upsert([1, 2], vectors, ["文本1", "文本2"])
+    >>> store.search(query_vectors, top_k=3)
+    """
+
+    def __init__(
+        self,
+        dimension: int,
+        metric_type: str = "IP",
+        ivf_min_rows: Optional[int] = None,
+        nprobe: int = 8
+    ):
+        """
+        初始化向量存储
+
+        参数:
+        dimension: 向量维度
+        metric_type: 距离度量类型（"L2" 或 "IP"）
+        ivf_min_rows: 构建 IVF 索引的最小数据量（None 表示始终精确检索）
+        nprobe: IVF 检索时搜索的簇数
+        """
+        if metric_type not in ("IP", "L2"):
+            raise ValueError(f"不支持的距离度量类型: {metric_type}")
+        self.dimension = dimension
+        self.metric_type = metric_type
+        self.ivf_min_rows = ivf_min_rows
+        self.nprobe = nprobe
+        # (主键, 向量矩阵, 文本)，更新时整体替换，检索时只读取一次引用
+        self._data = (np.empty(0, dtype=np.int64), np.empty((0, dimension), dtype=np.float32), [])
+        # IVF 索引：(构建时的向量矩阵, 簇中心, 按簇排列的行号, 每个簇在行号数组中的起始偏移)，数据变化后失效
+        self._ivf = None
+        # (数据快照, 主键 -> 行号)，按主键取文本时使用
+        self._row_index = None
+        self._write_lock = threading.Lock()
+
+    @classmethod
+    def from_arrays(
+        cls,
+        ids: np.ndarray,
+        vectors: np.ndarray,
+        texts: Sequence,
+        metric_type: str = "IP",
+        **kwargs
+    ) -> "NumpyVectorStore":
+        """
+        直接使用已有的数组构建存储（不复制，可以是内存映射的快照）
+
+        参数:
+        ids: int64 主键数组
+        vectors: (n, dimension) 的 float32 向量矩阵
+        texts: 与向量一一对应的文本序列
+        metric_type: 距离度量类型（"L2" 或 "IP"）
+        """
+        store = cls(vectors.shape[1], metric_type, **kwargs)
+        store._set(ids, vectors, texts)
+        return store
+
+    @property
+    def arrays(self) -> Tuple[np.ndarray, np.ndarray, Sequence]:
+        """当前的 (主键, 向量矩阵, 文本)，用于写入快照"""
+        return self._data
+
+    def upsert(self, ids: Sequence[int], vectors: Sequence, texts: Sequence[str]):
+        """
+        插入或更新数据（id 已存在时覆盖）
+
+        参数:
+        ids: 主键列表
+        vectors: 向量列表
+        texts: 文本列表
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(ids), self.dimension)
+        with self._write_lock:
+            old_ids, old_vectors, old_texts = self._data
+            keep = ~np.isin(old_ids, ids)
+            self._set(
+                np.concatenate([old_ids[keep], ids]),
+                np.concatenate([old_vectors[keep], vectors]),
+                [text for text, k in zip(old_texts, keep) if k] + list(texts),
+            )
+
+    def delete(self, ids: Sequence[int]):
+        """按主键删除数据"""
+        with self._write_lock:
+            old_ids, old_vectors, old_texts = self._data
+            keep = ~np.isin(old_ids, np.asarray(ids, dtype=np.int64))
+            self._set(old_ids[keep], old_vectors[keep], [text for text, k in zip(old_texts, keep) if k])
+
+    def _set(self, ids: np.ndarray, vectors: np.ndarray, texts: Sequence):
+        # 先准备好新数组再一次性替换引用，正在进行的检索仍使用旧数组
+        self._data = (ids, np.ascontiguousarray(vectors, dtype=np.float32), texts)
+        self._row_index = None
+
+    def get(self, ids: Sequence[int]) -> List[Optional[Any]]:
+        """
+        按主键取出文本（主键 -> 行号的索引在第一次调用时建立，数据更新后重建）
+
+        参数:
+        ids: 主键列表
+
+        返回:
+        与 ids 顺序一致的文本列表，不存在的主键对应 None
+        """
+        data = self._data
+        index = self._row_index
+        if index is None or index[0] is not data:
+            index = (data, {int(row_id): row for row, row_id in enumerate(data[0])})
+            self._row_index = index
+        rows, texts = index[1], data[2]
+        return [texts[rows[row_id]] if row_id in rows else None for row_id in (int(i) for i in ids)]
+
+    def _scores(self, vectors: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        """计算查询与候选向量的距离，统一转换为越大越相似的分数"""
+        if self.metric_type == "IP":
+            return queries @ vectors.T
+        # ||q - v||^2 = ||q||^2 - 2 q·v + ||v||^2，取负数使其越大越相似
+        return -(
+            (queries * queries).sum(axis=1, keepdims=True)
+            - 2 * (queries @ vectors.T)
+            + (vectors * vectors).sum(axis=1)
+        )
+
+    def _distance(self, score: float) -> float:
+        return float(score) if self.metric_type == "IP" else float(-score)
+
+    @staticmethod
+    def _top_k(scores: np.ndarray, top_k: int) -> np.ndarray:
+        """返回一维分数中最大的 top_k 个下标（按分数从高到低）"""
+        if top_k < len(scores):
+            candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            candidates = np.arange(len(scores))
+        return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+    def _build_ivf(self, vectors: np.ndarray, iterations: int = 10, seed: int = 0):
+        """用 k-means 把向量划分为 sqrt(n) 个簇，构建倒排索引"""
+        n = len(vectors)
+        nlist = max(1, int(np.sqrt(n)))
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(n, nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assign = np.argmax(self._scores(centroids, vectors), axis=1)
+            counts = np.bincount(assign, minlength=nlist)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, vectors)
+            nonempty = counts > 0
+            centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        assign = np.argmax(self._scores(centroids, vectors), axis=1)
+        order = np.argsort(assign, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))])
+        return vectors, centroids, order, offsets
+
+    def search_rows(self, query_vectors: Sequence, top_k: int) -> Tuple[Sequence, List[List[Tuple[int, float]]]]:
+        """
+        执行向量检索，返回行号（即 arrays 中的下标），供需要按行关联其他索引的调用方使用
+
+        参数:
+        query_vectors: 查询向量列表
+        top_k: 每个查询返回的结果数量
+
+        返回:
+        (检索时的文本序列, 结果列表)，结果列表与查询顺序一致，每项为 (行号, distance) 元组列表
+        """
+        # 取一次引用，检索过程中数据被替换也不受影响
+        _, vectors, texts = self._data
+        return texts, self._search_rows(vectors, len(texts), query_vectors, top_k)
+
+    def _search_rows(self, vectors: np.ndarray, row_count: int, query_vectors: Sequence, top_k: int) -> List[List[Tuple[int, float]]]:
+        queries = np.asarray(query_vectors, dtype=np.float32).reshape(-1, self.dimension)
+        if row_count == 0 or top_k <= 0:
+            return [[] for _ in range(len(queries))]
+
+        if self.ivf_min_rows is None or row_count < self.ivf_min_rows:
+            scores = self._scores(vectors, queries)
+            results = []
+            for row in scores:
+                best = self._top_k(row, top_k)
+                results.append([(int(i), self._distance(row[i])) for i in best])
+            return results
+
+        ivf = self._ivf
+        if ivf is None or ivf[0] is not vectors:
+            ivf = self._build_ivf(vectors)
+            self._ivf = ivf
+        _, centroids, order, offsets = ivf
+        nprobe = min(self.nprobe, len(centroids))
+        results = []
+        for query, centroid_scores in zip(queries, self._scores(centroids, queries)):
+            probes = self._top_k(centroid_scores, nprobe)
+            candidates = np.concatenate([order[offsets[c]:offsets[c + 1]] for c in probes])
+            row = self._scores(vectors[candidates], query[None, :])[0]
+            best = self._top_k(row, top_k)
+            results.append([(int(candidates[i]), self._distance(row[i])) for i in best])
+        return results
+
+    def search(self, query_vectors: Sequence, top_k: int) -> List[List[Tuple[str, float]]]:
+        """
+        执行向量检索
+
+        参数:
+        query_vectors: 查询向量列表
+        top_k: 每个查询返回的结果数量
+
+        返回:
+        与查询顺序一致的结果列表，每项为 (text, distance) 元组列表
+        """
+        texts, results = self.search_rows(query_vectors, top_k)
+        return [[(texts[i], distance) for i, distance in hits] for hits in results]
+
+    def __len__(self) -> int:
+        return len(self._data[2])
@@ -0,0 +1,339 @@
+import argparse
+import http.client
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlparse
+
+from mock_deepseek import config_from_args, count_tokens, start_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 各应用的目录和默认压测问题
+APPS = {
+    "gomoku": {"dir": "浏览器多次对话生成五子棋", "message": "帮我用 HTML 写一个可以在浏览器里玩的五子棋游戏"},
+    "rag": {"dir": "RAG初探", "message": "民法典第二百零四条规定了什么？"},
+    "agent": {"dir": "Agent小红书文案生成", "message": "帮我写一篇冷萃咖啡液的小红书文案，风格活泼一点"},
+}
+
+
+def percentile(samples: List[float], q: float) -> Optional[float]:
+    """最近秩法计算分位数，样本为空时返回 None"""
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, max(0, int(round(q * len(samples))) - 1))]
+
+
+class LoadGenerator:
+    """
+    向应用的 /chat（或 /chat/stream）接口发送并发请求并统计延迟
+
+    每个线程使用一个 keep-alive 连接；每个请求默认使用新的 session_id，
+    避免对话历史越积越长影响结果（sessions 大于 0 时在固定数量的会话之间轮换）。
+    """
+
+    def __init__(self, url: str, message: str, stream: bool = False, sessions: int = 0, timeout: float = 120.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.path = "/chat/stream" if stream else "/chat"
+        self.message = message
+        self.stream = stream
+        self.sessions = sessions
+        self.timeout = timeout
+        self._local = threading.local()
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        if getattr(self._local, "connection", None) is None:
+            self._local.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return self._local.connection
+
+    def _session_id(self) -> str:
+        with self._lock:
+            self._counter += 1
+            index = self._counter
+        if self.sessions > 0:
+            return f"bench-{index % self.sessions}"
+        return f"bench-{uuid.uuid4().hex[:12]}"
+
+    def request(self) -> Dict[str, Any]:
+        """
+        发送一个请求
+
+        返回:
+        {"ok", "status", "latency", "ttft", "tokens", "error"}，延迟单位为秒；ttft 只在流式请求中记录
+        """
+        body = json.dumps({"message": self.message, "session_id": self._session_id()}, ensure_ascii=False).encode("utf-8")
+        result = {"ok": False, "status": None, "latency": None, "ttft": None, "tokens": 0, "error": None}
+        start = time.perf_counter()
+        try:
+            connection = self._connection()
+            connection.request("POST", self.path, body=body, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            result["status"] = response.status
+            if self.stream:
+                text = self._read_stream(response, start, result)
+            else:
+                payload = json.loads(response.read() or b"{}")
+                text = payload.get("response") or ""
+            result["tokens"] = count_tokens(text)
+            result["ok"] = response.status == 200 and result["error"] is None
+            if response.status != 200 and result["error"] is None:
+                result["error"] = f"HTTP {response.status}"
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+            # 连接出错后重建
+            self._local.connection = None
+        result["latency"] = time.perf_counter() - start
+        return result
+
+    @staticmethod
+    def _read_stream(response, start: float, result: Dict[str, Any]) -> str:
+        """读取 SSE 事件流，记录首个内容块的时间，拼接所有内容块"""
+        pieces = []
+        for line in response:
+            line = line.decode("utf-8").strip()
+            if not line.startswith("data:"):
+                continue
+            event = json.loads(line[len("data:"):])
+            if event.get("type") == "error":
+                result["error"] = event.get("content")
+            elif event.get("content"):
+                if result["ttft"] is None:
+                    result["ttft"] = time.perf_counter() - start
+                pieces.append(event["content"])
+        return "".join(pieces)
+
+    def run(self, concurrency: int, requests: int = 0, duration: float = 0.0, warmup: int = 0) -> Dict[str, Any]:
+        """
+        以固定并发发送请求：requests 大于 0 时发送固定数量的请求，否则持续 duration 秒
+
+        参数:
+        concurrency: 并发数
+        requests: 请求总数
+        duration: 持续时间（秒）
+        warmup: 正式统计前先发送的预热请求数（不计入结果）
+
+        返回:
+        每个请求的结果列表和总耗时
+        """
+        for _ in range(warmup):
+            self.request()
+
+        results: List[Dict[str, Any]] = []
+        results_lock = threading.Lock()
+        remaining = [requests]
+        deadline = time.perf_counter() + duration if requests <= 0 else None
+
+        def worker():
+            while True:
+                with results_lock:
+                    if deadline is None:
+                        if remaining[0] <= 0:
+                            return
+                        remaining[0] -= 1
+                    elif time.perf_counter() >= deadline:
+                        return
+                result = self.request()
+                with results_lock:
+                    results.append(result)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for _ in range(concurrency):
+                pool.submit(worker)
+        return {"results": results, "elapsed": time.perf_counter() - start}
+
+
+def summarize(results: List[Dict[str, Any]], elapsed: float) -> Dict[str, Any]:
+    """汇总延迟分位数（毫秒）、每秒请求数、每秒 token 数和错误数"""
+    ok = [r for r in results if r["ok"]]
+    latencies = [r["latency"] * 1000 for r in ok]
+    ttfts = [r["ttft"] * 1000 for r in ok if r["ttft"] is not None]
+    errors: Dict[str, int] = {}
+    for r in results:
+        if not r["ok"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    summary = {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "failed": len(results) - len(ok),
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(len(ok) / elapsed, 2) if elapsed else None,
+        "tokens_per_second": round(sum(r["tokens"] for r in ok) / elapsed, 1) if elapsed else None,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies), 1) if latencies else None,
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": max(latencies) if latencies else None,
+        },
+        "errors": errors,
+    }
+    if ttfts:
+        summary["ttft_ms"] = {"p50": percentile(ttfts, 0.50), "p95": percentile(ttfts, 0.95), "p99": percentile(ttfts, 0.99)}
+    for stats in [summary["latency_ms"]] + ([summary["ttft_ms"]] if ttfts else []):
+        for key, value in stats.items():
+            if value is not None:
+                stats[key] = round(value, 1)
+    return summary
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_port(host: str, port: int, timeout: float, process: Optional[subprocess.Popen] = None):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"应用进程已退出，退出码 {process.returncode}")
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.5)
+    raise TimeoutError(f"等待 {host}:{port} 超时")
+
+
+def spawn_app(app: str, mock_url: str, startup_timeout: float, extra_args: List[str]) -> subprocess.Popen:
+    """
+    在应用目录中启动 main.py，DeepSeek 调用指向本地模拟服务
+
+    应用固定监听 5000 端口；进程放在独立的进程组中，结束时连同 Flask 重载器的子进程一起终止。
+    """
+    env = dict(os.environ, DEEPSEEK_BASE_URL=mock_url, DEEPSEEK_API_KEY=os.getenv("DEEPSEEK_API_KEY") or "mock")
+    process = subprocess.Popen(
+        [sys.executable, "main.py"] + extra_args,
+        cwd=os.path.join(ROOT, APPS[app]["dir"]),
+        env=env,
+        start_new_session=True,
+    )
+    try:
+        _wait_for_port("127.0.0.1", 5000, startup_timeout, process)
+    except Exception:
+        stop_app(process)
+        raise
+    return process
+
+
+def stop_app(process: subprocess.Popen):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=10)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def print_report(app: str, summary: Dict[str, Any], mock_stats: Optional[Dict[str, Any]]):
+    latency = summary["latency_ms"]
+    print(f"\n应用: {app}  请求数: {summary['requests']}  成功: {summary['succeeded']}  失败: {summary['failed']}")
+    print(f"耗时: {summary['elapsed_s']} 秒  每秒请求数: {summary['rps']}  每秒 token 数（回答）: {summary['tokens_per_second']}")
+    print(f"延迟(ms): mean={latency['mean']} p50={latency['p50']} p95={latency['p95']} p99={latency['p99']} max={latency['max']}")
+    if "ttft_ms" in summary:
+        ttft = summary["ttft_ms"]
+        print(f"首个 token 延迟(ms): p50={ttft['p50']} p95={ttft['p95']} p99={ttft['p99']}")
+    if mock_stats:
+        print(f"模拟服务: 大模型调用 {mock_stats['requests']} 次，注入错误 {mock_stats['errors']} 次，"
+              f"生成 token {mock_stats['completion_tokens']} 个（{mock_stats['completion_tokens_per_second']}/秒）")
+    for error, count in summary["errors"].items():
+        print(f"错误 x{count}: {error}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="对五子棋、RAG、小红书文案三个应用的 /chat 接口做端到端压测")
+    parser.add_argument("--app", choices=sorted(APPS), required=True, help="被测应用")
+    parser.add_argument("--url", default="http://127.0.0.1:5000", help="应用地址（--spawn 时忽略）")
+    parser.add_argument("--message", default=None, help="压测使用的问题，默认按应用选择")
+    parser.add_argument("--concurrency", type=int, default=8, help="并发数")
+    parser.add_argument("--requests", type=int, default=100, help="请求总数（为 0 时按 --duration 持续压测）")
+    parser.add_argument("--duration", type=float, default=30.0, help="持续压测的秒数")
+    parser.add_argument("--warmup", type=int, default=1, help="预热请求数")
+    parser.add_argument("--stream", action="store_true", help="压测 /chat/stream 并统计首个 token 延迟")
+    parser.add_argument("--sessions", type=int, default=0, help="在固定数量的会话之间轮换（0 表示每个请求一个新会话）")
+    parser.add_argument("--timeout", type=float, default=120.0, help="单个请求的超时秒数")
+    parser.add_argument("--json", default=None, help="把结果写入 JSON 文件")
+    parser.add_argument("--spawn", action="store_true", help="启动本地模拟服务和被测应用，压测结束后关闭")
+    parser.add_argument("--startup-timeout", type=float, default=300.0, help="--spawn 时等待应用启动的秒数（含入库时间）")
+    parser.add_argument("--app-args", default="", help="--spawn 时传给应用 main.py 的参数，例如 \"--workers 2\"")
+    # 模拟服务参数（--spawn 时生效）
+    parser.add_argument("--latency", type=float, default=0.2, help="模拟服务首个 token 之前的延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="模拟服务随机增加的延迟上限（秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="模拟服务的生成速度")
+    parser.add_argument("--completion-tokens", type=int, default=200, help="模拟服务普通回答的大致 token 数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟服务随机返回错误的比例")
+    parser.add_argument("--error-status", type=int, default=503, help="模拟服务随机错误的 HTTP 状态码")
+    parser.add_argument("--script", default=None, help="模拟服务的脚本规则 JSON 文件")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    mock_server = None
+    process = None
+    url = args.url
+    try:
+        if args.spawn:
+            port = _free_port()
+            mock_server = start_server("127.0.0.1", port, config_from_args(args))
+            mock_url = f"http://127.0.0.1:{port}/v1"
+            print(f"模拟 DeepSeek 服务: {mock_url}")
+            process = spawn_app(args.app, mock_url, args.startup_timeout, args.app_args.split())
+            url = "http://127.0.0.1:5000"
+
+        generator = LoadGenerator(
+            url,
+            args.message or APPS[args.app]["message"],
+            stream=args.stream,
+            sessions=args.sessions,
+            timeout=args.timeout,
+        )
+        mock_before = dict(mock_server.RequestHandlerClass.stats) if mock_server else None
+        run = generator.run(args.concurrency, args.requests, args.duration, args.warmup)
+        summary = summarize(run["results"], run["elapsed"])
+
+        mock_stats = None
+        if mock_server:
+            after = mock_server.RequestHandlerClass.stats
+            mock_stats = {key: after[key] - mock_before[key] for key in after}
+            mock_stats["completion_tokens_per_second"] = round(mock_stats["completion_tokens"] / run["elapsed"], 1)
+
+        print_report(args.app, summary, mock_stats)
+        if args.json:
+            report = {
+                "app": args.app,
+                "url": url,
+                "endpoint": generator.path,
+                "concurrency": args.concurrency,
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "summary": summary,
+                "mock": mock_stats,
+            }
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"结果已写入 {args.json}")
+    finally:
+        if process is not None:
+            stop_app(process)
+        if mock_server is not None:
+            mock_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
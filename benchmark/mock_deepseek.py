@@ -0,0 +1,312 @@
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+# 中日韩字符（含全角标点），与各应用 context_window.count_tokens 的估算方式一致
+_CJK_PATTERN = re.compile(r"[　-〿㐀-䶿一-鿿＀-￯]")
+
+DEFAULT_REPLY = "这是本地模拟服务返回的回答，用于在没有真实 DeepSeek 接口时测量吞吐量和延迟。"
+DEFAULT_JSON_REPLY = {"product_name": "冷萃咖啡液（榛果风味）", "style": "活泼"}
+
+
+def count_tokens(text: str) -> int:
+    """按 1 个中文字符约 0.6 个 token、1 个英文字符约 0.3 个 token 估算"""
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    return math.ceil(cjk * 0.6 + (len(text) - cjk) * 0.3)
+
+
+class MockConfig:
+    """
+    模拟服务的行为配置
+
+    参数:
+    latency: 首个 token 之前的固定延迟（秒）
+    jitter: 在 latency 基础上随机增加的延迟上限（秒）
+    tokens_per_second: 生成速度；非流式响应在全部 token 生成完后返回，流式响应按该速度逐块发送
+    completion_tokens: 普通回答的大致 token 数（由 reply 重复拼接而成）
+    error_rate: 随机返回错误的比例（0 ~ 1），用于验证重试
+    error_status: 随机错误使用的 HTTP 状态码
+    reply: 普通回答的文本
+    json_reply: 系统提示词要求以 JSON 返回时的回答，其中的字段也用作工具调用参数的默认值
+    script: 脚本规则列表（见 MockDeepSeekHandler._match_rule），按顺序匹配，先匹配的规则生效
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.2,
+        jitter: float = 0.0,
+        tokens_per_second: float = 200.0,
+        completion_tokens: int = 200,
+        error_rate: float = 0.0,
+        error_status: int = 503,
+        reply: str = DEFAULT_REPLY,
+        json_reply: Optional[Dict[str, Any]] = None,
+        script: Optional[List[Dict[str, Any]]] = None
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.reply = reply
+        self.json_reply = json_reply or DEFAULT_JSON_REPLY
+        self.script = script or []
+
+
+class MockDeepSeekHandler(BaseHTTPRequestHandler):
+    """
+    OpenAI 兼容的 /v1/chat/completions 接口
+
+    默认行为：
+    - 请求提供了工具且最后一条消息不是工具结果时，调用所有提供的工具（参数按 JSON Schema 生成）
+    - 系统提示词中要求返回 JSON 时，返回 json_reply
+    - 其余情况返回普通回答
+    脚本规则可覆盖默认行为，规则格式：
+    {"when": {"contains": "五子棋", "has_tools": true, "last_role": "user", "tool": "generate_emoji", "json": false},
+     "content": "...", "tool_calls": [{"name": "...", "arguments": {...}}], "latency": 1.0}
+    when 中的条件都满足时规则生效；content、tool_calls、latency 均可省略
+    """
+
+    protocol_version = "HTTP/1.1"
+    config = MockConfig()
+    stats = {"requests": 0, "errors": 0, "completion_tokens": 0}
+    stats_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload: Dict[str, Any]):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": "deepseek-chat", "object": "model"}]})
+        elif self.path == "/stats":
+            with self.stats_lock:
+                self._send_json(200, dict(self.stats))
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        config = self.config
+        with self.stats_lock:
+            self.stats["requests"] += 1
+
+        if config.error_rate and random.random() < config.error_rate:
+            with self.stats_lock:
+                self.stats["errors"] += 1
+            self._send_json(config.error_status, {"error": {"message": "模拟的服务端错误", "type": "server_error"}})
+            return
+
+        rule = self._match_rule(request) or {}
+        tool_calls = rule.get("tool_calls")
+        content = rule.get("content")
+        if tool_calls is None and content is None:
+            tool_calls, content = self._default_response(request)
+        tool_calls = [
+            {
+                "id": f"call_{uuid.uuid4().hex[:12]}",
+                "type": "function",
+                "function": {"name": call["name"], "arguments": json.dumps(call.get("arguments", {}), ensure_ascii=False)},
+            }
+            for call in tool_calls or []
+        ]
+
+        prompt_tokens = sum(count_tokens(str(message.get("content") or "")) for message in request.get("messages", []))
+        completion_tokens = count_tokens(content or "") + sum(count_tokens(c["function"]["arguments"]) for c in tool_calls)
+        with self.stats_lock:
+            self.stats["completion_tokens"] += completion_tokens
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens}
+
+        latency = rule.get("latency", config.latency) + random.uniform(0, config.jitter)
+        time.sleep(latency)
+        model = request.get("model", "deepseek-chat")
+        if request.get("stream"):
+            self._stream(model, content, tool_calls, usage)
+            return
+
+        time.sleep(completion_tokens / config.tokens_per_second)
+        message = {"role": "assistant", "content": content}
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+        self._send_json(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_calls else "stop"}],
+            "usage": usage,
+        })
+
+    def _stream(self, model: str, content: Optional[str], tool_calls: List[Dict[str, Any]], usage: Dict[str, int]):
+        """以 SSE 格式按 tokens_per_second 的速度逐块发送"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+        def send(delta: Dict[str, Any], finish_reason: Optional[str] = None, extra: Optional[Dict[str, Any]] = None):
+            payload = {
+                "id": chunk_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            payload.update(extra or {})
+            self._write_chunk(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n")
+
+        send({"role": "assistant", "content": ""})
+        # 每块约 5 个 token
+        step = 8
+        interval = count_tokens("字" * step) / self.config.tokens_per_second
+        for i in range(0, len(content or ""), step):
+            send({"content": content[i:i + step]})
+            time.sleep(interval)
+        for index, call in enumerate(tool_calls):
+            send({"tool_calls": [dict(call, index=index)]})
+        send({}, "tool_calls" if tool_calls else "stop", {"usage": usage})
+        self._write_chunk("data: [DONE]\n\n")
+        self._write_chunk("")
+
+    def _write_chunk(self, text: str):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _match_rule(self, request: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        messages = request.get("messages", [])
+        last_user = next((str(m.get("content") or "") for m in reversed(messages) if m.get("role") == "user"), "")
+        tools = [tool["function"]["name"] for tool in request.get("tools") or []]
+        facts = {
+            "has_tools": bool(tools),
+            "last_role": messages[-1].get("role") if messages else None,
+            "json": self._wants_json(request),
+        }
+        for rule in self.config.script:
+            when = rule.get("when", {})
+            if "contains" in when and when["contains"] not in last_user:
+                continue
+            if "tool" in when and when["tool"] not in tools:
+                continue
+            if any(key in when and when[key] != value for key, value in facts.items()):
+                continue
+            return rule
+        return None
+
+    @staticmethod
+    def _wants_json(request: Dict[str, Any]) -> bool:
+        if (request.get("response_format") or {}).get("type") == "json_object":
+            return True
+        return any(
+            message.get("role") == "system" and "json" in str(message.get("content") or "").lower()
+            for message in request.get("messages", [])
+        )
+
+    def _default_response(self, request: Dict[str, Any]):
+        """没有匹配的脚本规则时的默认行为，返回 (工具调用列表, 文本)"""
+        config = self.config
+        messages = request.get("messages", [])
+        tools = request.get("tools") or []
+        if tools and (not messages or messages[-1].get("role") != "tool"):
+            return [
+                {"name": tool["function"]["name"], "arguments": self._arguments(tool["function"].get("parameters") or {})}
+                for tool in tools
+            ], None
+        if self._wants_json(request):
+            return None, json.dumps(config.json_reply, ensure_ascii=False)
+        repeats = max(1, math.ceil(config.completion_tokens / max(count_tokens(config.reply), 1)))
+        return None, config.reply * repeats
+
+    def _arguments(self, schema: Dict[str, Any]) -> Dict[str, Any]:
+        """按 JSON Schema 生成工具参数：json_reply 中有同名字段时使用其值"""
+        arguments = {}
+        for name, spec in (schema.get("properties") or {}).items():
+            if name in self.config.json_reply:
+                arguments[name] = self.config.json_reply[name]
+            elif spec.get("enum"):
+                arguments[name] = spec["enum"][0]
+            elif spec.get("type") in ("integer", "number"):
+                arguments[name] = 1
+            elif spec.get("type") == "boolean":
+                arguments[name] = True
+            else:
+                arguments[name] = "测试"
+        return arguments
+
+
+def start_server(host: str = "127.0.0.1", port: int = 18080, config: Optional[MockConfig] = None) -> ThreadingHTTPServer:
+    """
+    在后台线程中启动模拟服务
+
+    返回:
+    服务实例（调用 shutdown() 停止），接口地址为 http://host:port/v1
+    """
+    handler = type("ConfiguredHandler", (MockDeepSeekHandler,), {
+        "config": config or MockConfig(),
+        "stats": {"requests": 0, "errors": 0, "completion_tokens": 0},
+        "stats_lock": threading.Lock(),
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-deepseek", daemon=True).start()
+    return server
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="本地模拟的 DeepSeek（OpenAI 兼容）接口")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--latency", type=float, default=0.2, help="首个 token 之前的延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="随机增加的延迟上限（秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="生成速度")
+    parser.add_argument("--completion-tokens", type=int, default=200, help="普通回答的大致 token 数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="随机返回错误的比例")
+    parser.add_argument("--error-status", type=int, default=503, help="随机错误的 HTTP 状态码")
+    parser.add_argument("--script", default=None, help="脚本规则的 JSON 文件（规则列表）")
+    return parser.parse_args()
+
+
+def config_from_args(args) -> MockConfig:
+    script = None
+    if args.script:
+        with open(args.script, "r", encoding="utf-8") as f:
+            script = json.load(f)
+    return MockConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        script=script,
+    )
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    server = start_server(args.host, args.port, config_from_args(args))
+    print(f"模拟 DeepSeek 服务已启动: http://{args.host}:{args.port}/v1")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
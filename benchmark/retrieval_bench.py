@@ -0,0 +1,506 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RAG_DIR = os.path.join(ROOT, "RAG初探")
+AGENT_DIR = os.path.join(ROOT, "Agent小红书文案生成")
+# 检索相关模块在 RAG 与 Agent 中保持一致，使用 RAG 目录中的版本
+sys.path.insert(0, RAG_DIR)
+
+from bm25_index import BM25Index  # noqa: E402
+from ingest import chunk_text, walk_documents  # noqa: E402
+from markdown_chunker import MarkdownChunker  # noqa: E402
+from vector_store import MilvusVectorStore, NumpyVectorStore  # noqa: E402
+
+CORPORA = ("synthetic", "mfd", "milvus_docs", "products")
+BACKENDS = ("numpy", "ivf", "milvus", "localdb", "bm25")
+
+
+def percentile(samples: List[float], q: float) -> Optional[float]:
+    """最近秩法计算分位数，样本为空时返回 None"""
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, max(0, int(round(q * len(samples))) - 1))]
+
+
+def latency_stats(samples: List[float]) -> Dict[str, Optional[float]]:
+    """把秒为单位的耗时样本汇总为毫秒分位数"""
+    ms = [s * 1000 for s in samples]
+    stats = {
+        "mean": sum(ms) / len(ms) if ms else None,
+        "p50": percentile(ms, 0.50),
+        "p95": percentile(ms, 0.95),
+        "p99": percentile(ms, 0.99),
+        "max": max(ms) if ms else None,
+    }
+    return {key: round(value, 3) if value is not None else None for key, value in stats.items()}
+
+
+@contextlib.contextmanager
+def quiet():
+    """屏蔽被测代码的 print 输出（例如 LocalMilvusDB.insert 打印整批数据），避免刷屏"""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+class Corpus:
+    """
+    一份检索语料：文本、文档向量和查询
+
+    参数:
+    name: 语料名称（含规模，例如 "synthetic-10000"）
+    texts: 文本块，作为检索结果的标识，需互不相同
+    vectors: (n, dimension) 的 float32 文档向量（已归一化，按 IP 检索）
+    query_texts: 查询文本（BM25 和 LocalMilvusDB.search 使用）
+    query_vectors: 与 query_texts 对应的查询向量
+    has_text: 文本是否为真实内容（合成语料的文本只是编号，不参与 BM25 测试）
+    """
+
+    def __init__(
+        self,
+        name: str,
+        texts: List[str],
+        vectors: np.ndarray,
+        query_texts: List[str],
+        query_vectors: np.ndarray,
+        has_text: bool = True
+    ):
+        self.name = name
+        self.texts = texts
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self.query_texts = query_texts
+        self.query_vectors = np.ascontiguousarray(query_vectors, dtype=np.float32)
+        self.has_text = has_text
+        self.row_of = {text: i for i, text in enumerate(texts)}
+
+    @property
+    def size(self) -> int:
+        return len(self.texts)
+
+    @property
+    def dimension(self) -> int:
+        return self.vectors.shape[1]
+
+    def ground_truth(self, top_k: int) -> np.ndarray:
+        """暴力计算每个查询的精确 top_k 行号，作为召回率的基准"""
+        scores = self.query_vectors @ self.vectors.T
+        k = min(top_k, self.size)
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, best, axis=1), axis=1, kind="stable")
+        return np.take_along_axis(best, order, axis=1)
+
+
+def recall(results: List[List[int]], truth: np.ndarray) -> float:
+    """平均召回率：检索结果与精确结果交集的比例"""
+    if len(truth) == 0 or truth.shape[1] == 0:
+        return 1.0
+    k = truth.shape[1]
+    return float(np.mean([len(set(hits[:k]) & set(expected.tolist())) / k for hits, expected in zip(results, truth)]))
+
+
+def synthetic_corpus(size: int, dimension: int, queries: int, rng: np.random.Generator, clusters: int = 64) -> Corpus:
+    """
+    合成语料：向量围绕若干簇中心分布（比均匀分布更接近真实的文本向量，也能体现 IVF 的召回损失），
+    查询为随机抽取的文档向量加噪声
+    """
+    def noise(rows: int, scale: float) -> np.ndarray:
+        # 每个分量的标准差为 scale / sqrt(dimension)，噪声向量的模长约为 scale
+        return rng.standard_normal((rows, dimension)).astype(np.float32) * (scale / np.sqrt(dimension))
+
+    centers = normalize(noise(clusters, 1.0))
+    assign = rng.integers(0, clusters, size)
+    vectors = normalize(centers[assign] + noise(size, 3.0))
+    picks = rng.choice(size, min(queries, size), replace=False)
+    query_vectors = normalize(vectors[picks] + noise(len(picks), 0.8))
+    texts = [f"doc-{i}" for i in range(size)]
+    query_texts = [f"query-{i}" for i in range(len(picks))]
+    return Corpus(f"synthetic-{size}", texts, vectors, query_texts, query_vectors, has_text=False)
+
+
+def sample_queries(texts: List[str], count: int, rng: np.random.Generator) -> List[str]:
+    """从文本块中抽取查询：取正文（去掉标题路径）开头的一句，模拟用户针对某段内容提问"""
+    picks = rng.choice(len(texts), min(count, len(texts)), replace=False)
+    queries = []
+    for i in picks:
+        lines = [line for line in texts[i].splitlines() if line.strip()]
+        body = lines[1] if len(lines) > 1 else lines[0]
+        queries.append(body.strip()[:60])
+    return queries
+
+
+def markdown_chunks(sources: List[str], max_chunks: int) -> List[str]:
+    """用应用入库时相同的切分方式（MarkdownChunker）切分文档，去掉重复的文本块"""
+    chunker = MarkdownChunker(max_tokens=480, overlap_tokens=50)
+    texts = {}
+    for source in sources:
+        for _, text in walk_documents(source):
+            for chunk in chunker.split(text):
+                texts.setdefault(chunk_text(chunk), None)
+                if max_chunks and len(texts) >= max_chunks:
+                    return list(texts)
+    return list(texts)
+
+
+def product_texts() -> List[str]:
+    """Agent 应用入库的产品信息文本块"""
+    with open(os.path.join(AGENT_DIR, "doc", "chunked_product_information.json"), "r", encoding="utf-8") as f:
+        return [chunk["content"] for chunk in json.load(f)["chunks"]]
+
+
+class Encoder:
+    """按指定的批大小分批调用编码模型"""
+
+    def __init__(self, model):
+        self.model = model
+
+    def encode_documents(self, texts: List[str], batch_size: int = 64) -> np.ndarray:
+        vectors = []
+        for i in range(0, len(texts), batch_size):
+            vectors.extend(self.model.encode_documents(texts[i:i + batch_size]))
+        return np.asarray(vectors, dtype=np.float32)
+
+    def encode_queries(self, texts: List[str], batch_size: int = 64) -> np.ndarray:
+        vectors = []
+        for i in range(0, len(texts), batch_size):
+            vectors.extend(self.model.encode_queries(texts[i:i + batch_size]))
+        return np.asarray(vectors, dtype=np.float32)
+
+
+def text_corpus(name: str, texts: List[str], queries: int, encoder: Encoder, rng: np.random.Generator) -> Corpus:
+    query_texts = sample_queries(texts, queries, rng)
+    return Corpus(
+        f"{name}-{len(texts)}",
+        texts,
+        normalize(encoder.encode_documents(texts)),
+        query_texts,
+        normalize(encoder.encode_queries(query_texts)),
+    )
+
+
+def replicate_corpus(base: Corpus, copies: int, rng: np.random.Generator) -> Corpus:
+    """
+    把语料复制为 copies 份：文本加副本编号，向量加少量噪声（各副本互不相同，不必重新编码），
+    查询不变，用于模拟大规模的产品库
+    """
+    if copies <= 1:
+        return base
+    dimension = base.dimension
+    texts = [f"{text}\n（副本 {c}）" for c in range(copies) for text in base.texts]
+    noise = rng.standard_normal((copies * base.size, dimension)).astype(np.float32) * (0.15 / np.sqrt(dimension))
+    vectors = normalize(np.tile(base.vectors, (copies, 1)) + noise)
+    name = base.name.rsplit("-", 1)[0]
+    return Corpus(f"{name}-{len(texts)}", texts, vectors, base.query_texts, base.query_vectors)
+
+
+def time_queries(search: Callable[[int], List[int]], count: int) -> Tuple[List[float], List[List[int]]]:
+    """逐个查询计时，返回 (耗时列表, 每个查询的结果行号)"""
+    samples, results = [], []
+    for i in range(count):
+        start = time.perf_counter()
+        hits = search(i)
+        samples.append(time.perf_counter() - start)
+        results.append(hits)
+    return samples, results
+
+
+class RetrievalBenchmark:
+    """
+    检索微基准
+
+    对每份语料、每个后端测量：
+    - 入库：NumPy 存储的写入与 IVF 构建耗时，Milvus Lite（LocalMilvusDB.insert）的写入吞吐
+    - 检索：逐个查询的延迟分位数、批量查询的吞吐（QPS）以及相对暴力检索的召回率
+    - 编码：编码模型在不同批大小下的文档编码吞吐和查询编码延迟（真实语料）
+    所有结果记录为字典列表，便于写入 JSON 后对比不同后端和索引参数
+    """
+
+    def __init__(
+        self,
+        top_ks: List[int],
+        nprobes: List[int],
+        backends: List[str],
+        work_dir: str,
+        insert_batch_size: int = 512,
+        warmup: int = 5
+    ):
+        self.top_ks = top_ks
+        self.nprobes = nprobes
+        self.backends = backends
+        self.work_dir = work_dir
+        self.insert_batch_size = insert_batch_size
+        self.warmup = warmup
+        self.records: List[Dict[str, Any]] = []
+        self._db = None
+
+    def record(self, corpus: Corpus, stage: str, backend: str, **values):
+        self._record(corpus.name, corpus.size, corpus.dimension, stage, backend, **values)
+
+    def _record(self, name: str, size: int, dimension: Optional[int], stage: str, backend: str, **values):
+        record = {"corpus": name, "size": size, "dimension": dimension, "stage": stage, "backend": backend}
+        record.update(values)
+        self.records.append(record)
+        summary = ", ".join(f"{k}={v}" for k, v in values.items() if not isinstance(v, dict))
+        latency = values.get("latency_ms")
+        if latency:
+            summary += f", p50={latency['p50']}ms p95={latency['p95']}ms p99={latency['p99']}ms"
+        print(f"[{name}] {stage:<7} {backend:<8} {summary}")
+
+    def db(self):
+        """按需创建基准专用的 LocalMilvusDB（数据放在工作目录中，不影响应用的数据）"""
+        if self._db is None:
+            with quiet():
+                from vector_db import LocalMilvusDB
+                self._db = LocalMilvusDB(persist_path=os.path.join(self.work_dir, "bench_milvus.db"))
+        return self._db
+
+    def run(self, corpus: Corpus):
+        truths = {k: corpus.ground_truth(k) for k in self.top_ks}
+        if "numpy" in self.backends or "ivf" in self.backends:
+            self.bench_numpy(corpus, truths)
+        if "milvus" in self.backends or "localdb" in self.backends:
+            try:
+                self.bench_milvus(corpus, truths)
+            except Exception as e:
+                # 未安装 pymilvus 或编码模型加载失败
+                print(f"[{corpus.name}] 跳过 Milvus 后端: {e}")
+        if "bm25" in self.backends and corpus.has_text:
+            self.bench_bm25(corpus)
+
+    def _bench_search(
+        self,
+        corpus: Corpus,
+        backend: str,
+        search: Callable[[int, int], List[int]],
+        search_batch: Callable[[int], Any],
+        truths: Dict[int, np.ndarray],
+        **params
+    ):
+        """
+        测量一个检索后端：逐个查询的延迟、批量查询的吞吐和召回率
+
+        参数:
+        search: (查询序号, top_k) -> 结果行号列表
+        search_batch: top_k -> 一次检索全部查询
+        truths: top_k -> 暴力检索的精确结果
+        params: 附加记录的参数（例如 nprobe）
+        """
+        count = len(corpus.query_texts)
+        for top_k, truth in truths.items():
+            with quiet():
+                for i in range(min(self.warmup, count)):
+                    search(i, top_k)
+                samples, results = time_queries(lambda i: search(i, top_k), count)
+                start = time.perf_counter()
+                search_batch(top_k)
+                batch_seconds = time.perf_counter() - start
+            self.record(corpus, "query", backend, top_k=top_k, recall=round(recall(results, truth), 4),
+                        batch_qps=round(count / batch_seconds, 1), latency_ms=latency_stats(samples), **params)
+
+    def _bench_store(self, corpus: Corpus, backend: str, store: NumpyVectorStore, truths: Dict[int, np.ndarray], **params):
+        queries = corpus.query_vectors
+        self._bench_search(
+            corpus, backend,
+            lambda i, top_k: [row for row, _ in store.search_rows(queries[i:i + 1], top_k)[1][0]],
+            lambda top_k: store.search_rows(queries, top_k),
+            truths, **params,
+        )
+
+    def bench_numpy(self, corpus: Corpus, truths: Dict[int, np.ndarray]):
+        ids = np.arange(corpus.size, dtype=np.int64)
+        if "numpy" in self.backends:
+            store = NumpyVectorStore(corpus.dimension, "IP")
+            start = time.perf_counter()
+            for i in range(0, corpus.size, self.insert_batch_size):
+                end = i + self.insert_batch_size
+                store.upsert(ids[i:end], corpus.vectors[i:end], corpus.texts[i:end])
+            seconds = time.perf_counter() - start
+            self.record(corpus, "ingest", "numpy", seconds=round(seconds, 4), rows_per_second=round(corpus.size / seconds, 1),
+                        batch_size=self.insert_batch_size)
+            self._bench_store(corpus, "numpy", store, truths)
+
+        if "ivf" in self.backends:
+            for nprobe in self.nprobes:
+                store = NumpyVectorStore.from_arrays(ids, corpus.vectors, corpus.texts, "IP", ivf_min_rows=0, nprobe=nprobe)
+                # 第一次检索时构建 IVF 索引，单独计时
+                start = time.perf_counter()
+                store.search_rows(corpus.query_vectors[:1], 1)
+                build_seconds = time.perf_counter() - start
+                self.record(corpus, "ingest", "ivf", nprobe=nprobe, build_seconds=round(build_seconds, 4))
+                self._bench_store(corpus, "ivf", store, truths, nprobe=nprobe)
+
+    def bench_milvus(self, corpus: Corpus, truths: Dict[int, np.ndarray]):
+        db = self.db()
+        collection = "bench_" + "".join(c if c.isalnum() else "_" for c in corpus.name)
+        vectors = corpus.vectors.tolist()
+        rows = [{"id": i, "vector": vectors[i], "text": text} for i, text in enumerate(corpus.texts)]
+        with quiet():
+            db.create_collection(collection, corpus.dimension, "IP")
+            start = time.perf_counter()
+            ok = all(db.insert(collection, rows[i:i + self.insert_batch_size])
+                     for i in range(0, len(rows), self.insert_batch_size))
+            seconds = time.perf_counter() - start
+        if not ok:
+            print(f"[{corpus.name}] 写入 Milvus 失败，跳过 Milvus 后端")
+            return
+        self.record(corpus, "ingest", "milvus", seconds=round(seconds, 4), rows_per_second=round(corpus.size / seconds, 1),
+                    batch_size=self.insert_batch_size)
+
+        if "milvus" in self.backends:
+            store = MilvusVectorStore(db.milvus_client, collection, "IP")
+            queries = corpus.query_vectors
+            self._bench_search(
+                corpus, "milvus",
+                lambda i, top_k: [corpus.row_of[text] for text, _ in store.search(queries[i:i + 1], top_k)[0]],
+                lambda top_k: store.search(queries, top_k),
+                truths,
+            )
+
+        if "localdb" in self.backends:
+            # LocalMilvusDB.search 的完整路径：查询向量缓存 + 按集合大小选择的检索后端。
+            # 查询向量预先放入缓存，测量结果不包含编码模型的耗时（编码单独测量）
+            questions = [f"{corpus.name}:{text}" for text in corpus.query_texts]
+            for question, vector in zip(questions, corpus.query_vectors):
+                db.query_cache.put(question, vector)
+            with quiet():
+                local_store = type(db.get_store(collection)).__name__
+            self._bench_search(
+                corpus, "localdb",
+                lambda i, top_k: [corpus.row_of[text] for text, _ in db.search(collection, questions[i], top_k=top_k)],
+                lambda top_k: db.search_many(collection, questions, top_k),
+                truths, local_store=local_store,
+            )
+
+    def bench_bm25(self, corpus: Corpus):
+        """BM25 没有暴力检索基准（倒排表遍历本身就是精确的），只记录建索引耗时和查询延迟"""
+        start = time.perf_counter()
+        index = BM25Index.build(corpus.texts)
+        self.record(corpus, "ingest", "bm25", build_seconds=round(time.perf_counter() - start, 4),
+                    terms=len(index.vocabulary))
+        for top_k in self.top_ks:
+            samples, _ = time_queries(lambda i: index.search([corpus.query_texts[i]], top_k)[0], len(corpus.query_texts))
+            self.record(corpus, "query", "bm25", top_k=top_k, latency_ms=latency_stats(samples))
+
+    def bench_encoder(self, encoder: Encoder, name: str, texts: List[str], queries: List[str], batch_sizes: List[int]):
+        """测量编码模型在不同批大小下的文档编码吞吐，以及单个查询的编码延迟"""
+        dimension = None
+        for batch_size in batch_sizes:
+            start = time.perf_counter()
+            vectors = encoder.encode_documents(texts, batch_size)
+            seconds = time.perf_counter() - start
+            dimension = vectors.shape[1]
+            self._record(name, len(texts), dimension, "encode", "documents", batch_size=batch_size,
+                         texts_per_second=round(len(texts) / seconds, 1))
+        samples, _ = time_queries(lambda i: encoder.encode_queries([queries[i]]), len(queries))
+        self._record(name, len(texts), dimension, "encode", "queries", batch_size=1, latency_ms=latency_stats(samples))
+
+
+def int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="LocalMilvusDB / NumPy 向量存储 / BM25 / 编码模型的检索微基准")
+    parser.add_argument("--corpora", default="synthetic,mfd", help=f"语料，逗号分隔，可选 {','.join(CORPORA)}")
+    parser.add_argument("--backends", default=",".join(BACKENDS), help=f"检索后端，逗号分隔，可选 {','.join(BACKENDS)}")
+    parser.add_argument("--sizes", type=int_list, default=[1000, 10000, 50000], help="合成语料的规模")
+    parser.add_argument("--dimension", type=int, default=768, help="合成语料的向量维度")
+    parser.add_argument("--product-copies", type=int_list, default=[1, 100, 1000], help="产品库的复制份数")
+    parser.add_argument("--max-chunks", type=int, default=0, help="真实语料最多使用的文本块数（0 表示全部）")
+    parser.add_argument("--queries", type=int, default=200, help="每份语料的查询数")
+    parser.add_argument("--top-k", type=int_list, default=[3, 10], help="检索的 top_k")
+    parser.add_argument("--nprobe", type=int_list, default=[4, 8, 16], help="IVF 检索的簇数")
+    parser.add_argument("--batch-sizes", type=int_list, default=[1, 16, 64], help="编码模型的批大小")
+    parser.add_argument("--insert-batch-size", type=int, default=512, help="写入时每批的行数")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--output", default=None, help="把结果写入 JSON 文件")
+    parser.add_argument("--work-dir", default=None, help="Milvus 数据和编码缓存的目录（默认使用临时目录并在结束后删除）")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    corpora = [c for c in args.corpora.split(",") if c]
+    backends = [b for b in args.backends.split(",") if b]
+    for name in corpora:
+        if name not in CORPORA:
+            raise SystemExit(f"未知的语料: {name}")
+    for name in backends:
+        if name not in BACKENDS:
+            raise SystemExit(f"未知的检索后端: {name}")
+    output = os.path.abspath(args.output) if args.output else None
+
+    work_dir = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix="retrieval_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+    # 应用模块在导入时按相对路径创建数据库和缓存文件，切换到工作目录避免写入应用目录
+    os.chdir(work_dir)
+    rng = np.random.default_rng(args.seed)
+    bench = RetrievalBenchmark(args.top_k, args.nprobe, backends, work_dir, args.insert_batch_size)
+    try:
+        for size in args.sizes if "synthetic" in corpora else []:
+            bench.run(synthetic_corpus(size, args.dimension, args.queries, rng))
+
+        real = [name for name in corpora if name != "synthetic"]
+        if real:
+            try:
+                with quiet():
+                    from utils import embedding_model
+            except Exception as e:
+                print(f"跳过真实语料 {real}（编码模型不可用）: {e}")
+                real = []
+            else:
+                encoder = Encoder(embedding_model)
+
+        for name in real:
+            if name == "mfd":
+                texts = markdown_chunks([os.path.join(RAG_DIR, "doc", "mfd.md")], args.max_chunks)
+            elif name == "milvus_docs":
+                texts = markdown_chunks([os.path.join(RAG_DIR, "doc", "milvus_docs")], args.max_chunks)
+            else:
+                texts = product_texts()
+            print(f"语料 {name}: {len(texts)} 个文本块")
+            base = text_corpus(name, texts, args.queries, encoder, rng)
+            if name != "products":
+                bench.bench_encoder(encoder, name, texts[:256], base.query_texts[:50], args.batch_sizes)
+                bench.run(base)
+                continue
+            for copies in args.product_copies:
+                bench.run(replicate_corpus(base, copies, rng))
+    finally:
+        if not args.work_dir:
+            os.chdir(ROOT)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if output:
+        report = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "environment": {
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+            },
+            "config": {key: value for key, value in vars(args).items() if key != "output"},
+            "results": bench.records,
+        }
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+import atexit
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional, TextIO
+
+# 日志级别：低于 LOG_LEVEL 的记录在调用处直接丢弃，不进入队列
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+LOG_LEVEL = LEVELS.get(os.getenv("LOG_LEVEL", "info").lower(), LEVELS["info"])
+# 控制台输出中单条消息的最大字符数，完整内容写入 JSON 日志文件
+CONSOLE_MAX_CHARS = int(os.getenv("LOG_CONSOLE_MAX_CHARS", "500"))
+# 设置后应用日志同时以 JSON 行的形式写入该文件（按大小轮转）
+LOG_FILE = os.getenv("LOG_FILE")
+# 日志文件轮转的大小上限和保留的历史文件数
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+
+
+def _truncate(text: str, limit: int) -> str:
+    if limit <= 0 or len(text) <= limit:
+        return text
+    return f"{text[:limit]}…（共 {len(text)} 字符）"
+
+
+def _json_default(value: Any) -> str:
+    return str(value)
+
+
+class RotatingJsonlFile:
+    """
+    追加写入的 JSON 行文件，超过 max_bytes 时轮转：path -> path.1 -> path.2 ...，最多保留 backup_count 个历史文件
+
+    只由后台写线程调用，不加锁。
+    """
+
+    def __init__(self, path: str, max_bytes: int = LOG_MAX_BYTES, backup_count: int = LOG_BACKUP_COUNT):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._file: Optional[TextIO] = None
+        self._size = 0
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._size = self._file.tell()
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                source = f"{self.path}.{i}"
+                if os.path.exists(source):
+                    os.replace(source, f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def write(self, record: Dict[str, Any]):
+        line = json.dumps(record, ensure_ascii=False, default=_json_default) + "\n"
+        if self._file is None:
+            self._open()
+        size = len(line.encode("utf-8"))
+        if self.max_bytes > 0 and self._size > 0 and self._size + size > self.max_bytes:
+            self._rotate()
+        self._file.write(line)
+        self._size += size
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class AsyncLogWriter:
+    """
+    队列 + 后台线程的日志写入器：调用方只把原始参数放入队列，消息格式化、JSON 序列化和文件 / 控制台 I/O 都在后台线程完成
+
+    功能：
+    - 队列已满时丢弃新记录并计数，请求处理永远不会因为写日志而阻塞
+    - 队列空闲时批量刷新文件缓冲区，进程退出时写完队列中剩余的记录
+    - 控制台输出截断过长的消息，完整内容保留在 JSON 日志文件中
+
+    使用示例：
+    >>> writer = AsyncLogWriter()
+    >>> writer.submit(None, {"level": "info", "message": "启动完成"})
+    """
+
+    def __init__(self, max_queue: int = 10000, console: TextIO = None):
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        self._console = console
+        self._files: Dict[str, RotatingJsonlFile] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.written = 0
+        self.dropped = 0
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="async-log-writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def file(self, path: str, max_bytes: int = LOG_MAX_BYTES, backup_count: int = LOG_BACKUP_COUNT) -> RotatingJsonlFile:
+        """返回（必要时创建）路径对应的轮转文件，同一路径共用一个文件对象"""
+        with self._lock:
+            sink = self._files.get(path)
+            if sink is None:
+                sink = self._files[path] = RotatingJsonlFile(path, max_bytes, backup_count)
+            return sink
+
+    def submit(self, sink: Optional[RotatingJsonlFile], record: Dict[str, Any], console: bool = False) -> bool:
+        """
+        把一条记录放入队列，不等待写入
+
+        参数:
+        sink: 写入的 JSON 行文件（None 表示不写文件）
+        record: 记录字典；其中的 "args" 会在后台线程中格式化进 "message"
+        console: 是否同时输出到控制台
+
+        返回:
+        是否成功入队（队列已满时返回 False）
+        """
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((sink, record, console))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _format(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        args = record.pop("args", None)
+        if args:
+            try:
+                record["message"] = record["message"] % args
+            except (TypeError, ValueError):
+                record["message"] = " ".join([str(record["message"])] + [str(arg) for arg in args])
+        return record
+
+    def _write(self, sink: Optional[RotatingJsonlFile], record: Dict[str, Any], console: bool):
+        record = self._format(record)
+        if console:
+            stream = self._console or sys.stdout
+            stamp = datetime.fromtimestamp(record["ts"]).strftime("%H:%M:%S")
+            message = _truncate(str(record.get("message", "")), CONSOLE_MAX_CHARS)
+            stream.write(f"{stamp} {record['level'].upper():<7} {record['logger']}: {message}\n")
+        if sink is not None:
+            record["ts"] = datetime.fromtimestamp(record["ts"]).isoformat(timespec="milliseconds")
+            sink.write(record)
+        self.written += 1
+
+    def _flush(self):
+        for sink in list(self._files.values()):
+            sink.flush()
+        (self._console or sys.stdout).flush()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            pending = [item]
+            # 一次取出队列中已有的全部记录，写完后统一刷新
+            while True:
+                try:
+                    pending.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = False
+            for entry in pending:
+                if entry is None:
+                    stop = True
+                    continue
+                try:
+                    self._write(*entry)
+                except Exception as e:
+                    sys.stderr.write(f"写日志失败: {e}\n")
+            try:
+                self._flush()
+            except Exception:
+                pass
+            for _ in pending:
+                self._queue.task_done()
+            if stop:
+                return
+
+    def flush(self, timeout: float = 5.0):
+        """等待队列中已有的记录写完（主要用于测试和退出前）"""
+        if self._thread is None:
+            return
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def close(self, timeout: float = 5.0):
+        """写完剩余记录后停止后台线程并关闭文件"""
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+        for sink in list(self._files.values()):
+            sink.close()
+
+    def stats(self) -> Dict[str, int]:
+        """返回写入统计信息"""
+        return {"queued": self._queue.qsize(), "written": self.written, "dropped": self.dropped}
+
+
+# 进程内共用一个写入器（后台线程在第一次写日志时启动）
+writer = AsyncLogWriter()
+
+
+class Logger:
+    """
+    带级别和采样的日志记录器，接口与 print 的用法接近，但格式化和输出都在后台线程中完成
+
+    消息使用 % 风格的占位符，参数在后台线程中才格式化，因此大对象（检索结果、提示词）不会在请求线程中被转成字符串；
+    传入的参数在格式化之前不应再被修改。
+
+    使用示例：
+    >>> log = get_logger("vector_db")
+    >>> log.info("在 '%s' 中找到 %d 个结果", collection_name, len(results))
+    >>> log.debug("工具返回结果：%s", tool_result, sample=0.1)   # 只记录约 10% 的调用
+    """
+
+    def __init__(self, name: str, level: int = None, console: bool = True):
+        self.name = name
+        self.level = LOG_LEVEL if level is None else level
+        self.console = console
+        self.sink = writer.file(LOG_FILE) if LOG_FILE else None
+
+    def enabled(self, level: str) -> bool:
+        return LEVELS[level] >= self.level
+
+    def log(self, level: str, message: str, *args: Any, sample: float = 1.0, **fields: Any):
+        """
+        记录一条日志
+
+        参数:
+        level: 级别（debug / info / warning / error）
+        message: 消息，可包含 % 占位符
+        args: 占位符参数
+        sample: 采样比例（0~1），高频的大日志可只记录一部分
+        fields: 额外的结构化字段，写入 JSON 日志文件
+        """
+        if LEVELS[level] < self.level:
+            return
+        if sample < 1.0 and random.random() >= sample:
+            return
+        if not self.console and self.sink is None:
+            return
+        record = {"ts": time.time(), "level": level, "logger": self.name, "message": message}
+        if args:
+            record["args"] = args
+        if fields:
+            record.update(fields)
+        writer.submit(self.sink, record, console=self.console)
+
+    def debug(self, message: str, *args: Any, **kwargs: Any):
+        self.log("debug", message, *args, **kwargs)
+
+    def info(self, message: str, *args: Any, **kwargs: Any):
+        self.log("info", message, *args, **kwargs)
+
+    def warning(self, message: str, *args: Any, **kwargs: Any):
+        self.log("warning", message, *args, **kwargs)
+
+    def error(self, message: str, *args: Any, **kwargs: Any):
+        self.log("error", message, *args, **kwargs)
+
+
+_loggers: Dict[str, Logger] = {}
+
+
+def get_logger(name: str) -> Logger:
+    """返回指定名称的日志记录器，同名共用一个实例"""
+    logger = _loggers.get(name)
+    if logger is None:
+        logger = _loggers.setdefault(name, Logger(name))
+    return logger
+
+
+class ConversationLog:
+    """
+    对话日志：每轮问答追加为一行 JSON（时间、会话 id、问题、回答及额外字段），按大小轮转
+
+    写入通过后台写入器完成，不阻塞请求；同一文件的多个引擎共用一个文件对象。
+
+    使用示例：
+    >>> conversation_log = ConversationLog("conversation.jsonl")
+    >>> conversation_log.record(session_id="user-1", question="你好", answer="你好！")
+    """
+
+    def __init__(self, path: str, max_bytes: int = LOG_MAX_BYTES, backup_count: int = LOG_BACKUP_COUNT, sample: float = 1.0):
+        self.path = path
+        self.sample = sample
+        self.sink = writer.file(path, max_bytes, backup_count)
+
+    def record(self, **fields: Any) -> bool:
+        """追加一轮对话记录，返回是否入队（被采样跳过或队列已满时返回 False）"""
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return False
+        return writer.submit(self.sink, {"ts": time.time(), **fields})
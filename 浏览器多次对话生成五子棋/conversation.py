@@ -2,21 +2,41 @@ import json
 from datetime import datetime
 import os
 import random
-from openai import OpenAI
+from llm_transport import LLMTransport
+import metrics
+from async_logger import ConversationLog, get_logger
+from session_store import SessionStore
+from async_runtime import AsyncRuntime, ServerBusyError
+from context_window import ContextWindow
 
 # 从环境变量获取 DeepSeek API Key
 api_key = os.getenv("DEEPSEEK_API_KEY")
+# 指向本地模拟服务（DEEPSEEK_BASE_URL）时不需要真实的 API Key
+base_url = os.getenv("DEEPSEEK_BASE_URL")
 if not api_key:
-    raise ValueError("请设置 DEEPSEEK_API_KEY 环境变量")
+    if not base_url:
+        raise ValueError("请设置 DEEPSEEK_API_KEY 环境变量")
+    api_key = "mock"
 
-# 初始化 OpenAI 客户端（假设 DeepSeek 的 API 兼容 OpenAI 格式）
-client = OpenAI(
+# 所有大模型调用共用的传输层（假设 DeepSeek 的 API 兼容 OpenAI 格式）：
+# 同步 / 异步客户端各自使用 keep-alive 连接池，调用超时、限流和服务端错误自动重试
+# DEEPSEEK_BASE_URL 可指向本地模拟服务；DEEPSEEK_HEDGE=1 时启用对冲请求
+transport = LLMTransport(
     api_key=api_key,
-    base_url="https://api.deepseek.com/v1",  # DeepSeek API 的基地址
+    base_url=base_url or "https://api.deepseek.com/v1",  # DeepSeek API 的基地址
+    max_connections=64,
+    timeout=60,
+    max_retries=3,
+    hedge=os.getenv("DEEPSEEK_HEDGE") == "1",
 )
 
+log = get_logger("conversation")
+
+SYSTEM_PROMPT = "你是一个专业的 Web 开发助手，擅长用 HTML/CSS/JavaScript 编写游戏。"
+
+SUMMARY_PROMPT = "请把下面的新对话合并进已有摘要，生成一段简洁的中文摘要，保留用户的需求、已确定的方案和关键结论，不超过300字。"
+
 class ConversationEngine:
-    messages : list = [{"role": "system", "content": "你是一个专业的 Web 开发助手，擅长用 HTML/CSS/JavaScript 编写游戏。"}]
     """
     多轮对话引擎类
     
@@ -28,30 +48,89 @@ class ConversationEngine:
     
     使用方法：
     1. 初始化引擎: engine = ConversationEngine()
-    2. 处理用户消息: response = engine.chat(user_message)
+    2. 处理用户消息: response = engine.chat_with_deepseek(user_message, session_id)
     3. 获取对话历史: history = engine.get_history()
     4. 保存对话日志: engine.save_logs()
     """
     
-    def __init__(self, log_file):
+    def __init__(
+        self,
+        log_file,
+        session_db_path: str = None,
+        context_budget: int = 8000,
+        runtime: AsyncRuntime = None
+    ):
         """
         初始化对话引擎
         
         参数:
-        log_file: 对话日志保存
+        log_file: 对话日志保存路径（每轮问答追加一行 JSON，按大小轮转）
+        session_db_path: 会话持久化的 SQLite 路径（可选，默认仅保存在内存中）
+        context_budget: 每次请求的 token 预算，超出时早期对话被折叠进摘要
+        runtime: 异步运行时（可选，None 表示使用同步客户端）
         """
+        self.runtime = runtime
         self.log_file = log_file
+        self.conversation_log = ConversationLog(log_file)
         self.conversation_history = []
+        # 每个会话独立保存对话历史，不同用户之间互不干扰
+        self.sessions = SessionStore(SYSTEM_PROMPT, db_path=session_db_path)
+        self.context_window = ContextWindow(budget_tokens=context_budget, summarizer=self.summarize)
+
+    def _create_completion(self, stage: str = "llm", **kwargs):
+        """
+        调用 DeepSeek：配置了异步运行时时在其事件循环中并发执行，否则使用同步客户端
+
+        stage 为指标中的阶段名，调用耗时、结果和 token 用量按阶段记录
+        """
+        if kwargs.get("stream"):
+            # 最后一个数据块附带本次调用的 token 用量
+            kwargs.setdefault("stream_options", {"include_usage": True})
+            return metrics.observe_stream(stage, lambda: self._request_completion(**kwargs))
+        return metrics.observe_completion(stage, lambda: self._request_completion(**kwargs))
+
+    def _request_completion(self, **kwargs):
+        if self.runtime is None:
+            return transport.create(**kwargs)
+        if kwargs.get("stream"):
+            return self.runtime.iterate(lambda: transport.acreate(**kwargs))
+        return self.runtime.run(lambda: transport.acreate(**kwargs))
+
+    def summarize(self, summary: str, messages: list) -> str:
+        """调用 DeepSeek 把早期对话合并进滚动摘要"""
+        conversation = "\n".join(
+            f"{'用户' if message['role'] == 'user' else '助手'}：{message['content']}" for message in messages
+        )
+        response = self._create_completion(
+            stage="llm_summary",
+            model="deepseek-chat",
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": f"已有摘要：\n{summary or '无'}\n\n新的对话：\n{conversation}"},
+            ],
+            temperature=0.3,
+            max_tokens=400,
+            stream=False
+        )
+        return response.choices[0].message.content
 
     
-    def chat_with_deepseek(self, prompt) -> str:
-        self.messages.append({"role": "user", "content": prompt})
+    def chat_with_deepseek(self, prompt, session_id: str = "default") -> str:
+        with self.sessions.session(session_id) as session:
+            return self._chat(prompt, session)
+
+    def _chat(self, prompt, session) -> str:
+        user_message = {"role": "user", "content": prompt}
+        # 在 token 预算内组织请求：早期对话折叠为摘要，只携带最近的历史
+        with metrics.span("context_build"):
+            messages = self.context_window.build(session, [user_message])
         try:
-            print(f"lpppppppp: {self.messages}")
+            log.debug("请求消息：%s", messages)
             # 调用 DeepSeek Chat API
-            response = client.chat.completions.create(
+            response = self._create_completion(
+                stage="llm_answer",
                 model="deepseek-chat",  # 或 DeepSeek 提供的其他模型名称
-                messages=self.messages,
+                messages=messages,
                 temperature=0.7,
                 stream=False
             )
@@ -59,20 +138,73 @@ class ConversationEngine:
             # 提取生成的 HTML 内容
             if response.choices and len(response.choices) > 0:
                 html_content = response.choices[0].message.content
-                self.messages.append(response.choices[0].message)
-                print(f"问题：{prompt}，响应: {html_content}")
-                with open(self.log_file, "w", encoding="utf-8") as f:
-                    f.write(f"Question: {prompt}\n")
-                    f.write(f"Answer: {html_content}\n")
+                session.messages.append(user_message)
+                session.messages.append({"role": "assistant", "content": html_content})
+                log.debug("问题：%s，响应: %s", prompt, html_content)
+                self.conversation_log.record(session_id=session.session_id, question=prompt, answer=html_content)
                 return html_content
                 # 保存到文件
                 
                 
             else:
-                print("未收到有效响应")
-                self.messages.pop()
+                log.warning("未收到有效响应")
                 return ""
+        except ServerBusyError:
+            # 排队已满，交给接口层返回 503
+            raise
+        except Exception as e:
+            log.error("调用 API 出错: %s", e)
+            return ""
+
+    def chat_with_deepseek_stream(self, prompt, session_id: str = "default"):
+        """
+        流式调用 DeepSeek，逐块产出生成的内容
+
+        参数:
+        prompt: 用户消息
+        session_id: 会话 id
+
+        产出:
+        事件字典，type 为 "delta"（增量内容）、"done"（生成结束）或 "error"（调用出错）
+        """
+        with self.sessions.session(session_id) as session:
+            yield from self._chat_stream(prompt, session)
+
+    def _chat_stream(self, prompt, session):
+        user_message = {"role": "user", "content": prompt}
+        with metrics.span("context_build"):
+            messages = self.context_window.build(session, [user_message])
+        try:
+            response = self._create_completion(
+                stage="llm_answer",
+                model="deepseek-chat",
+                messages=messages,
+                temperature=0.7,
+                stream=True
+            )
+
+            parts = []
+            for chunk in response:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield {"type": "delta", "content": delta}
+
+            html_content = "".join(parts)
+            if not html_content:
+                log.warning("未收到有效响应")
+                yield {"type": "error", "content": "未收到有效响应"}
+                return
+
+            session.messages.append(user_message)
+            session.messages.append({"role": "assistant", "content": html_content})
+            log.debug("问题：%s，响应: %s", prompt, html_content)
+            self.conversation_log.record(session_id=session.session_id, question=prompt, answer=html_content, stream=True)
+            yield {"type": "done"}
+        except ServerBusyError:
+            raise
         except Exception as e:
-            print(f"调用 API 出错: {e}")
-            self.messages.pop()
-            return ""
\ No newline at end of file
+            log.error("调用 API 出错: %s", e)
+            yield {"type": "error", "content": f"调用 API 出错: {e}"}
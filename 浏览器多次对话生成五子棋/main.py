@@ -1,8 +1,38 @@
-from flask import Flask, request, jsonify
-from conversation import ConversationEngine
+import json
+import uuid
+
+from flask import Flask, request, jsonify, Response, stream_with_context
+from conversation import ConversationEngine, transport
+from async_runtime import AsyncRuntime, ServerBusyError
+import metrics
+import async_logger
 
 app = Flask(__name__)
-engine = ConversationEngine("conversation.log")
+log = async_logger.get_logger("main")
+# 所有请求的大模型调用共用一个后台事件循环，最多 32 个并发调用，超过 128 个排队时返回 503
+runtime = AsyncRuntime(max_concurrency=32, max_queue=128)
+metrics.register_components(runtime, transport, async_logger.writer)
+# 对话日志追加写入 JSON 行文件（按大小轮转），由后台线程写入
+engine = ConversationEngine("conversation.jsonl", runtime=runtime)
+
+SESSION_COOKIE = 'session_id'
+
+def resolve_session_id(data: dict) -> tuple[str, bool]:
+    """
+    取请求的会话 id：优先使用请求体中的 session_id，其次是 cookie；都没有时生成新的 id（第二个返回值为 True），
+    由接口通过 cookie 和响应返回给客户端，没有带 session_id 的客户端之间不会共用同一个会话
+    """
+    session_id = data.get('session_id') or request.cookies.get(SESSION_COOKIE)
+    if session_id:
+        return str(session_id), False
+    return uuid.uuid4().hex, True
+
+def attach_session(response: Response, session_id: str, is_new: bool) -> Response:
+    """在响应头中带上会话 id，新生成的 id 同时写入 cookie"""
+    response.headers['X-Session-Id'] = session_id
+    if is_new:
+        response.set_cookie(SESSION_COOKIE, session_id, httponly=True, samesite='Lax')
+    return response
 
 @app.route('/')
 def index():
@@ -12,14 +42,54 @@ def index():
 def chat_endpoint():
     data = request.json
     user_message = data.get('message', '')
-    print(f"lppppp:{user_message}")
+    session_id, is_new = resolve_session_id(data)
+    log.debug("收到消息：%s", user_message)
     # 处理用户消息
-    response = engine.chat_with_deepseek(user_message)
+    with metrics.request_trace('/chat') as trace:
+        try:
+            response = engine.chat_with_deepseek(user_message, session_id)
+        except ServerBusyError:
+            trace.status = 'busy'
+            return attach_session(jsonify({'response': '服务繁忙，请稍后再试', 'session_id': session_id}), session_id, is_new), 503
     
-    return jsonify({
+    return attach_session(jsonify({
         'response': response,
+        'session_id': session_id,
         #'history': engine.get_history()
-    })
+    }), session_id, is_new)
+
+def sse_event(event: dict) -> str:
+    """将事件编码为 Server-Sent Events 格式"""
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+def sse_events(events):
+    """将事件流编码为 SSE，排队已满时以错误事件结束（计时覆盖整个生成过程）"""
+    with metrics.request_trace('/chat/stream') as trace:
+        try:
+            for event in events:
+                yield sse_event(event)
+        except ServerBusyError:
+            trace.status = 'busy'
+            yield sse_event({'type': 'error', 'content': '服务繁忙，请稍后再试'})
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream_endpoint():
+    data = request.json
+    user_message = data.get('message', '')
+    session_id, is_new = resolve_session_id(data)
+    # 以 SSE 的形式逐块返回生成内容，浏览器收到第一块即可开始渲染
+    events = engine.chat_with_deepseek_stream(user_message, session_id)
+
+    return attach_session(Response(
+        stream_with_context(sse_events(events)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    ), session_id, is_new)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 抓取接口：请求和各阶段的耗时直方图、大模型调用次数和 token 用量"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 # @app.route('/clear', methods=['POST'])
 # def clear_history():
@@ -27,4 +97,4 @@ def chat_endpoint():
 #     return jsonify({'status': 'success'})
 
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    app.run(debug=True, port=5000, use_reloader=False, threaded=True)
@@ -0,0 +1,388 @@
+import contextvars
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from async_logger import get_logger
+
+# 阶段耗时的分桶上限（秒）：覆盖从毫秒级的缓存命中、检索到数十秒的大模型调用
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# 整个请求耗时超过该秒数时打印各阶段耗时明细
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "5"))
+
+# usage 中的字段 -> token 类型标签；prompt_cache_hit/miss_tokens 为 DeepSeek 的上下文缓存统计
+_USAGE_FIELDS = (
+    ("prompt_tokens", "prompt"),
+    ("completion_tokens", "completion"),
+    ("prompt_cache_hit_tokens", "prompt_cache_hit"),
+    ("prompt_cache_miss_tokens", "prompt_cache_miss"),
+)
+
+log = get_logger("metrics")
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[Any], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    """单调递增的计数器，按标签值分别计数"""
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, labels: Tuple = ()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}" for labels, value in values]
+        return lines
+
+
+class Histogram:
+    """
+    固定分桶的直方图
+
+    每个标签组合只保存各桶的计数、总和与次数，记录一次耗时只需一次二分查找和一次加锁，
+    输出时再累加为 Prometheus 要求的累积分桶。
+    """
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = (), buckets: Sequence[float] = DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # 标签值 -> [各桶计数（最后一个为 +Inf）, 总和, 次数]
+        self._series: Dict[Tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, labels: Tuple = ()):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            series = sorted((labels, (list(counts), total, count)) for labels, (counts, total, count) in self._series.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                le_label = f'le="{le}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, le_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {count}")
+        return lines
+
+
+class CallbackGauge:
+    """输出时才调用回调取值的指标，用于暴露已有组件的统计信息（例如传输层的重试次数）"""
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str], callback: Callable[[], Dict[Tuple, float]],
+                 metric_type: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.callback = callback
+        self.metric_type = metric_type
+
+    def render(self) -> List[str]:
+        try:
+            values = sorted(self.callback().items())
+        except Exception as e:
+            return [f"# {self.name} 采集失败: {_escape(e)}"]
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.metric_type}"]
+        lines += [
+            f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+            for labels, value in values if value is not None
+        ]
+        return lines
+
+
+class MetricsRegistry:
+    """
+    进程内的指标注册表，render() 输出 Prometheus 文本格式
+
+    使用示例：
+    >>> registry = MetricsRegistry()
+    >>> requests = registry.counter("app_requests_total", "请求数", ["endpoint"])
+    >>> requests.inc(labels=("/chat",))
+    >>> print(registry.render())
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None and not isinstance(metric, CallbackGauge):
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help: str, label_names: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, label_names))
+
+    def histogram(self, name: str, help: str, label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = DURATION_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, label_names, buckets))
+
+    def gauge_callback(self, name: str, help: str, label_names: Sequence[str],
+                       callback: Callable[[], Dict[Tuple, float]], metric_type: str = "gauge") -> CallbackGauge:
+        """注册回调指标，同名指标重复注册时替换"""
+        return self._register(CallbackGauge(name, help, label_names, callback, metric_type))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+REQUEST_SECONDS = registry.histogram(
+    "chat_request_duration_seconds", "接口请求的总耗时", ["endpoint", "status"])
+STAGE_SECONDS = registry.histogram(
+    "chat_stage_duration_seconds", "各处理阶段的耗时（阶段可以嵌套，例如检索包含查询编码）", ["stage"])
+STAGE_ERRORS = registry.counter(
+    "chat_stage_errors_total", "各处理阶段抛出异常的次数", ["stage"])
+LLM_REQUESTS = registry.counter(
+    "llm_requests_total", "大模型调用次数", ["stage", "status"])
+LLM_TOKENS = registry.counter(
+    "llm_tokens_total", "大模型调用消耗的 token 数（来自接口返回的 usage）", ["stage", "type"])
+LLM_FIRST_TOKEN_SECONDS = registry.histogram(
+    "llm_time_to_first_token_seconds", "流式调用从发出请求到收到第一个数据块的耗时", ["stage"])
+
+# 当前请求的耗时明细，由 request_trace 设置；未设置时阶段耗时只记入直方图
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("metrics_trace", default=None)
+
+
+class RequestTrace:
+    """一次请求内各阶段的耗时明细，status 可由调用方修改（例如排队已满时设为 "busy"）"""
+
+    __slots__ = ("endpoint", "status", "spans", "start")
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.status = "ok"
+        # (阶段, 耗时秒数) 列表，并行执行的工具在各自线程中追加（list.append 是原子操作）
+        self.spans: List[Tuple[str, float]] = []
+        self.start = time.perf_counter()
+
+
+def observe(stage: str, seconds: float, detail: Optional[str] = None):
+    """
+    记录一个阶段的耗时
+
+    参数:
+    stage: 阶段名（直方图的标签，取值应是有限的几种）
+    seconds: 耗时秒数
+    detail: 写入请求明细的名称（可选，例如带轮次编号的 "agent_iteration_2"），不影响直方图的标签
+    """
+    STAGE_SECONDS.observe(seconds, (stage,))
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.spans.append((detail or stage, seconds))
+
+
+class span:
+    """
+    计时上下文管理器：退出时把耗时记入阶段直方图和当前请求的明细，异常时同时累加错误计数
+
+    使用示例：
+    >>> with metrics.span("retrieval"):
+    ...     hits = db.search(collection, question)
+    """
+
+    __slots__ = ("stage", "detail", "start")
+
+    def __init__(self, stage: str, detail: Optional[str] = None):
+        self.stage = stage
+        self.detail = detail
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.stage, time.perf_counter() - self.start, self.detail)
+        if exc_type is not None and issubclass(exc_type, Exception):
+            STAGE_ERRORS.inc(labels=(self.stage,))
+        return False
+
+
+class _SpanBreakdown:
+    """慢请求日志中的阶段耗时明细，转成字符串时才格式化"""
+
+    __slots__ = ("spans",)
+
+    def __init__(self, spans: List[Tuple[str, float]]):
+        self.spans = spans
+
+    def __str__(self) -> str:
+        return ", ".join(f"{name}={seconds * 1000:.0f}ms" for name, seconds in self.spans)
+
+
+class request_trace:
+    """
+    请求级的计时：记录接口总耗时，收集请求内各阶段的耗时，超过 SLOW_REQUEST_SECONDS 时打印明细
+
+    流式接口应在产出事件的生成器内部使用，使计时覆盖整个生成过程。
+    """
+
+    def __init__(self, endpoint: str):
+        self.trace = RequestTrace(endpoint)
+        self.previous = None
+
+    def __enter__(self) -> RequestTrace:
+        self.previous = _current_trace.get()
+        _current_trace.set(self.trace)
+        return self.trace
+
+    def __exit__(self, exc_type, exc, tb):
+        # 不使用 reset(token)：流式响应的生成器可能在另一个上下文中结束
+        _current_trace.set(self.previous)
+        trace = self.trace
+        if exc_type is not None and issubclass(exc_type, Exception) and trace.status == "ok":
+            trace.status = "error"
+        elapsed = time.perf_counter() - trace.start
+        REQUEST_SECONDS.observe(elapsed, (trace.endpoint, trace.status))
+        if elapsed >= SLOW_REQUEST_SECONDS:
+            # 明细在后台写日志的线程中格式化；复制一份，避免线程池中仍在运行的阶段继续追加
+            log.warning("慢请求 %s 耗时 %.2fs（%s）: %s", trace.endpoint, elapsed, trace.status, _SpanBreakdown(list(trace.spans)))
+        return False
+
+
+def traced(fn: Callable, *args, **kwargs) -> Callable[[], Any]:
+    """
+    把函数绑定到当前上下文，提交到线程池后在其中记录的阶段耗时仍归入当前请求的明细
+
+    使用示例：
+    >>> executor.submit(metrics.traced(call_tool, name, args))
+    """
+    context = contextvars.copy_context()
+    return lambda: context.run(fn, *args, **kwargs)
+
+
+def record_usage(stage: str, usage: Any):
+    """按阶段累加接口返回的 token 用量（usage 为空时忽略）"""
+    if usage is None:
+        return
+    for field, token_type in _USAGE_FIELDS:
+        value = getattr(usage, field, None)
+        if value:
+            LLM_TOKENS.inc(value, (stage, token_type))
+
+
+def observe_completion(stage: str, create: Callable[[], Any]) -> Any:
+    """非流式大模型调用：记录耗时、调用结果和 token 用量"""
+    with span(stage):
+        try:
+            response = create()
+        except Exception:
+            LLM_REQUESTS.inc(labels=(stage, "error"))
+            raise
+    LLM_REQUESTS.inc(labels=(stage, "ok"))
+    record_usage(stage, getattr(response, "usage", None))
+    return response
+
+
+def observe_stream(stage: str, create: Callable[[], Any]) -> Iterator[Any]:
+    """
+    流式大模型调用：记录首个数据块的耗时、完整耗时、调用结果，以及最后一个数据块中的 token 用量
+    （请求需带上 stream_options={"include_usage": True}）
+
+    调用方提前停止读取（例如客户端断开）时只记录耗时，不计为失败。
+    """
+    start = time.perf_counter()
+    first = True
+    try:
+        for chunk in create():
+            if first:
+                LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - start, (stage,))
+                first = False
+            usage = getattr(chunk, "usage", None)
+            if usage is not None:
+                record_usage(stage, usage)
+            yield chunk
+    except Exception:
+        LLM_REQUESTS.inc(labels=(stage, "error"))
+        STAGE_ERRORS.inc(labels=(stage,))
+        raise
+    else:
+        LLM_REQUESTS.inc(labels=(stage, "ok"))
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def register_components(runtime: Any = None, transport: Any = None, log_writer: Any = None):
+    """
+    把异步运行时和大模型传输层已有的统计信息注册为指标，抓取时才读取，不增加调用路径上的开销
+
+    参数:
+    runtime: AsyncRuntime（可选），暴露并发中、排队中的调用数和拒绝次数
+    transport: LLMTransport（可选），暴露调用、重试、失败和对冲次数
+    log_writer: AsyncLogWriter（可选），暴露已写入和因队列已满被丢弃的日志条数
+    """
+    if runtime is not None:
+        registry.gauge_callback(
+            "llm_runtime_calls", "异步运行时中的大模型调用数", ["state"],
+            lambda: {("in_flight",): runtime.in_flight, ("waiting",): runtime.waiting},
+        )
+        registry.gauge_callback(
+            "llm_runtime_rejected_total", "排队已满被拒绝的调用数", [],
+            lambda: {(): runtime.rejected}, metric_type="counter",
+        )
+    if transport is not None:
+        registry.gauge_callback(
+            "llm_transport_events_total", "传输层的调用、重试、失败和对冲次数", ["event"],
+            lambda: {(name,): value for name, value in transport.stats().items() if not name.startswith("latency_")},
+            metric_type="counter",
+        )
+    if log_writer is not None:
+        registry.gauge_callback(
+            "log_records_total", "后台日志写入器处理的日志条数", ["result"],
+            lambda: {("written",): log_writer.written, ("dropped",): log_writer.dropped},
+            metric_type="counter",
+        )
+
+
+def render() -> str:
+    """Prometheus 文本格式的全部指标"""
+    return registry.render()
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"